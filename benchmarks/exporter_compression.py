@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Exporter compression codecs benchmark.
+
+Compresses the records fixtures, serialized as JSON lines and repeated to
+get a reasonably sized corpus, with each registered codec and reports the
+throughput and the compression ratio::
+
+    $ python benchmarks/exporter_compression.py --repeat 500
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import time
+from os.path import dirname, join
+
+from zenodo.modules.exporter.streams import COMPRESSORS, get_compressor
+
+FIXTURES = join(dirname(__file__), '..', 'zenodo', 'modules', 'fixtures',
+                'data', 'records.json')
+
+CODECS = [
+    ('bz2', {}),
+    ('pbz2', {}),
+    ('gzip', {}),
+    ('pgzip', {}),
+    ('xz', {}),
+    ('zstd', {'level': 3}),
+    ('zstd', {'level': 10}),
+    ('zstd', {'level': 10, 'threads': -1}),
+]
+
+
+def load_corpus(repeat):
+    """Load the records fixtures as a list of JSON lines."""
+    with open(FIXTURES) as fp:
+        records = json.load(fp)
+    lines = [(json.dumps(r) + '\n').encode('utf8') for r in records]
+    return lines * repeat
+
+
+def run(codec, options, corpus):
+    """Compress the corpus and return the elapsed time and output size."""
+    compressor = get_compressor(codec, **options)
+    size = 0
+    start = time.time()
+    for line in corpus:
+        size += len(compressor.compress(line))
+    size += len(compressor.flush())
+    return time.time() - start, size
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.repeat)
+    total = sum(len(line) for line in corpus)
+    print('Corpus: {0} records, {1:.1f} MiB'.format(
+        len(corpus), total / 2.0 ** 20))
+    print('{0:<30} {1:>10} {2:>12} {3:>8}'.format(
+        'codec', 'MiB/s', 'size (KiB)', 'ratio'))
+    for codec, options in CODECS:
+        assert codec in COMPRESSORS
+        name = '{0} {1}'.format(codec, options) if options else codec
+        try:
+            elapsed, size = run(codec, options, corpus)
+        except RuntimeError as e:
+            print('{0:<30} skipped ({1})'.format(name, e))
+            continue
+        print('{0:<30} {1:>10.1f} {2:>12.0f} {3:>8.2f}'.format(
+            name, total / 2.0 ** 20 / elapsed, size / 1024.0,
+            float(total) / size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Piwik export query strings benchmark.
+
+Builds the query strings of synthetic statistics events, spread over a
+number of records, with the per-event builder previously used by the Piwik
+exporter and with the batch builder, and reports the events/sec::
+
+    $ python benchmarks/piwik_query_strings.py --events 100000 --records 500
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import random
+import time
+
+from elasticsearch_dsl.utils import AttrDict
+from flask import Flask
+from six.moves.urllib.parse import urlencode
+
+from zenodo.modules.records.serializers.schemas.common import ui_link_for
+from zenodo.modules.stats.exporters import build_query_strings
+from zenodo.modules.stats.lookup import RecordEntry, RecordLookup
+
+
+def make_lookup(n_records):
+    """Create a lookup of synthetic records."""
+    lookup = RecordLookup(max_size=n_records)
+    for recid in range(1, n_records + 1):
+        lookup._set(str(recid), RecordEntry(recid, {
+            'recid': recid,
+            'title': u'Record {0} title'.format(recid) * 10,
+            '_oai': {'id': 'oai:zenodo.org:{0}'.format(recid)},
+        }))
+    return lookup
+
+
+def make_events(n_events, n_records):
+    """Create synthetic view and download events."""
+    events = []
+    for i in range(n_events):
+        event = dict(
+            recid=str(random.randint(1, n_records)),
+            visitor_id='{0:032x}'.format(random.getrandbits(128)),
+            timestamp='2019-01-01T00:{0:02d}:{1:02d}'.format(
+                i // 60 % 60, i % 60),
+            referrer='https://example.org/{0}'.format(i % 100),
+            country='CH',
+        )
+        if i % 3 == 0:
+            event['file_key'] = 'file-{0}.pdf'.format(i % 5)
+        events.append(AttrDict(event))
+    return events
+
+
+def build_query_string(event, lookup, id_site):
+    """Build the query string of a single event (previous implementation)."""
+    record = lookup.get(event.recid)
+    if record is None:
+        return None
+    url = ui_link_for('record_html', id=event.recid)
+    visitor_id = event.visitor_id[0:16]
+    params = dict(
+        idsite=id_site,
+        rec=1,
+        url=url,
+        _id=visitor_id,
+        cid=visitor_id,
+        cvar=json.dumps({'1': ['oaipmhID', record.oai_id]}),
+        cdt=event.timestamp,
+        urlref=event.referrer,
+        action_name=record.title[:150],
+    )
+    if event.to_dict().get('country'):
+        params['country'] = event.country.lower()
+    if event.to_dict().get('file_key'):
+        params['url'] = ui_link_for('record_file', id=event.recid,
+                                    filename=event.file_key)
+        params['download'] = params['url']
+    return '?{}'.format(urlencode(params, 'utf-8'))
+
+
+def per_event(events, lookup, chunk_size):
+    """Build the query strings event by event."""
+    for i in range(0, len(events), chunk_size):
+        [build_query_string(e, lookup, 1) for e in events[i:i + chunk_size]]
+
+
+def batch(events, lookup, chunk_size):
+    """Build the query strings page by page."""
+    for i in range(0, len(events), chunk_size):
+        build_query_strings(events[i:i + chunk_size], lookup, id_site=1)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--records', type=int, default=500)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    app = Flask('benchmark')
+    app.config['THEME_SITEURL'] = 'https://zenodo.org'
+    lookup = make_lookup(args.records)
+    events = make_events(args.events, args.records)
+    with app.app_context():
+        for name, func in (('per-event', per_event), ('batch', batch)):
+            start = time.time()
+            func(events, lookup, args.chunk_size)
+            elapsed = time.time() - start
+            print('{0:<10} {1:>12.0f} events/sec'.format(
+                name, args.events / elapsed))
+
+
+if __name__ == '__main__':
+    main()
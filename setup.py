@@ -45,10 +45,16 @@ tests_require = [
 ]
 
 extras_require = {
+    'columnar': [
+        'pyarrow>=0.13.0',
+    ],
     'docs': [
         'Sphinx>=1.5,<1.6',
     ],
     'tests': tests_require,
+    'zstd': [
+        'zstandard>=0.11.0',
+    ],
 }
 
 extras_require['all'] = []
@@ -241,6 +247,12 @@ setup(
         'invenio_config.module': [
             'zenodo = zenodo.config',
         ],
+        'invenio_db.alembic': [
+            'zenodo_stats = zenodo.modules.stats:alembic',
+        ],
+        'invenio_db.models': [
+            'zenodo_stats = zenodo.modules.stats.models',
+        ],
         'invenio_pidstore.minters': [
             'zenodo_record_minter '
             '= zenodo.modules.records.minters:zenodo_record_minter',
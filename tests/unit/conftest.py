@@ -82,6 +82,7 @@ from zenodo.modules.fixtures.records import loadsipmetadatatypes
 from zenodo.modules.github.cli import github
 from zenodo.modules.records.api import ZenodoRecord
 from zenodo.modules.records.models import AccessRight
+from zenodo.modules.records.refs import refs_cache
 from zenodo.modules.records.serializers.bibtex import Bibtex
 from zenodo.modules.tokens.scopes import tokens_generate_scope
 
@@ -340,6 +341,7 @@ def db(app):
     yield db_
     db_.session.remove()
     db_.drop_all()
+    refs_cache.invalidate()
 
 
 @pytest.yield_fixture
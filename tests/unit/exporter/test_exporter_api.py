@@ -26,10 +26,20 @@
 
 from __future__ import absolute_import, print_function
 
+import bz2
+from datetime import timedelta
+
+import pytest
 from invenio_files_rest.models import ObjectVersion
 from invenio_indexer.api import RecordIndexer
 from invenio_search import current_search
+from lxml import etree
+from mock import patch
+from six import BytesIO
 
+from zenodo.modules.exporter import Exporter, FanoutExporter, \
+    IncrementalExporter
+from zenodo.modules.exporter.errors import FailedExportJobError
 from zenodo.modules.exporter.tasks import export_job
 
 
@@ -43,3 +53,172 @@ def test_exporter(app, db, es, exporter_bucket, record_with_files_creation):
         assert ObjectVersion.get_by_bucket(exporter_bucket).count() == 0
         export_job(job_id='records')
         assert ObjectVersion.get_by_bucket(exporter_bucket).count() == 1
+
+
+def test_sliced_exporter(app, db, es, exporter_bucket,
+                         record_with_files_creation):
+    """Test sliced record exporter."""
+    pid, record, record_url = record_with_files_creation
+    RecordIndexer().index_by_id(record.id)
+    current_search.flush_and_refresh('records')
+
+    job = app.config['EXPORTER_JOBS']['records']
+    with patch.dict(app.config['EXPORTER_JOBS'],
+                    records=dict(job, slices=4, checkpoint_key=None)):
+        export_job(job_id='records')
+    objs = ObjectVersion.get_by_bucket(exporter_bucket).all()
+    assert len(objs) == 1
+    assert '.part-' not in objs[0].key
+    assert objs[0].file.size > 0
+
+
+def test_sliced_exporter_failed_record(app, db, es, exporter_bucket,
+                                       record_with_files_creation):
+    """Test sliced export with a record failing to be serialized."""
+    pid, record, record_url = record_with_files_creation
+    RecordIndexer().index_by_id(record.id)
+    current_search.flush_and_refresh('records')
+
+    job = app.config['EXPORTER_JOBS']['records']
+    with patch.dict(app.config['EXPORTER_JOBS'],
+                    records=dict(job, slices=4, checkpoint_key=None)), \
+            patch.object(job['serializer'], 'serialize_exporter',
+                         side_effect=Exception('failed')):
+        with pytest.raises(FailedExportJobError) as excinfo:
+            export_job(job_id='records')
+    assert str(record.id) in str(excinfo.value)
+    # The parts were still written and assembled
+    objs = ObjectVersion.get_by_bucket(exporter_bucket).all()
+    assert len(objs) == 1
+    assert '.part-' not in objs[0].key
+
+
+def test_incremental_exporter(app, db, es, exporter_bucket,
+                              record_with_files_creation):
+    """Test incremental record exporter."""
+    pid, record, record_url = record_with_files_creation
+    RecordIndexer().index_by_id(record.id)
+    current_search.flush_and_refresh('records')
+
+    job = dict(app.config['EXPORTER_JOBS']['records-delta'])
+    assert job.pop('exporter_cls') is IncrementalExporter
+    writer = job.pop('writer')
+
+    assert IncrementalExporter(
+        lag=timedelta(0), writer=writer.copy('delta-1'), **job).run()
+    state = writer.load_state(job['state_key'])
+    assert state['key'] == 'delta-1'
+    assert state['since'] is None
+    assert writer.load_state('delta-1.deleted.json')['deleted'] == []
+
+    # The second run starts where the first one ended
+    assert IncrementalExporter(
+        lag=timedelta(0), writer=writer.copy('delta-2'), **job).run()
+    new_state = writer.load_state(job['state_key'])
+    assert new_state['key'] == 'delta-2'
+    assert new_state['since'] == state['until']
+
+
+def test_checkpointed_exporter(app, db, es, exporter_bucket,
+                               record_with_files_creation):
+    """Test checkpointed record exporter."""
+    pid, record, record_url = record_with_files_creation
+    RecordIndexer().index_by_id(record.id)
+    current_search.flush_and_refresh('records')
+
+    job = dict(app.config['EXPORTER_JOBS']['records'])
+    job.pop('checkpoint_key')
+    writer = job.pop('writer')
+
+    assert Exporter(checkpoint_key='checkpoint.json', checkpoint_size=1,
+                    writer=writer.copy('full'), **job).run()
+    assert [o.key for o in ObjectVersion.get_by_bucket(exporter_bucket)] \
+        == ['full']
+    assert ObjectVersion.get(exporter_bucket, 'full').file.size > 0
+
+    # Resume from a checkpoint after the last record
+    writer.save_state('checkpoint.json', dict(
+        key='resumed', parts=[], search_after=[record['recid']]))
+    assert Exporter(checkpoint_key='checkpoint.json', checkpoint_size=1,
+                    writer=writer, **job).run()
+    assert ObjectVersion.get(exporter_bucket, 'resumed')
+    assert ObjectVersion.get(exporter_bucket, 'checkpoint.json') is None
+
+
+def test_checkpointed_exporter_resume_merged(app, db, es, exporter_bucket):
+    """Test resuming a checkpointed export interrupted after the merge."""
+    job = dict(app.config['EXPORTER_JOBS']['records'])
+    checkpoint_key = job.pop('checkpoint_key')
+    writer = job.pop('writer')
+    for key in ('resumed', 'resumed.part-0000'):
+        fp = writer.copy(key).open()
+        fp.write(BytesIO(b'records'))
+        fp.close()
+    # The second part was already removed when the job was interrupted
+    writer.save_state(checkpoint_key, dict(
+        key='resumed', parts=['resumed.part-0000', 'resumed.part-0001'],
+        merged=True, failed_ids=[], failed_count=0))
+
+    with patch.object(Exporter, '_write') as write:
+        assert Exporter(checkpoint_key=checkpoint_key, writer=writer,
+                        **job).run()
+    assert not write.called
+    assert [o.key for o in ObjectVersion.get_by_bucket(exporter_bucket)] \
+        == ['resumed']
+    obj = ObjectVersion.get(exporter_bucket, 'resumed')
+    with obj.file.storage().open('rb') as fp:
+        assert fp.read() == b'records'
+
+
+def test_checkpointed_exporter_failed_record(app, db, es, exporter_bucket,
+                                            record_with_files_creation):
+    """Test checkpointed export with a record failing to be serialized."""
+    pid, record, record_url = record_with_files_creation
+    RecordIndexer().index_by_id(record.id)
+    current_search.flush_and_refresh('records')
+
+    job = dict(app.config['EXPORTER_JOBS']['records'])
+    job.pop('checkpoint_key')
+    writer = job.pop('writer')
+
+    with patch.object(job['serializer'], 'serialize_exporter',
+                      side_effect=Exception('failed')):
+        assert not Exporter(
+            checkpoint_key='checkpoint.json', checkpoint_size=1,
+            writer=writer.copy('full'), **job).run()
+    # The parts were still written and assembled
+    assert [o.key for o in ObjectVersion.get_by_bucket(exporter_bucket)] \
+        == ['full']
+    assert ObjectVersion.get(exporter_bucket, 'full').file
+
+
+@pytest.mark.parametrize('job_id', ['records-delta', 'records-xml'])
+def test_sliced_exporter_not_supported(app, db, es, exporter_bucket, job_id):
+    """Test that jobs which do not support slices cannot be sliced."""
+    with patch.dict(app.config['EXPORTER_JOBS'][job_id], slices=4):
+        with pytest.raises(ValueError):
+            export_job(job_id=job_id)
+    assert ObjectVersion.get_by_bucket(exporter_bucket).count() == 0
+
+
+def test_fanout_exporter(app, db, es, exporter_bucket,
+                         record_with_files_creation):
+    """Test multi-format record exporter."""
+    pid, record, record_url = record_with_files_creation
+    RecordIndexer().index_by_id(record.id)
+    current_search.flush_and_refresh('records')
+
+    job = dict(app.config['EXPORTER_JOBS']['records-xml'])
+    assert job.pop('exporter_cls') is FanoutExporter
+    targets = [dict(t, writer=t['writer'].copy(t['name']))
+               for t in job.pop('targets')]
+
+    assert FanoutExporter(targets=targets, page_size=1, queue_size=1,
+                          **job).run()
+    for name in ('datacite', 'dcat'):
+        obj = ObjectVersion.get(exporter_bucket, name)
+        assert obj.file.size > 0
+        with obj.file.storage().open('rb') as fp:
+            root = etree.fromstring(bz2.decompress(fp.read()))
+        assert root.tag == 'resources'
+        assert len(root) == 1
@@ -27,10 +27,18 @@
 from __future__ import absolute_import, print_function
 
 import bz2
+import os
+import zlib
 
 import pytest
+from six import BytesIO
 
-from zenodo.modules.exporter import BZip2ResultStream, ResultStream
+from zenodo.modules.exporter import BZip2ResultStream, \
+    ColumnarResultStream, CompressedResultStream, ResultStream
+from zenodo.modules.exporter.errors import FailedExportJobError
+from zenodo.modules.exporter.streams import ConcatStream, FailedRecordIds, \
+    ProgressStream
+from zenodo.modules.exporter.utils import ExportProgress
 
 
 @pytest.fixture()
@@ -101,3 +109,154 @@ def test_resultstream(bzip2resultstream):
 
     assert bzip2resultstream.read() == data
     assert bzip2resultstream.read() == b''
+
+
+def test_concatstream():
+    """Test concatenation of compressed parts."""
+    parts = [bz2.compress(b'test 1\n'), bz2.compress(b'test 2\n')]
+    stream = ConcatStream(BytesIO(p) for p in parts)
+    data = b''
+    chunk = stream.read(4)
+    while chunk:
+        data += chunk
+        chunk = stream.read(4)
+    assert data == b''.join(parts)
+    assert stream.read() == b''
+
+
+def _bz2_decompress(data):
+    """Decompress multi-stream BZip2 data."""
+    out = b''
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out += decompressor.decompress(data)
+        data = decompressor.unused_data
+    return out
+
+
+@pytest.mark.parametrize('codec,options,decompress', [
+    ('bz2', {}, bz2.decompress),
+    ('gzip', {'level': 1}, lambda d: zlib.decompress(d, 16 + zlib.MAX_WBITS)),
+    ('pbz2', {'block_size': 4, 'threads': 2}, _bz2_decompress),
+])
+def test_compressedresultstream(searchobj, serializerobj, fetcher, codec,
+                                options, decompress):
+    """Test compressed result stream codecs."""
+    stream = CompressedResultStream(
+        searchobj, fetcher, serializerobj, codec=codec, **options)
+    data = b''
+    chunk = stream.read()
+    while chunk:
+        data += chunk
+        chunk = stream.read()
+    assert decompress(data) == b'test 1test 2'
+
+
+def test_unknown_codec(searchobj, serializerobj, fetcher):
+    """Test unknown compression codec."""
+    with pytest.raises(ValueError):
+        CompressedResultStream(
+            searchobj, fetcher, serializerobj, codec='unknown')
+
+
+def test_resultstream_header_footer(searchobj, serializerobj, fetcher):
+    """Test the header and footer of the serializer."""
+    serializerobj.export_header = b'<resources>'
+    serializerobj.export_footer = b'</resources>'
+    stream = ResultStream(searchobj, fetcher, serializerobj)
+    assert stream.read(100) == b'<resources>test 1test 2</resources>'
+    assert stream.count == 2
+
+
+def test_resultstream_read_size(searchobj, serializerobj, fetcher):
+    """Test buffered reads of a given size."""
+    stream = ResultStream(searchobj, fetcher, serializerobj)
+    assert stream.read(4) == b'test'
+    assert stream.read(4) == b' 1te'
+    assert stream.read(100) == b'st 2'
+    assert stream.read(100) == b''
+
+
+@pytest.mark.parametrize('format', ['parquet', 'arrow'])
+def test_columnarresultstream(searchobj, fetcher, format):
+    """Test Parquet and Arrow result streams."""
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+
+    class Serializer(object):
+        def arrow_schema(self):
+            return pyarrow.schema([pyarrow.field('title', pyarrow.string())])
+
+        def serialize_exporter(self, pid, record):
+            return dict(title=record['_source']['title'])
+
+    stream = ColumnarResultStream(
+        searchobj, fetcher, Serializer(), format=format, row_group_size=1)
+    data = b''
+    chunk = stream.read(16)
+    while chunk:
+        data += chunk
+        chunk = stream.read(16)
+
+    if format == 'parquet':
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(data))
+    else:
+        table = pyarrow.RecordBatchFileReader(
+            pyarrow.BufferReader(data)).read_all()
+    assert table.column('title').to_pylist() == ['test 1', 'test 2']
+
+
+def test_progressstream(app, resultstream):
+    """Test progress reporting of a result stream."""
+    reports = []
+    progress = ExportProgress(name='test', updater=reports.append,
+                              interval=0)
+    stream = ProgressStream(resultstream, progress)
+    with app.app_context():
+        assert stream.read(100) == b'test 1test 2'
+    assert progress.records == 2
+    assert progress.serialized_bytes == progress.output_bytes == 12
+    assert reports[-1]['records'] == 2
+    assert reports[-1]['compression_ratio'] == 1.0
+
+
+def test_failedrecordids():
+    """Test bounded list of failed record ids."""
+    failed = FailedRecordIds(max_size=2)
+    for i in range(5):
+        failed.append(str(i))
+    assert len(failed) == 5
+    assert failed.ids == ['0', '1']
+    assert list(failed) == ['0', '1', '2', '3', '4']
+    assert failed.path
+
+    msg = str(FailedExportJobError(record_ids=failed))
+    assert msg.startswith(
+        'Serialization failed for the following records: 0, 1 and 3 more')
+    assert failed.path in msg
+
+    # Closing the list removes the file, but keeps the first ids
+    path = failed.path
+    with failed:
+        pass
+    assert not os.path.exists(path)
+    assert failed.path is None
+    assert len(failed) == 5
+    assert failed.ids == ['0', '1']
+
+
+def test_resultstream_failed_record_ids(searchobj, fetcher):
+    """Test that the failed record ids of a result stream are released."""
+    class Serializer(object):
+        def serialize_exporter(self, pid, record):
+            raise Exception('failed')
+
+    stream = ResultStream(searchobj, fetcher, Serializer())
+    stream.failed_record_ids = FailedRecordIds(max_size=1)
+    stream.raise_on_failure = False
+    assert stream.read(100) == b''
+    path = stream.failed_record_ids.path
+    assert os.path.exists(path)
+    stream.close()
+    assert not os.path.exists(path)
+    assert len(stream.failed_record_ids) == 2
@@ -26,11 +26,14 @@
 
 from __future__ import absolute_import, print_function
 
+import os
+
 import pytest
 from invenio_files_rest.models import ObjectVersion
 from six import BytesIO
 
-from zenodo.modules.exporter import filename_factory
+from zenodo.modules.exporter import FilesystemWriter, MultipartWriter, \
+    filename_factory
 
 
 def test_filename_factory():
@@ -49,3 +52,56 @@ def test_bucket_writer(writer):
     writer.write(BytesIO(b'this is a test'))
     writer.close()
     assert ObjectVersion.get(writer.bucket_id, writer.key).file_id is not None
+
+
+def test_multipart_writer(app, exporter_bucket):
+    """Test multipart bucket writer."""
+    # Small objects are written in a single request
+    writer = MultipartWriter(bucket_id=exporter_bucket.id, key='small')
+    writer.open()
+    writer.write(BytesIO(b'this is a test'))
+    writer.close()
+    assert ObjectVersion.get(exporter_bucket.id, 'small').file.size == 14
+
+    data = os.urandom(1024) * (11 * 1024)
+    writer = writer.copy('large')
+    writer.part_size = 5 * 1024 * 1024
+    writer.open()
+    writer.write(BytesIO(data))
+    writer.close()
+    obj = ObjectVersion.get(exporter_bucket.id, 'large')
+    assert obj.file.size == len(data)
+    with obj.file.storage().open('rb') as fp:
+        assert fp.read() == data
+
+
+def test_filesystem_writer(tmpdir):
+    """Test filesystem writer."""
+    writer = FilesystemWriter(path=str(tmpdir), key='test.json')
+    writer.open()
+    assert tmpdir.listdir() != []
+    assert not tmpdir.join('test.json').exists()
+    writer.write(BytesIO(b'this is a test'))
+    writer.close()
+    assert tmpdir.join('test.json').read() == 'this is a test'
+    assert [f.basename for f in tmpdir.listdir()] == ['test.json']
+
+    # A failed write leaves no file behind
+    class FailingStream(object):
+        def read(self, size=-1):
+            raise IOError()
+
+    writer = writer.copy('failed.json')
+    writer.open()
+    pytest.raises(IOError, writer.write, FailingStream())
+    writer.close()
+    assert [f.basename for f in tmpdir.listdir()] == ['test.json']
+
+    # States
+    assert writer.load_state('state.json') is None
+    writer.save_state('state.json', {'key': 'test.json'})
+    assert writer.load_state('state.json') == {'key': 'test.json'}
+    assert writer.read_part('test.json').read() == b'this is a test'
+    writer.remove_part('test.json')
+    writer.remove_part('test.json')
+    assert [f.basename for f in tmpdir.listdir()] == ['state.json']
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Test the Zenodo records indexer."""
+
+from __future__ import absolute_import, print_function
+
+from helpers import publish_and_expunge
+from invenio_pidrelations.contrib.versioning import PIDVersioning
+from invenio_pidrelations.serializers.utils import serialize_relations
+from invenio_search import current_search, current_search_client
+from invenio_search.api import RecordsSearch
+from mock import patch
+from six import BytesIO, b
+
+from zenodo.modules.deposit.api import ZenodoDeposit
+from zenodo.modules.deposit.resolvers import deposit_resolver
+from zenodo.modules.records.api import ZenodoRecord
+from zenodo.modules.records.indexer import ZenodoRecordIndexer, \
+    _indexing_data, create_reindex_index, iter_record_ids, \
+    prefetch_indexing_data, swap_index_aliases, update_index_settings, \
+    uuid_ranges
+from zenodo.modules.records.tasks import reindex_records
+from zenodo.modules.records.utils import build_record_custom_fields
+
+
+def _assert_prefetched(records):
+    """Check the prefetched data against the per-record queries."""
+    data = prefetch_indexing_data(records)
+    assert len(data) == len(records)
+    for record in records:
+        assert data[str(record.id)] == _indexing_data(record)
+
+
+def test_prefetch_indexing_data(app, db, es, deposit, deposit_file):
+    """Test prefetching the data added by the indexer receiver."""
+    deposit_v1 = publish_and_expunge(db, deposit)
+    depid_v1_value = deposit_v1['_deposit']['id']
+    recid_v1, record_v1 = deposit_v1.fetch_published()
+    _assert_prefetched([record_v1])
+
+    # With a draft version
+    deposit_v1.newversion()
+    _assert_prefetched([record_v1])
+    pv = PIDVersioning(child=recid_v1)
+    depid_v2 = pv.draft_child_deposit
+    data = prefetch_indexing_data([record_v1])[str(record_v1.id)]
+    assert data['relations']['version'][0]['draft_child_deposit'] == {
+        'pid_type': 'depid', 'pid_value': depid_v2.pid_value}
+
+    deposit_v2 = ZenodoDeposit.get_record(depid_v2.get_assigned_object())
+    deposit_v2.files['file.txt'] = BytesIO(b('file1'))
+    deposit_v2 = publish_and_expunge(db, deposit_v2)
+    recid_v2, record_v2 = deposit_v2.fetch_published()
+    depid_v1, deposit_v1 = deposit_resolver.resolve(depid_v1_value)
+    recid_v1, record_v1 = deposit_v1.fetch_published()
+    _assert_prefetched([record_v1, record_v2])
+
+    data = prefetch_indexing_data([record_v1, record_v2])
+    assert [data[str(r.id)]['relations']['version'][0]['is_last']
+            for r in (record_v1, record_v2)] == [False, True]
+    assert data[str(record_v2.id)]['related_identifiers'] == [{
+        'scheme': 'doi',
+        'relation': 'isVersionOf',
+        'identifier': record_v2['conceptdoi'],
+    }]
+
+    # Records without a recid are ignored
+    assert prefetch_indexing_data([ZenodoRecord({})]) == {}
+
+
+def test_zenodo_record_indexer(app, db, es, deposit, deposit_file):
+    """Test bulk indexing with prefetched data."""
+    records_index_name = 'records-record-v1.0.0'
+    deposit_v1 = publish_and_expunge(db, deposit)
+    recid_v1, record_v1 = deposit_v1.fetch_published()
+    expected = _indexing_data(record_v1)
+
+    indexer = ZenodoRecordIndexer(prefetch_size=2)
+    indexer.bulk_index([str(record_v1.id)])
+    indexer.process_bulk_queue()
+    current_search.flush_and_refresh(index=records_index_name)
+    hits = RecordsSearch(index=records_index_name).execute()['hits']['hits']
+    assert len(hits) == 1
+    assert hits[0]['_source']['relations'] == expected['relations']
+    assert hits[0]['_source']['_stats'] == expected['stats']
+
+
+def test_zenodo_record_indexer_relations(app, db, es, deposit,
+                                        deposit_file):
+    """Test that bulk indexed relations are the serialized relations."""
+    records_index_name = 'records-record-v1.0.0'
+    deposit_v1 = publish_and_expunge(db, deposit)
+    depid_v1_value = deposit_v1['_deposit']['id']
+    recid_v1, record_v1 = deposit_v1.fetch_published()
+    deposit_v1.newversion()
+    pv = PIDVersioning(child=recid_v1)
+    depid_v2 = pv.draft_child_deposit
+    deposit_v2 = ZenodoDeposit.get_record(depid_v2.get_assigned_object())
+    deposit_v2.files['file.txt'] = BytesIO(b('file1'))
+    deposit_v2 = publish_and_expunge(db, deposit_v2)
+    recid_v2, record_v2 = deposit_v2.fetch_published()
+    # With a draft of a third version
+    deposit_v2.newversion()
+    db.session.commit()
+    depid_v1, deposit_v1 = deposit_resolver.resolve(depid_v1_value)
+    recid_v1, record_v1 = deposit_v1.fetch_published()
+
+    indexer = ZenodoRecordIndexer(prefetch_size=2)
+    indexer.bulk_index([str(record_v1.id), str(record_v2.id)])
+    indexer.process_bulk_queue()
+    current_search.flush_and_refresh(index=records_index_name)
+    hits = RecordsSearch(index=records_index_name).execute()['hits']['hits']
+    relations = dict((h['_id'], h['_source']['relations']) for h in hits)
+    assert relations == {
+        str(record_v1.id): serialize_relations(recid_v1),
+        str(record_v2.id): serialize_relations(recid_v2),
+    }
+    assert relations[str(record_v2.id)]['version'][0][
+        'draft_child_deposit'] is not None
+
+
+def test_uuid_ranges():
+    """Test splitting the UUID space in ranges."""
+    assert uuid_ranges(1) == [('00000000-0000-0000-0000-000000000000', None)]
+    assert uuid_ranges(4) == [
+        ('00000000-0000-0000-0000-000000000000',
+         '40000000-0000-0000-0000-000000000000'),
+        ('40000000-0000-0000-0000-000000000000',
+         '80000000-0000-0000-0000-000000000000'),
+        ('80000000-0000-0000-0000-000000000000',
+         'c0000000-0000-0000-0000-000000000000'),
+        ('c0000000-0000-0000-0000-000000000000', None),
+    ]
+
+
+def test_reindex_records(app, db, es, deposit, deposit_file):
+    """Test reindexing records in a new index."""
+    records_index_name = 'records-record-v1.0.0'
+    deposit_v1 = publish_and_expunge(db, deposit)
+    recid_v1, record_v1 = deposit_v1.fetch_published()
+
+    ids = [id_ for start, end in uuid_ranges(3)
+           for chunk in iter_record_ids(start, end, chunk_size=1)
+           for id_ in chunk]
+    assert sorted(ids) == sorted([str(record_v1.id), str(deposit_v1.id)])
+
+    new_index = create_reindex_index(records_index_name)
+    previous = update_index_settings(new_index, {'refresh_interval': '-1'})
+    results = [reindex_records(start, end, index=records_index_name,
+                               target=new_index, chunk_size=1)
+               for start, end in uuid_ranges(3)]
+    assert sum(r['indexed'] for r in results) == 1
+    assert sum(r['errors'] for r in results) == 0
+    update_index_settings(new_index, previous)
+    current_search_client.indices.refresh(index=new_index)
+
+    swap_index_aliases(records_index_name, new_index)
+    current_search.flush_and_refresh(index=records_index_name)
+    alias = current_search_client.indices.get_alias(
+        index=app.config['SEARCH_INDEX_PREFIX'] + records_index_name)
+    assert list(alias) == [new_index]
+    hits = RecordsSearch(index=records_index_name).execute()['hits']['hits']
+    assert [h['_id'] for h in hits] == [str(record_v1.id)]
+    assert hits[0]['_source']['relations'] == \
+        _indexing_data(record_v1)['relations']
+
+
+def test_reindex_records_failed_record(app, db, es, deposit, deposit_file):
+    """Test that the records failing to serialize are skipped."""
+    records_index_name = 'records-record-v1.0.0'
+    deposit_v1 = publish_and_expunge(db, deposit)
+    recid_v1, record_v1 = deposit_v1.fetch_published()
+    deposit_v1.newversion()
+    pv = PIDVersioning(child=recid_v1)
+    depid_v2 = pv.draft_child_deposit
+    deposit_v2 = ZenodoDeposit.get_record(depid_v2.get_assigned_object())
+    deposit_v2.files['file.txt'] = BytesIO(b('file1'))
+    deposit_v2 = publish_and_expunge(db, deposit_v2)
+    recid_v2, record_v2 = deposit_v2.fetch_published()
+
+    def _custom_fields(json):
+        if json['recid'] == record_v1['recid']:
+            raise ValueError('Invalid record')
+        return build_record_custom_fields(json)
+
+    new_index = create_reindex_index(records_index_name)
+    with patch('zenodo.modules.records.indexer.build_record_custom_fields',
+               side_effect=_custom_fields):
+        result = reindex_records(uuid_ranges(1)[0][0],
+                                 index=records_index_name, target=new_index)
+    assert result['indexed'] == 1
+    assert result['errors'] == 1
+    current_search_client.indices.refresh(index=new_index)
+    hits = current_search_client.search(index=new_index)['hits']['hits']
+    assert [h['_id'] for h in hits] == [str(record_v2.id)]
+    current_search_client.indices.delete(index=new_index)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Test the cache of the documents referenced by records."""
+
+from __future__ import absolute_import, print_function
+
+import copy
+
+from invenio_records.api import Record
+from mock import patch
+
+from zenodo.modules.records.refs import cached_ref_pid, prefetch_refs, \
+    refs_cache
+
+LICENSE_REF = 'https://dx.zenodo.org/licenses/CC0-1.0'
+GRANT_REFS = [
+    'http://dx.zenodo.org/grants/10.13039/501100000780::282896',
+    'http://dx.zenodo.org/grants/10.13039/501100000780::027819',
+]
+FUNDER_REF = 'https://dx.doi.org/10.13039/501100000780'
+
+
+def test_cached_ref_pid(app):
+    """Test getting the PID of a cached reference."""
+    assert cached_ref_pid(LICENSE_REF) == ('od_lic', 'CC0-1.0')
+    assert cached_ref_pid(GRANT_REFS[0]) == \
+        ('grant', '10.13039/501100000780::282896')
+    assert cached_ref_pid(FUNDER_REF) == ('frdoi', '10.13039/501100000780')
+    assert cached_ref_pid('https://zenodo.org/schemas/x.json') is None
+
+
+def test_refs_cache(app, db, minimal_record, grant_records, license_record):
+    """Test resolving references through the cache."""
+    minimal_record['license'] = {'$ref': LICENSE_REF}
+    minimal_record['grants'] = [{'$ref': ref} for ref in GRANT_REFS]
+    record = Record.create(minimal_record)
+    db.session.commit()
+    refs_cache.invalidate()
+    expected = copy.deepcopy(record.replace_refs())
+    assert all(ref in refs_cache for ref in GRANT_REFS + [LICENSE_REF])
+
+    refs_cache.invalidate()
+    prefetch_refs([record])
+    assert len(refs_cache) == 4
+    assert FUNDER_REF in refs_cache
+    assert copy.deepcopy(record.replace_refs()) == expected
+
+    # Updating a license invalidates the cache
+    license = Record.get_record(license_record.id)
+    license['title'] = 'New title'
+    license.commit()
+    db.session.commit()
+    assert len(refs_cache) == 0
+    assert record.replace_refs()['license']['title'] == 'New title'
+
+    # Documents cached before the update is committed are discarded
+    license['title'] = 'Newer title'
+    license.commit()
+    prefetch_refs([record])
+    assert LICENSE_REF in refs_cache
+    db.session.commit()
+    assert len(refs_cache) == 0
+    assert record.replace_refs()['license']['title'] == 'Newer title'
+
+    # Changing the resolved documents doesn't change the cached ones
+    prefetch_refs([record])
+    record.replace_refs()['license']['title'] = 'Changed'
+    assert refs_cache.get(LICENSE_REF)['title'] == 'Newer title'
+    assert record.replace_refs()['license']['title'] == 'Newer title'
+
+    # Many changes in a transaction invalidate the cache once, and once more
+    # after the commit
+    with patch.object(refs_cache, 'invalidate') as invalidate:
+        for title in ('A', 'B', 'C'):
+            license['title'] = title
+            license.commit()
+        assert invalidate.call_count == 1
+        db.session.commit()
+        assert invalidate.call_count == 2
+    refs_cache.invalidate()
+
+    # The least recently used documents are evicted
+    app.config['ZENODO_RECORDS_REFS_CACHE_SIZE'] = 2
+    try:
+        refs_cache.invalidate()
+        prefetch_refs([record])
+        assert len(refs_cache) == 2
+    finally:
+        app.config['ZENODO_RECORDS_REFS_CACHE_SIZE'] = 20000
@@ -22,6 +22,7 @@
 from __future__ import absolute_import, print_function
 
 from helpers import publish_and_expunge
+from invenio_cache import current_cache
 from invenio_pidrelations.contrib.versioning import PIDVersioning
 from invenio_pidrelations.serializers.utils import serialize_relations
 from invenio_pidstore.models import PersistentIdentifier
@@ -30,6 +31,7 @@ from six import BytesIO, b
 from zenodo.modules.deposit.api import ZenodoDeposit
 from zenodo.modules.deposit.resolvers import deposit_resolver
 from zenodo.modules.records.serializers.pidrelations import \
+    get_versions_identifiers, invalidate_versions_identifiers, \
     serialize_related_identifiers
 
 
@@ -208,3 +210,38 @@ def test_related_identifiers_serialization(app, db, deposit, deposit_file):
         }
     ]
     assert rids == expected_parent
+
+
+def test_versions_identifiers(app, db, deposit, deposit_file):
+    """Test the cached identifiers of the versions of a concept."""
+    invalidate_versions_identifiers('1')
+    deposit_v1 = publish_and_expunge(db, deposit)
+    recid_v1, record_v1 = deposit_v1.fetch_published()
+    assert current_cache.get('record_versions:1') is None
+
+    v1 = ['2', '10.5072/zenodo.2', '10.5072/zenodo.1']
+    assert get_versions_identifiers('1') == [v1]
+    assert current_cache.get('record_versions:1') == [v1]
+
+    # Publishing a new version invalidates the cached identifiers
+    deposit_v1.newversion()
+    pv = PIDVersioning(child=recid_v1)
+    depid_v2 = pv.draft_child_deposit
+    deposit_v2 = ZenodoDeposit.get_record(depid_v2.get_assigned_object())
+    deposit_v2.files['file.txt'] = BytesIO(b('file1'))
+    deposit_v2 = publish_and_expunge(db, deposit_v2)
+    assert current_cache.get('record_versions:1') is None
+    assert get_versions_identifiers('1') == [
+        v1, ['3', '10.5072/zenodo.3', '10.5072/zenodo.1']]
+
+    # Identifiers cached before the transaction is committed are removed
+    invalidate_versions_identifiers('1')
+    assert get_versions_identifiers('1')
+    assert current_cache.get('record_versions:1') is not None
+    db.session.commit()
+    assert current_cache.get('record_versions:1') is None
+
+    # Versions are not loaded for non-versioned recids
+    assert get_versions_identifiers('2') == []
+    assert current_cache.get('record_versions:2') is None
+    invalidate_versions_identifiers('1')
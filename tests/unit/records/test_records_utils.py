@@ -26,8 +26,12 @@
 
 from __future__ import absolute_import, print_function
 
+import copy
+
+from invenio_records.api import Record
+
 from zenodo.modules.records.utils import build_record_custom_fields, \
-    is_valid_openaire_type
+    is_valid_openaire_type, resolve_record_refs
 
 
 def test_openaire_type_validation(app):
@@ -96,3 +100,26 @@ def test_build_record_custom_fields(app, full_record, custom_metadata):
             (v['key'], tuple(v['subject']), tuple(v['object']))
             for v in result['custom_relationships']},
     }
+
+
+def test_resolve_record_refs(app, db, minimal_record, grant_records,
+                             license_record):
+    """Test resolving the references of a record."""
+    minimal_record['license'] = {
+        '$ref': 'https://dx.zenodo.org/licenses/CC-BY-4.0'}
+    minimal_record['grants'] = [
+        {'$ref': 'http://dx.zenodo.org/grants/10.13039/501100000780::282896'},
+        {'$ref': 'http://dx.zenodo.org/grants/10.13039/501100000780::027819'},
+    ]
+    record = Record.create(minimal_record)
+
+    resolved = resolve_record_refs(record)
+    assert resolved == copy.deepcopy(record.replace_refs())
+    assert resolved['license']['id'] == 'CC-BY-4.0'
+    assert [g['funder']['name'] for g in resolved['grants']] == \
+        ['European Commission'] * 2
+    # The record itself is not modified
+    assert record['license'] == {
+        '$ref': 'https://dx.zenodo.org/licenses/CC-BY-4.0'}
+    resolved['grants'][0]['code'] = 'modified'
+    assert resolve_record_refs(record)['grants'][0]['code'] == '282896'
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Unit test for Zenodo columnar serializer."""
+
+from __future__ import absolute_import, print_function
+
+from zenodo.modules.records.serializers.columnar import \
+    ZenodoColumnarSerializer
+
+
+def test_flatten():
+    """Test flattening of a serialized record into a row."""
+    row = ZenodoColumnarSerializer.flatten({
+        'id': 123,
+        'conceptrecid': '122',
+        'doi': '10.5281/zenodo.123',
+        'metadata': {
+            'title': 'Test',
+            'resource_type': {'type': 'publication', 'subtype': 'article'},
+            'access_right': 'open',
+            'communities': [{'id': 'zenodo'}, {'id': 'ecfunded'}],
+            'creators': [{'name': 'Doe, John'}, {'name': 'Smith, Jane'}],
+            'publication_date': '2019-01-01',
+        },
+        'files': [{'size': 10}, {'size': 32}],
+    })
+    assert row == dict(
+        recid=123,
+        conceptrecid='122',
+        doi='10.5281/zenodo.123',
+        conceptdoi=None,
+        title='Test',
+        resource_type='publication/article',
+        access_right='open',
+        communities=['zenodo', 'ecfunded'],
+        creators=['Doe, John', 'Smith, Jane'],
+        publication_date='2019-01-01',
+        file_count=2,
+        file_size=42,
+    )
+    assert set(row) == set(n for n, _ in ZenodoColumnarSerializer.columns)
+
+
+def test_flatten_without_files():
+    """Test flattening of a record without files."""
+    row = ZenodoColumnarSerializer.flatten(
+        {'id': 1, 'metadata': {'resource_type': {'type': 'dataset'}}})
+    assert row['resource_type'] == 'dataset'
+    assert row['file_count'] == 0
+    assert row['file_size'] == 0
+    assert row['communities'] == []
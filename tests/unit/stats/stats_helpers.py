@@ -39,12 +39,13 @@ from invenio_records_files.models import RecordsBuckets
 from invenio_records_ui.signals import record_viewed
 from invenio_search import current_search
 from invenio_stats import current_stats
-from invenio_stats.tasks import aggregate_events, process_events
+from invenio_stats.tasks import process_events
 from mock import patch
 from six import BytesIO
 
 from zenodo.modules.records.api import ZenodoRecord
-from zenodo.modules.stats.tasks import update_record_statistics
+from zenodo.modules.stats.tasks import aggregate_events, \
+    update_record_statistics
 
 
 def mock_date(*date_parts):
@@ -164,8 +165,9 @@ def create_stats_fixtures(metadata, n_records, n_versions, n_files,
         current_search.flush_and_refresh(index='events-stats-*')
 
     if do_aggregate_events:
-        with patch('invenio_stats.aggregations.datetime',
-                   mock_date(*end_date.timetuple()[:3])):
+        current_date = mock_date(*end_date.timetuple()[:3])
+        with patch('invenio_stats.aggregations.datetime', current_date), \
+                patch('zenodo.modules.stats.tasks.datetime', current_date):
             aggregate_events(
                 ['record-view-agg', 'record-view-all-versions-agg',
                  'record-download-agg', 'record-download-all-versions-agg'])
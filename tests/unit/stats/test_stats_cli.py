@@ -26,7 +26,7 @@ from click.testing import CliRunner
 from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_records.api import Record
 
-from zenodo.modules.stats.cli import import_events
+from zenodo.modules.stats.cli import import_events, import_events_file
 
 
 def test_record_view_import(app, db, es, event_queues, full_record,
@@ -50,6 +50,8 @@ def test_record_view_import(app, db, es, event_queues, full_record,
     res = runner.invoke(
         import_events, ['record-view', csv_file.dirname], obj=script_info)
     assert res.exit_code == 0
+    assert 'Imported 1 events (0 skipped) from 1 files' in res.output
+    assert 'events/sec).' in res.output
     events = list(event_queues['stats-record-view'].consume())
     assert len(events) == 1
     assert events[0] == {
@@ -70,3 +72,27 @@ def test_record_view_import(app, db, es, event_queues, full_record,
         'user_agent': 'foo',
         'user_id': None,
     }
+
+
+def test_import_events_file(app, db, es, event_queues, full_record, tmpdir):
+    """Test import of a CSV file with records resolved in bulk."""
+    r = Record.create(full_record)
+    PersistentIdentifier.create(
+        'recid', '12345', object_type='rec', object_uuid=r.id,
+        status=PIDStatus.REGISTERED)
+    db.session.commit()
+
+    csv_file = tmpdir.join('record-views.csv')
+    csv_file.write(
+        ',userAgent,ipAddress,url,serverTimePretty,timestamp,referrer\n'
+        ',foo,137.138.36.206,https://zenodo.org/record/12345,,1367928000,\n'
+        ',foo,137.138.36.206,https://zenodo.org/record/12345,,1367928001,\n'
+        ',foo,137.138.36.206,https://zenodo.org/record/999,,1367928002,\n'
+        ',foo,137.138.36.206,https://example.org/record/1,,1367928003,\n')
+
+    assert import_events_file(
+        str(csv_file), 'record-view', chunk_size=1) == (2, 2)
+    events = list(event_queues['stats-record-view'].consume())
+    assert [e['timestamp'] for e in events] == [
+        '2013-05-07T12:00:00', '2013-05-07T12:00:01']
+    assert all(e['record_id'] == str(r.id) for e in events)
@@ -21,15 +21,29 @@
 # or submit itself to any jurisdiction.
 
 """Unit tests for statistics exporters."""
+import time
 from datetime import datetime, timedelta
 
 import pytest
+from click.testing import CliRunner
+from elasticsearch_dsl.utils import AttrDict
 from invenio_cache import current_cache
 from mock import mock
+from six.moves.urllib.parse import parse_qsl
 from stats_helpers import create_stats_fixtures
 
+from zenodo.modules.stats.bookmarks import BookmarkStore
+from zenodo.modules.stats.cli import piwik_bookmark, piwik_replay
 from zenodo.modules.stats.exporters import PiwikExporter, \
-    PiwikExportRequestError
+    PiwikExportRequestError, build_query_strings
+from zenodo.modules.stats.lookup import RecordEntry
+from zenodo.modules.stats.models import StatsExporterBookmark
+
+
+def reset_bookmark():
+    """Remove the Piwik exporter bookmark."""
+    current_cache.delete('piwik_export:bookmark')
+    BookmarkStore().delete(PiwikExporter.bookmark_name)
 
 
 class MockResponse:
@@ -56,7 +70,7 @@ def mocked_requests_fail(*args, **kwargs):
     return MockResponse({}, 500)
 
 
-@mock.patch('zenodo.modules.stats.exporters.requests.post',
+@mock.patch('zenodo.modules.stats.exporters.requests.Session.post',
             side_effect=mocked_requests_success)
 def test_piwik_exporter(app, db, es, locations, event_queues, full_record):
     records = create_stats_fixtures(
@@ -71,22 +85,22 @@ def test_piwik_exporter(app, db, es, locations, event_queues, full_record):
         do_update_record_statistics=False
     )
 
-    current_cache.delete('piwik_export:bookmark')
-    bookmark = current_cache.get('piwik_export:bookmark')
+    reset_bookmark()
+    bookmark = PiwikExporter().bookmark
     assert bookmark is None
 
     start_date = datetime(2018, 1, 1, 12)
     end_date = datetime(2018, 1, 1, 14)
     PiwikExporter().run(start_date=start_date, end_date=end_date)
-    bookmark = current_cache.get('piwik_export:bookmark')
+    bookmark = PiwikExporter().bookmark
     assert bookmark == u'2018-01-01T14:00:00'
 
     PiwikExporter().run()
-    bookmark = current_cache.get('piwik_export:bookmark')
+    bookmark = PiwikExporter().bookmark
     assert bookmark == u'2018-01-01T14:30:00'
 
 
-@mock.patch('zenodo.modules.stats.exporters.requests.post',
+@mock.patch('zenodo.modules.stats.exporters.requests.Session.post',
             side_effect=mocked_requests_invalid)
 def test_piwik_exporter_invalid_request(app, db, es, locations, event_queues,
                                         full_record):
@@ -99,19 +113,19 @@ def test_piwik_exporter_invalid_request(app, db, es, locations, event_queues,
         interval=timedelta(minutes=30),
         do_process_events=True)
 
-    current_cache.delete('piwik_export:bookmark')
-    bookmark = current_cache.get('piwik_export:bookmark')
+    reset_bookmark()
+    bookmark = PiwikExporter().bookmark
     assert bookmark is None
 
     start_date = datetime(2018, 1, 1, 12)
     end_date = datetime(2018, 1, 1, 14)
 
     PiwikExporter().run(start_date=start_date, end_date=end_date)
-    bookmark = current_cache.get('piwik_export:bookmark')
+    bookmark = PiwikExporter().bookmark
     assert bookmark is None
 
 
-@mock.patch('zenodo.modules.stats.exporters.requests.post',
+@mock.patch('zenodo.modules.stats.exporters.requests.Session.post',
             side_effect=mocked_requests_fail)
 def test_piwik_exporter_request_fail(app, db, es, locations, event_queues,
                                      full_record):
@@ -124,8 +138,8 @@ def test_piwik_exporter_request_fail(app, db, es, locations, event_queues,
         interval=timedelta(minutes=30),
         do_process_events=True)
 
-    current_cache.delete('piwik_export:bookmark')
-    bookmark = current_cache.get('piwik_export:bookmark')
+    reset_bookmark()
+    bookmark = PiwikExporter().bookmark
     assert bookmark is None
 
     start_date = datetime(2018, 1, 1, 12)
@@ -133,7 +147,7 @@ def test_piwik_exporter_request_fail(app, db, es, locations, event_queues,
 
     with pytest.raises(PiwikExportRequestError):
         PiwikExporter().run(start_date=start_date, end_date=end_date)
-    bookmark = current_cache.get('piwik_export:bookmark')
+    bookmark = PiwikExporter().bookmark
     assert bookmark is None
 
 
@@ -148,12 +162,154 @@ def test_piwik_exporter_no_bookmark(app, db, es, locations, event_queues,
         interval=timedelta(minutes=30),
         do_process_events=True)
 
-    current_cache.delete('piwik_export:bookmark')
-    bookmark = current_cache.get('piwik_export:bookmark')
+    reset_bookmark()
+    bookmark = PiwikExporter().bookmark
     assert bookmark is None
 
-    with mock.patch('zenodo.modules.stats.exporters.requests.post') as mocked:
+    with mock.patch(
+            'zenodo.modules.stats.exporters.requests.Session.post') as mocked:
         PiwikExporter().run()
         mocked.assert_not_called()
-    bookmark = current_cache.get('piwik_export:bookmark')
+    bookmark = PiwikExporter().bookmark
     assert bookmark is None
+
+
+def test_piwik_exporter_pipelined(app, db, es, locations, event_queues,
+                                  full_record):
+    records = create_stats_fixtures(
+        metadata=full_record, n_records=1, n_versions=1, n_files=1,
+        event_data={'user_id': '1', 'country': 'CH'},
+        # 4 event timestamps
+        start_date=datetime(2018, 1, 1, 13),
+        end_date=datetime(2018, 1, 1, 15),
+        interval=timedelta(minutes=30),
+        do_process_events=True)
+
+    def mocked_post(url, json=None, **kwargs):
+        # Earlier chunks complete last
+        requests = ''.join(json['requests'])
+        time.sleep(0.3 if 'T13%3A00' in requests else 0)
+        if 'T13%3A30' in requests:
+            return MockResponse({}, 500)
+        return MockResponse({'status': 'success', 'invalid': 0}, 200)
+
+    start_date = datetime(2018, 1, 1, 12)
+    end_date = datetime(2018, 1, 1, 15)
+    config = {'chunk_size': 2, 'workers': 4}
+    reset_bookmark()
+    with mock.patch.dict(app.config['ZENODO_STATS_PIWIK_EXPORTER'], config):
+        with mock.patch(
+                'zenodo.modules.stats.exporters.requests.Session.post',
+                side_effect=mocked_post) as mocked:
+            with mock.patch.object(app.logger, 'warning') as warning:
+                with pytest.raises(PiwikExportRequestError):
+                    PiwikExporter().run(
+                        start_date=start_date, end_date=end_date)
+            assert mocked.call_count == 4
+    # The bookmark is not moved past the failed chunk
+    bookmark = PiwikExporter().bookmark
+    assert bookmark == u'2018-01-01T13:00:00'
+    # The chunks sent after the failed one are logged, as they are sent again
+    assert warning.call_count == 1
+    sent = warning.call_args[1]['extra']['sent_chunks']
+    assert [c['begin_event_timestamp'] for c in sent] == [
+        u'2018-01-01T14:00:00', u'2018-01-01T14:30:00']
+
+
+def test_bookmark_store(app, db):
+    """Test keeping the exporters' bookmarks in the database."""
+    store = BookmarkStore()
+    assert store.get('test') is None
+    store.set('test', u'2018-01-01T13:00:00')
+    assert store.get('test') == u'2018-01-01T13:00:00'
+    store.set('test', datetime(2018, 1, 1, 14))
+    assert store.get('test') == u'2018-01-01T14:00:00'
+    assert StatsExporterBookmark.query.count() == 1
+    store.delete('test')
+    assert store.get('test') is None
+
+
+def test_piwik_exporter_bookmarks(app, db, es, locations, event_queues,
+                                  full_record, script_info):
+    records = create_stats_fixtures(
+        metadata=full_record, n_records=1, n_versions=1, n_files=1,
+        event_data={'user_id': '1', 'country': 'CH'},
+        # 4 event timestamps
+        start_date=datetime(2018, 1, 1, 13),
+        end_date=datetime(2018, 1, 1, 15),
+        interval=timedelta(minutes=30),
+        do_process_events=True)
+
+    # Bookmarks kept in the cache are still used
+    reset_bookmark()
+    current_cache.set('piwik_export:bookmark', u'2018-01-01T14:00:00')
+    assert PiwikExporter().bookmark == u'2018-01-01T14:00:00'
+    with mock.patch('zenodo.modules.stats.exporters.requests.Session.post',
+                    side_effect=mocked_requests_success):
+        PiwikExporter().run()
+    assert BookmarkStore().get('piwik') == u'2018-01-01T14:30:00'
+    current_cache.delete('piwik_export:bookmark')
+    assert PiwikExporter().bookmark == u'2018-01-01T14:30:00'
+
+    runner = CliRunner()
+    res = runner.invoke(piwik_bookmark, [], obj=script_info)
+    assert res.exit_code == 0
+    assert '2018-01-01T14:30:00' in res.output
+
+    # Replays don't move the bookmark
+    with mock.patch('zenodo.modules.stats.exporters.requests.Session.post',
+                    side_effect=mocked_requests_success) as mocked:
+        res = runner.invoke(
+            piwik_replay, ['2018-01-01T12:00:00', '2018-01-01T14:00:00'],
+            obj=script_info)
+        assert res.exit_code == 0
+        assert mocked.called
+    assert PiwikExporter().bookmark == u'2018-01-01T14:30:00'
+
+    res = runner.invoke(
+        piwik_bookmark, ['--set', '2018-01-01T13:00:00'], obj=script_info)
+    assert res.exit_code == 0
+    assert PiwikExporter().bookmark == u'2018-01-01T13:00:00'
+    reset_bookmark()
+
+
+def test_build_query_strings(app):
+    lookup = {
+        '1': RecordEntry('a', {
+            'recid': 1, 'title': u'R\xe9cord ' * 30,
+            '_oai': {'id': 'oai:zenodo.org:1'}}),
+        '2': None,
+    }
+    events = [
+        AttrDict(dict(recid='1', visitor_id='v' * 20, referrer=None,
+                      timestamp='2018-01-01T13:00:00', country='CH')),
+        AttrDict(dict(recid='2', visitor_id='v' * 20,
+                      timestamp='2018-01-01T13:00:00')),
+        AttrDict(dict(recid='1', visitor_id='w' * 16,
+                      timestamp='2018-01-01T14:00:00', file_key='a b.txt',
+                      referrer='https://example.org')),
+        AttrDict(dict(timestamp='2018-01-01T14:00:00')),
+    ]
+    query_strings = build_query_strings(events, lookup, id_site=1)
+    assert len(query_strings) == 2
+
+    params = [dict(parse_qsl(qs[1:])) for qs in query_strings]
+    action_name = params[0].pop('action_name')
+    if isinstance(action_name, bytes):
+        action_name = action_name.decode('utf-8')
+    siteurl = app.config['THEME_SITEURL']
+    assert params[0] == {
+        'idsite': '1',
+        'rec': '1',
+        'url': siteurl + '/record/1',
+        '_id': 'v' * 16,
+        'cid': 'v' * 16,
+        'cvar': '{"1": ["oaipmhID", "oai:zenodo.org:1"]}',
+        'cdt': '2018-01-01T13:00:00',
+        'country': 'ch',
+    }
+    assert action_name == (u'R\xe9cord ' * 30)[:150]
+    assert params[1]['url'] == siteurl + '/record/1/files/a b.txt'
+    assert params[1]['download'] == params[1]['url']
+    assert params[1]['urlref'] == 'https://example.org'
+    assert 'country' not in params[1]
@@ -24,14 +24,21 @@
 
 from datetime import datetime, timedelta
 
+from elasticsearch_dsl import Search
 from flask import url_for
 from invenio_indexer.api import RecordIndexer
 from invenio_search import current_search
+from invenio_search.utils import build_alias_name
+from invenio_stats import current_stats
 from invenio_stats.tasks import aggregate_events, process_events
-from stats_helpers import create_stats_fixtures
+from mock import patch
+from stats_helpers import create_stats_fixtures, mock_date
 
+from zenodo.modules.stats import tasks
 from zenodo.modules.stats.tasks import update_record_statistics
-from zenodo.modules.stats.utils import get_record_stats
+from zenodo.modules.stats.utils import build_record_stats, \
+    build_records_stats, get_conceptrecids_children, get_record_stats, \
+    index_records_stats
 
 
 def test_update_record_statistics(app, db, es, locations, event_queues,
@@ -110,3 +117,118 @@ def test_update_record_statistics(app, db, es, locations, event_queues,
     for recid, _, _ in records[1:]:
         stats = get_record_stats(recid.object_uuid)
         assert stats == expected_stats
+
+
+def test_get_conceptrecids_children(app, db, es, locations, event_queues,
+                                    minimal_record):
+    """Test batched resolution of the versions of conceptrecids."""
+    records = create_stats_fixtures(
+        metadata=minimal_record, n_records=3, n_versions=2, n_files=1,
+        event_data={'user_id': '1'},
+        start_date=datetime(2018, 1, 1, 13),
+        end_date=datetime(2018, 1, 1, 14),
+        interval=timedelta(minutes=30),
+        do_process_events=False, do_aggregate_events=False,
+        do_update_record_statistics=False)
+
+    conceptrecids = {r['conceptrecid'] for _, r, _ in records}
+    assert len(conceptrecids) == 3
+    batches = list(get_conceptrecids_children(conceptrecids, batch_size=2))
+    assert [len(b) for b in batches] == [4, 2]
+    assert {i for b in batches for i in b} == {
+        (str(recid.object_uuid), str(recid.pid_value), r['conceptrecid'])
+        for recid, r, _ in records}
+
+
+def test_build_records_stats(app, db, es, locations, event_queues,
+                             minimal_record):
+    """Test batched building of records statistics."""
+    records = create_stats_fixtures(
+        metadata=minimal_record, n_records=2, n_versions=2, n_files=1,
+        event_data={'user_id': '1'},
+        start_date=datetime(2018, 1, 1, 13),
+        end_date=datetime(2018, 1, 1, 15),
+        interval=timedelta(minutes=30),
+        do_update_record_statistics=False)
+
+    params = [(r['recid'], r['conceptrecid']) for _, r, _ in records]
+    stats = build_records_stats(params, chunk_size=3)
+    assert set(stats) == {recid for recid, _ in params}
+    for recid, conceptrecid in params:
+        assert stats[recid] == build_record_stats(recid, conceptrecid)
+        assert stats[recid]['views'] == 4.0
+        assert stats[recid]['version_views'] == 8.0
+    # The all-versions statistics are skipped without a conceptrecid
+    assert 'version_views' not in build_records_stats([(-1, None)])[-1]
+
+
+def test_index_records_stats(app, db, es, locations, event_queues,
+                             minimal_record):
+    """Test that documents rewritten by the indexer are not overwritten."""
+    records = create_stats_fixtures(
+        metadata=minimal_record, n_records=2, n_versions=1, n_files=1,
+        event_data={'user_id': '1'},
+        start_date=datetime(2018, 1, 1, 13),
+        end_date=datetime(2018, 1, 1, 14),
+        interval=timedelta(minutes=30),
+        do_aggregate_events=True, do_update_record_statistics=True)
+    (recid_1, record_1, _), (recid_2, record_2, _) = records
+    expected = get_record_stats(record_1.id)
+    params = [(str(r.id), r['recid'], r['conceptrecid'])
+              for r in (record_1, record_2)]
+
+    def _build_records_stats(*args, **kwargs):
+        # The first record is reindexed while the statistics are built
+        RecordIndexer().index(record_1)
+        stats = build_records_stats(*args, **kwargs)
+        for recid in stats:
+            stats[recid]['views'] = 100.0
+        return stats
+
+    with patch('zenodo.modules.stats.utils.build_records_stats',
+               side_effect=_build_records_stats):
+        assert index_records_stats(params) == []
+    current_search.flush_and_refresh(index='records')
+    assert get_record_stats(record_1.id) == expected
+    assert get_record_stats(record_2.id)['views'] == 100.0
+
+
+def test_aggregate_events(app, db, es, locations, event_queues,
+                          minimal_record):
+    """Test the aggregation of events in parallel windows."""
+    create_stats_fixtures(
+        metadata=minimal_record, n_records=2, n_versions=1, n_files=1,
+        event_data={'user_id': '1'},
+        start_date=datetime(2018, 1, 1, 13),
+        end_date=datetime(2018, 1, 4, 13),
+        interval=timedelta(hours=12),
+        do_aggregate_events=False, do_update_record_statistics=False)
+
+    current_date = mock_date(2018, 1, 5)
+    with patch('invenio_stats.aggregations.datetime', current_date), \
+            patch('zenodo.modules.stats.tasks.datetime', current_date):
+        # One window per day, from the first event to the current date
+        tasks.aggregate_events(['record-view-agg'], batch_size=1)
+    current_search.flush_and_refresh(index='stats-*')
+
+    events = Search(
+        using=es, index=build_alias_name('events-stats-record-view'))
+    aggs = Search(using=es, index=build_alias_name('stats-record-view'))
+    # 2 records * 4 days
+    assert aggs.count() == 8
+    assert sum(agg.count for agg in aggs.scan()) == events.count()
+    bookmark = tasks._aggregator('record-view-agg').bookmark_api
+    assert bookmark.get_bookmark() == datetime(2018, 1, 5)
+
+
+def test_aggregator_batch_size(app, es):
+    """Test that the batch size is not passed to the aggregators."""
+    params = current_stats.aggregations['record-view-agg'].params
+    with patch.dict(params, {'batch_size': 2}):
+        aggr = tasks._aggregator('record-view-agg')
+        assert aggr.interval == 'day'
+        assert not hasattr(aggr, 'batch_size')
+        assert tasks._batch_size('record-view-agg') == 2
+        assert tasks._batch_size('record-view-agg', 3) == 3
+    assert tasks._batch_size('record-view-agg') == \
+        app.config['ZENODO_STATS_AGGREGATION_BATCH_SIZE']
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Unit tests for statistics utilities."""
+
+from __future__ import absolute_import, print_function
+
+import uuid
+from datetime import datetime, timedelta
+
+from invenio_cache import current_cache
+from mock import patch
+from stats_helpers import create_stats_fixtures
+
+from zenodo.modules.stats.utils import aggregation_windows, \
+    get_cached_record_stats, invalidate_record_stats
+
+
+def test_cached_record_stats(app):
+    """Test cached record statistics."""
+    record_id = uuid.uuid4()
+    with patch('zenodo.modules.stats.utils.get_record_stats',
+               return_value={'views': 1.0}) as get_record_stats:
+        assert get_cached_record_stats(record_id) == {'views': 1.0}
+        assert get_cached_record_stats(record_id) == {'views': 1.0}
+        assert get_record_stats.call_count == 1
+
+        get_record_stats.return_value = {'views': 2.0}
+        invalidate_record_stats([record_id])
+        assert get_cached_record_stats(record_id) == {'views': 2.0}
+        assert get_record_stats.call_count == 2
+
+    # A concurrent fetch of the same record's statistics is waited for
+    other_id = uuid.uuid4()
+    current_cache.add('record_stats:{0}:lock'.format(other_id), True)
+    current_cache.set('record_stats:{0}'.format(other_id), {'views': 3.0})
+    with patch('zenodo.modules.stats.utils.get_record_stats') as \
+            get_record_stats:
+        assert get_cached_record_stats(other_id) == {'views': 3.0}
+        assert not get_record_stats.called
+
+    # Records without statistics are cached as an empty dictionary
+    with patch('zenodo.modules.stats.utils.get_record_stats',
+               return_value=None):
+        assert get_cached_record_stats(uuid.uuid4()) == {}
+
+    # Failures are not cached
+    failed_id = uuid.uuid4()
+    with patch('zenodo.modules.stats.utils.get_record_stats',
+               side_effect=Exception('Unavailable')):
+        assert get_cached_record_stats(failed_id) == {}
+    assert current_cache.get('record_stats:{0}'.format(failed_id)) is None
+    assert current_cache.get('record_stats:{0}:lock'.format(failed_id)) \
+        is None
+
+    # Requests waiting for a dead fetch fetch the statistics directly
+    with patch('zenodo.modules.stats.utils.get_record_stats',
+               return_value={'views': 4.0}):
+        current_cache.add('record_stats:{0}:lock'.format(failed_id), True)
+        assert get_cached_record_stats(failed_id) == {'views': 4.0}
+    current_cache.delete('record_stats:{0}:lock'.format(failed_id))
+    invalidate_record_stats([record_id, other_id])
+
+
+def test_record_lookup(app, db, es, locations, event_queues, minimal_record,
+                       record_lookup):
+    """Test record lookup."""
+    records = create_stats_fixtures(
+        metadata=minimal_record, n_records=1, n_versions=2, n_files=2,
+        event_data={'user_id': '1'},
+        start_date=datetime(2018, 1, 1, 13),
+        end_date=datetime(2018, 1, 1, 14),
+        interval=timedelta(minutes=30),
+        do_process_events=False, do_aggregate_events=False,
+        do_update_record_statistics=False)
+    (recid_v1, record_v1, files_v1), (recid_v2, _, _) = records
+
+    record_lookup.warm_up([recid_v1.pid_value, recid_v2.pid_value, '999'])
+    assert len(record_lookup) == 3
+    assert record_lookup.get('999') is None
+
+    entry = record_lookup.get(recid_v1.pid_value)
+    assert entry.record_id == str(record_v1.id)
+    assert entry.event_metadata()['conceptrecid'] == \
+        record_v1['conceptrecid']
+    assert sorted(entry.files) == sorted(f.key for f in files_v1)
+    f = record_lookup.get_file(recid_v1.pid_value, files_v1[0].key)
+    assert (f.file_id, f.size) == (str(files_v1[0].file_id), 10)
+    assert record_lookup.get_file(recid_v1.pid_value, 'missing') is None
+
+    # The least recently used entries are evicted
+    record_lookup.max_size = 2
+    record_lookup.get('999')
+    record_lookup.warm_up(['1000'])
+    assert recid_v1.pid_value not in record_lookup
+    assert recid_v2.pid_value not in record_lookup
+    assert '999' in record_lookup
+
+
+def test_aggregation_windows():
+    windows = aggregation_windows(
+        datetime(2018, 1, 1, 13), datetime(2018, 1, 8, 10), 'day', 3)
+    assert windows == [
+        (datetime(2018, 1, 1), datetime(2018, 1, 3)),
+        (datetime(2018, 1, 4), datetime(2018, 1, 6)),
+        (datetime(2018, 1, 7), datetime(2018, 1, 8, 10)),
+    ]
+    assert aggregation_windows(
+        datetime(2018, 1, 1, 13), datetime(2018, 1, 1), 'day', 3) == [
+        (datetime(2018, 1, 1), datetime(2018, 1, 1))]
+    assert aggregation_windows(
+        datetime(2018, 1, 15), datetime(2018, 3, 1), 'month', 2) == [
+        (datetime(2018, 1, 1), datetime(2018, 2, 1)),
+        (datetime(2018, 3, 1), datetime(2018, 3, 1)),
+    ]
@@ -174,7 +174,11 @@ CELERY_TASK_ROUTES = {
     'zenodo.modules.sipstore.tasks.archive_sip': {'queue': 'low'},
     'zenodo_migrator.tasks.migrate_concept_recid_sips': {'queue': 'low'},
     'invenio_openaire.tasks.register_grant': {'queue': 'low'},
-    'invenio_indexer.tasks.process_bulk_queue': {'queue': 'celery-indexer'}
+    'invenio_indexer.tasks.process_bulk_queue': {'queue': 'celery-indexer'},
+    'zenodo.modules.records.tasks.process_bulk_queue': {
+        'queue': 'celery-indexer'},
+    'zenodo.modules.records.tasks.reindex_records': {
+        'queue': 'celery-indexer'},
 }
 #: Beat schedule
 CELERY_BEAT_SCHEDULE = {
@@ -183,7 +187,7 @@ CELERY_BEAT_SCHEDULE = {
         'schedule': crontab(minute=2, hour=0),
     },
     'indexer': {
-        'task': 'invenio_indexer.tasks.process_bulk_queue',
+        'task': 'zenodo.modules.records.tasks.process_bulk_queue',
         'schedule': timedelta(minutes=5),
         'kwargs': {
             'es_bulk_kwargs': {'raise_on_error': False},
@@ -254,6 +258,20 @@ CELERY_BEAT_SCHEDULE = {
             'job_id': 'records',
         }
     },
+    'export-delta': {
+        'task': 'zenodo.modules.exporter.tasks.export_job',
+        'schedule': crontab(minute=0, hour=5),
+        'kwargs': {
+            'job_id': 'records-delta',
+        }
+    },
+    'export-xml': {
+        'task': 'zenodo.modules.exporter.tasks.export_job',
+        'schedule': crontab(minute=0, hour=6, day_of_month=1),
+        'kwargs': {
+            'job_id': 'records-xml',
+        }
+    },
     # Stats
     'stats-process-events': {
         'task': 'invenio_stats.tasks.process_events',
@@ -261,7 +279,7 @@ CELERY_BEAT_SCHEDULE = {
         'args': [('record-view', 'file-download')],
     },
     'stats-aggregate-events': {
-        'task': 'invenio_stats.tasks.aggregate_events',
+        'task': 'zenodo.modules.stats.tasks.aggregate_events',
         'schedule': timedelta(hours=3),
         'args': [(
             'record-view-agg', 'record-view-all-versions-agg',
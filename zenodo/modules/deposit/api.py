@@ -52,6 +52,8 @@ from zenodo.modules.records.api import ZenodoFileObject, ZenodoFilesIterator, \
     ZenodoFilesMixin, ZenodoRecord
 from zenodo.modules.records.minters import doi_generator, is_local_doi, \
     zenodo_concept_doi_minter, zenodo_doi_updater
+from zenodo.modules.records.serializers.pidrelations import \
+    invalidate_versions_identifiers
 from zenodo.modules.records.utils import is_doi_locally_managed, \
     is_valid_openaire_type
 
@@ -492,6 +494,7 @@ class ZenodoDeposit(Deposit, ZenodoFilesMixin):
 
         deposit = super(ZenodoDeposit, self).publish(pid, id_)
         recid, record = deposit.fetch_published()
+        invalidate_versions_identifiers(record.get('conceptrecid'))
 
         pv = PIDVersioning(child=recid)
         is_new_version = pv.children.count() > 1
@@ -26,15 +26,14 @@
 
 from __future__ import absolute_import, print_function
 
-import copy
-
 from flask import current_app
 from invenio_pidrelations.contrib.records import index_siblings
 from invenio_pidrelations.contrib.versioning import PIDVersioning
 from invenio_pidrelations.serializers.utils import serialize_relations
 from invenio_pidstore.models import PersistentIdentifier
 
-from zenodo.modules.records.utils import build_record_custom_fields
+from zenodo.modules.records.utils import build_record_custom_fields, \
+    resolve_record_refs
 
 from .api import ZenodoDeposit
 
@@ -68,7 +67,7 @@ def indexer_receiver(sender, json=None, record=None, index=None,
         # Temporarily set to draft mode to ensure that `clear` can be called
         json['_deposit']['status'] = 'draft'
         json.clear()
-        json.update(copy.deepcopy(pub_record.replace_refs()))
+        json.update(resolve_record_refs(pub_record))
 
         # Set back to published mode and restore schema.
         json['_deposit']['status'] = 'published'
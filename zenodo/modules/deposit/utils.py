@@ -52,6 +52,8 @@ from zenodo.modules.openaire.helpers import openaire_datasource_id, \
 from zenodo.modules.openaire.tasks import openaire_delete
 from zenodo.modules.records.api import ZenodoRecord
 from zenodo.modules.records.minters import is_local_doi
+from zenodo.modules.records.serializers.pidrelations import \
+    invalidate_versions_identifiers
 
 
 def file_id_to_key(value):
@@ -137,6 +139,7 @@ def delete_record(record_uuid, reason, user):
     pv.remove_child(recid)
     pv.update_redirect()
     recid.delete()
+    invalidate_versions_identifiers(record.get('conceptrecid'))
 
     # Remove the record from index
     try:
@@ -26,6 +26,8 @@
 
 from __future__ import absolute_import, print_function
 
-from .api import Exporter
-from .streams import BZip2ResultStream, ResultStream
-from .writers import BucketWriter, filename_factory
+from .api import Exporter, FanoutExporter, IncrementalExporter
+from .streams import BZip2ResultStream, ColumnarResultStream, \
+    CompressedResultStream, ResultStream
+from .writers import BucketWriter, FilesystemWriter, MultipartWriter, \
+    filename_factory
@@ -26,32 +26,82 @@
 
 from __future__ import absolute_import, print_function
 
+import copy
+import threading
+from datetime import datetime, timedelta
+from itertools import islice
+
+from dateutil.parser import parse as dateutil_parse
+from elasticsearch.helpers import scan
 from elasticsearch_dsl import Q
+from elasticsearch_dsl.connections import connections
 from flask import current_app
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_search.api import RecordsSearch
+from six.moves.queue import Queue
 
 from .errors import FailedExportJobError
-from .streams import ResultStream
+from .streams import FailedRecordIds, ProgressStream, ResultStream
+from .utils import ExportProgress
+from .writers import merge_parts, part_key, tombstones_key
 
 
 class Exporter(object):
     """Export controller.
 
     Takes as input an index, a query, a serializer and an output writer and
-    executes the export job.
+    executes the export job. Extra options for the result stream (e.g. the
+    compression codec and level) can be passed in ``resultstream_kwargs``.
+
+    If ``slice_id`` and ``max_slices`` are given, only the corresponding
+    slice of the search results is exported (using an Elasticsearch sliced
+    scroll), so that several exporters can run in parallel over disjoint
+    parts of the index. The part of a slice is written even if some records
+    fail to be serialized, and their ids are kept in ``failed_ids`` (a
+    :py:class:`~.streams.FailedRecordIds` of at most ``max_failed_ids`` ids
+    in memory).
+
+    If ``checkpoint_key`` is given, the results are exported in parts of
+    ``checkpoint_size`` records, in the order of ``checkpoint_sort``. After
+    each part, the writer saves a checkpoint with the written parts and the
+    sort values of the last exported record, so that a new run of the job
+    continues from there instead of starting over. Once all records are
+    exported, the parts are assembled into the output object, and the
+    checkpoint is marked as merged before the parts and the checkpoint are
+    removed, so that an interrupted cleanup does not export the records
+    again. Checkpoints are not supported for sliced jobs. Records which fail to be serialized
+    do not stop the export of a part: their ids are kept in the checkpoint,
+    and reported once the parts are assembled.
+
+    Search hits are scanned as raw dictionaries, and if the serializer has
+    an ``export_fields`` attribute, only these fields are fetched.
     """
 
+    max_failed_ids = 1000
+    """Maximum number of ids of not serialized records kept in memory."""
+
     def __init__(self, index='records', pid_fetcher=None, query=None,
-                 resultstream_cls=ResultStream, search_cls=RecordsSearch,
-                 serializer=None, writer=None, ):
+                 resultstream_cls=ResultStream, resultstream_kwargs=None,
+                 search_cls=RecordsSearch, serializer=None, writer=None,
+                 slice_id=None, max_slices=None, checkpoint_key=None,
+                 checkpoint_size=100000, checkpoint_sort=('recid', ),
+                 progress_interval=None, ):
         """Initialize exporter."""
         self._index = index
         self._pid_fetcher = pid_fetcher
         self._query = query
         self._resultstream_cls = resultstream_cls
+        self._resultstream_kwargs = resultstream_kwargs or {}
         self._search_cls = search_cls
         self._serializer = serializer
         self._writer = writer
+        self._slice_id = slice_id
+        self._max_slices = max_slices
+        self._checkpoint_key = checkpoint_key
+        self._checkpoint_size = checkpoint_size
+        self._checkpoint_sort = checkpoint_sort
+        self._progress_interval = progress_interval
+        self.failed_ids = FailedRecordIds(max_size=self.max_failed_ids)
 
     @property
     def search(self):
@@ -59,15 +109,404 @@ class Exporter(object):
         s = self._search_cls(index=self._index)
         if self._query:
             s = s.query(Q('query_string', query=self._query))
+        if self._max_slices and self._max_slices > 1:
+            s = s.extra(slice={'id': self._slice_id, 'max': self._max_slices})
         return s
 
-    def run(self, progress_updater=None):
-        """Run export job."""
-        fp = self._writer.open()
+    def _write(self, writer, search, progress, failed=None):
+        """Write the serialized search results with a writer.
+
+        :param failed: If given, a :py:class:`~.streams.FailedRecordIds` to
+            which the ids of the records which failed to be serialized are
+            added. The whole output is then written even if some records
+            fail (otherwise it is aborted).
+        :returns: ``True`` if all records were serialized.
+        """
+        stream = self._resultstream_cls(
+            search, self._pid_fetcher, self._serializer,
+            **self._resultstream_kwargs)
+        if failed is not None:
+            stream.failed_record_ids = failed
+            stream.raise_on_failure = False
+        fp = writer.open()
         try:
-            fp.write(self._resultstream_cls(
-                self.search, self._pid_fetcher, self._serializer))
+            fp.write(ProgressStream(stream, progress))
         except FailedExportJobError as e:
-            current_app.logger.exception(e.message)
+            current_app.logger.exception(str(e))
+            return False
         finally:
             fp.close()
+            if failed is None:
+                stream.close()
+        return not stream.failed_record_ids
+
+    def _run_checkpointed(self, progress):
+        """Run export job in parts, resuming from the last checkpoint."""
+        writer = self._writer
+        state = writer.load_state(self._checkpoint_key) or {}
+        key = state.get('key') or writer.resolve_key()
+        parts = state.get('parts', [])
+        failed_ids = state.get('failed_ids', [])
+        failed_count = state.get('failed_count', 0)
+        if state:
+            current_app.logger.info(
+                'Resuming export of {0} after {1} parts.'.format(
+                    key, len(parts)))
+
+        cursor = SearchAfterCursor(
+            self.search, self._checkpoint_sort,
+            search_after=state.get('search_after'),
+            window=self._checkpoint_size)
+        while not state.get('merged') and not cursor.exhausted:
+            part = part_key(key, len(parts))
+            # Remove any leftovers of an interrupted run
+            writer.remove_part(part)
+            count = cursor.count
+            with FailedRecordIds(max_size=self.max_failed_ids) as failed:
+                self._write(
+                    writer.copy(part), cursor, progress, failed=failed)
+            if cursor.count == count:
+                writer.remove_part(part)
+                break
+            parts.append(part)
+            failed_count += len(failed)
+            failed_ids = (failed_ids + failed.ids)[:self.max_failed_ids]
+            writer.save_state(self._checkpoint_key, dict(
+                key=key, parts=parts, search_after=cursor.search_after,
+                success=not failed_count, failed_ids=failed_ids,
+                failed_count=failed_count))
+
+        if not state.get('merged'):
+            merge_parts(writer, key, parts, remove=False)
+            # Once the output is written, a new run only has to clean up.
+            writer.save_state(self._checkpoint_key, dict(
+                key=key, parts=parts, merged=True,
+                success=not failed_count, failed_ids=failed_ids,
+                failed_count=failed_count))
+        for part in parts:
+            writer.remove_part(part)
+        writer.remove_part(self._checkpoint_key)
+        if failed_count:
+            current_app.logger.error(str(FailedExportJobError(
+                record_ids=failed_ids, count=failed_count)))
+            return False
+        return True
+
+    def run(self, progress_updater=None):
+        """Run export job.
+
+        :param progress_updater: Callable periodically receiving the export
+            metrics (see :py:class:`~.utils.ExportProgress`).
+        :returns: ``True`` if all records were exported, ``False`` if some
+            records failed to be serialized.
+        """
+        name = self._index
+        if self._max_slices and self._max_slices > 1:
+            name = '{0} (slice {1}/{2})'.format(
+                name, self._slice_id + 1, self._max_slices)
+        progress = ExportProgress(
+            name=name,
+            updater=progress_updater,
+            interval=self._progress_interval or
+            current_app.config['EXPORTER_PROGRESS_INTERVAL'])
+        try:
+            if self._checkpoint_key:
+                return self._run_checkpointed(progress)
+            sliced = self._max_slices and self._max_slices > 1
+            return self._write(self._writer, RawSearch(
+                self.search,
+                source=getattr(self._serializer, 'export_fields', None)),
+                progress, failed=self.failed_ids if sliced else None)
+        finally:
+            self.failed_ids.close()
+            progress.report()
+
+
+class RawSearch(object):
+    """Search wrapper scanning raw hits with the Elasticsearch client.
+
+    The hits are returned as the plain dictionaries of the scroll pages,
+    without building Elasticsearch DSL response objects, and the source can
+    be limited to the fields used by the serializer.
+
+    :param search: Elasticsearch DSL search instance.
+    :param source: List of source fields to fetch (all if ``None``).
+    :param size: Number of hits per scroll page.
+    :param scroll: Scroll context keep-alive time.
+    """
+
+    def __init__(self, search, source=None, size=1000, scroll='5m'):
+        """Initialize the search wrapper."""
+        self.search = search.source(source) if source else search
+        self.size = size
+        self.scroll = scroll
+
+    def scan(self):
+        """Iterate over all raw hits."""
+        s = self.search
+        return scan(
+            connections.get_connection(s._using),
+            query=s.to_dict(),
+            index=s._index,
+            size=self.size,
+            scroll=self.scroll,
+            **s._params
+        )
+
+
+class SearchAfterCursor(object):
+    """Cursor over search results in sort order, using ``search_after``.
+
+    Unlike a scroll, the position of the cursor (the sort values of the last
+    returned hit) can be saved and used to resume the iteration later. Each
+    call to ``scan()`` returns the next ``window`` hits, which makes the
+    cursor usable as the search of a result stream.
+
+    :param search: Elasticsearch DSL search instance.
+    :param sort: Fields to sort on. The sort values must be unique.
+    :param search_after: Sort values of the hit to start after.
+    :param window: Number of hits returned by each ``scan()``.
+    :param size: Number of hits fetched per search request.
+    """
+
+    def __init__(self, search, sort, search_after=None, window=None,
+                 size=1000):
+        """Initialize the cursor."""
+        self.search = search.sort(*sort).extra(size=size)
+        self.search_after = search_after
+        self.window = window
+        self.exhausted = False
+        self.count = 0
+        self._hits = self._iter_hits()
+
+    def _iter_hits(self):
+        """Iterate over all hits after the current position."""
+        while True:
+            s = self.search
+            if self.search_after is not None:
+                s = s.extra(search_after=self.search_after)
+            hits = s.execute().hits
+            if not len(hits):
+                self.exhausted = True
+                return
+            for hit in hits:
+                self.search_after = list(hit.meta.sort)
+                yield hit
+
+    def scan(self):
+        """Iterate over the next window of hits."""
+        for hit in islice(self._hits, self.window):
+            self.count += 1
+            yield hit
+
+
+class IncrementalExporter(Exporter):
+    """Incremental export controller.
+
+    Exports only the records updated since the previous run, together with
+    the list of records deleted in the same time window (the "tombstones").
+    The end of the exported time window (the high-water mark) is stored by
+    the writer under ``state_key`` and only advanced if the export succeeds.
+    A full dump can thus be rebuilt from a snapshot plus all later deltas.
+
+    The window ends ``lag`` before the start of the run, to leave time for
+    recently updated records to be indexed.
+    """
+
+    def __init__(self, state_key=None, lag=timedelta(hours=1), **kwargs):
+        """Initialize exporter."""
+        super(IncrementalExporter, self).__init__(**kwargs)
+        self._state_key = state_key
+        self._lag = lag
+        self._since = None
+        self._until = None
+
+    @property
+    def search(self):
+        """Get Elasticsearch search instance for the time window."""
+        s = super(IncrementalExporter, self).search
+        updated = {'lte': self._until.isoformat()}
+        if self._since:
+            updated['gt'] = self._since.isoformat()
+        return s.filter('range', _updated=updated)
+
+    def deleted_recids(self):
+        """Get the recids of the records deleted in the time window."""
+        query = PersistentIdentifier.query.filter(
+            PersistentIdentifier.pid_type == 'recid',
+            PersistentIdentifier.status == PIDStatus.DELETED,
+            PersistentIdentifier.updated <= self._until,
+        )
+        if self._since:
+            query = query.filter(PersistentIdentifier.updated > self._since)
+        return [pid_value for (pid_value, ) in query.with_entities(
+            PersistentIdentifier.pid_value).yield_per(1000)]
+
+    def run(self, progress_updater=None):
+        """Run incremental export job."""
+        state = self._writer.load_state(self._state_key) or {}
+        self._since = dateutil_parse(state['until']) \
+            if state.get('until') else None
+        self._until = datetime.utcnow().replace(microsecond=0) - self._lag
+
+        key = self._writer.resolve_key()
+        writer, self._writer = self._writer, self._writer.copy(key)
+        try:
+            if not super(IncrementalExporter, self).run(
+                    progress_updater=progress_updater):
+                return False
+        finally:
+            self._writer = writer
+
+        window = dict(
+            since=self._since.isoformat() if self._since else None,
+            until=self._until.isoformat(),
+        )
+        writer.save_state(
+            tombstones_key(key), dict(deleted=self.deleted_recids(), **window))
+        writer.save_state(self._state_key, dict(key=key, **window))
+        return True
+
+
+class FanoutExporter(Exporter):
+    """Multi-format export controller.
+
+    Scans the search results once and exports them with several targets.
+    Each target is a dictionary with a ``serializer`` and a ``writer``, and
+    optionally a ``name`` (used in the progress reports), a
+    ``resultstream_cls`` and ``resultstream_kwargs`` (e.g. for the
+    compression codec).
+
+    Each target is serialized and written by its own thread, which receives
+    pages of ``page_size`` raw hits through a queue of at most
+    ``queue_size`` pages, so that the scan only advances as fast as the
+    slowest target. The fetched source fields are the union of the
+    serializers' ``export_fields`` (all fields if a serializer does not
+    define them).
+    """
+
+    def __init__(self, targets=None, queue_size=10, page_size=100, **kwargs):
+        """Initialize exporter."""
+        super(FanoutExporter, self).__init__(**kwargs)
+        self._targets = targets or []
+        self._queue_size = queue_size
+        self._page_size = page_size
+
+    @property
+    def export_fields(self):
+        """Get the source fields needed by all the targets' serializers."""
+        fields = set()
+        for target in self._targets:
+            serializer_fields = getattr(
+                target['serializer'], 'export_fields', None)
+            if serializer_fields is None:
+                return None
+            fields.update(serializer_fields)
+        return sorted(fields)
+
+    def _exporter(self, target):
+        """Get the exporter of a single target."""
+        return Exporter(
+            index=self._index,
+            pid_fetcher=self._pid_fetcher,
+            serializer=target['serializer'],
+            writer=target['writer'],
+            resultstream_cls=target.get('resultstream_cls', ResultStream),
+            resultstream_kwargs=target.get('resultstream_kwargs'),
+        )
+
+    def _write_target(self, app, exporter, search, progress, results, index):
+        """Export the hits received by a target thread."""
+        with app.app_context():
+            try:
+                results[index] = exporter._write(
+                    exporter._writer, search, progress)
+            except Exception:
+                app.logger.exception(
+                    'Export target {0} failed.'.format(progress.name))
+            finally:
+                # Keep consuming the queue, so that the scan is not blocked.
+                search.drain()
+                progress.report()
+
+    def run(self, progress_updater=None):
+        """Run export job.
+
+        :param progress_updater: Callable periodically receiving the metrics
+            of all targets, as ``{'targets': [metrics, ...]}``.
+        :returns: ``True`` if all records were exported by all targets.
+        """
+        app = current_app._get_current_object()
+        interval = self._progress_interval or \
+            current_app.config['EXPORTER_PROGRESS_INTERVAL']
+        progresses = []
+
+        def updater(metrics):
+            if progress_updater:
+                progress_updater(
+                    dict(targets=[p.metrics for p in progresses]))
+
+        searches, threads = [], []
+        results = [False] * len(self._targets)
+        for index, target in enumerate(self._targets):
+            exporter = self._exporter(target)
+            progress = ExportProgress(
+                name='{0} ({1})'.format(
+                    self._index, target.get('name', index)),
+                updater=updater,
+                interval=interval)
+            progresses.append(progress)
+            search = QueueSearch(Queue(maxsize=self._queue_size))
+            searches.append(search)
+            threads.append(threading.Thread(
+                target=self._write_target,
+                args=(app, exporter, search, progress, results, index)))
+
+        for thread in threads:
+            thread.start()
+        try:
+            hits = RawSearch(self.search, source=self.export_fields).scan()
+            while True:
+                page = list(islice(hits, self._page_size))
+                if not page:
+                    break
+                for search in searches:
+                    search.queue.put(page)
+        finally:
+            for search in searches:
+                search.queue.put(None)
+            for thread in threads:
+                thread.join()
+        return all(results)
+
+
+class QueueSearch(object):
+    """Search wrapper iterating over pages of raw hits received in a queue.
+
+    A ``None`` page marks the end of the hits. Since the same pages are sent
+    to several serializers, each hit is returned with a deep copy of its
+    source, which serializers are free to modify.
+
+    :param queue: Queue of lists of raw hits.
+    """
+
+    def __init__(self, queue):
+        """Initialize the search wrapper."""
+        self.queue = queue
+        self.exhausted = False
+
+    def scan(self):
+        """Iterate over the received hits."""
+        while not self.exhausted:
+            page = self.queue.get()
+            if page is None:
+                self.exhausted = True
+                return
+            for hit in page:
+                yield dict(hit, _source=copy.deepcopy(hit['_source']))
+
+    def drain(self):
+        """Discard the remaining pages, until the end of the hits."""
+        while not self.exhausted:
+            if self.queue.get() is None:
+                self.exhausted = True
@@ -27,13 +27,18 @@
 from __future__ import absolute_import, print_function
 
 from zenodo.modules.records.fetchers import zenodo_record_fetcher
-from zenodo.modules.records.serializers import json_v1
+from zenodo.modules.records.serializers import columnar_v1, datacite_v41, \
+    dcat_v1, json_v1
 
-from .streams import BZip2ResultStream
+from .api import FanoutExporter, IncrementalExporter
+from .streams import BZip2ResultStream, ColumnarResultStream
 from .writers import BucketWriter, filename_factory
 
 EXPORTER_BUCKET_UUID = '00000000-0000-0000-0000-000000000001'
 
+EXPORTER_PROGRESS_INTERVAL = 60
+"""Interval in seconds between progress reports of running export jobs."""
+
 EXPORTER_JOBS = {
     'records': {
         'index': 'records',
@@ -44,7 +49,104 @@ EXPORTER_JOBS = {
         ),
         'resultstream_cls': BZip2ResultStream,
         'pid_fetcher': zenodo_record_fetcher,
-        'query': "+_exists_:recid +_missing_:removal_reason"
-    }
+        'query': "+_exists_:recid +_missing_:removal_reason",
+        'checkpoint_key': 'records.checkpoint.json',
+    },
+    'records-delta': {
+        'exporter_cls': IncrementalExporter,
+        'state_key': 'records-delta.state.json',
+        'index': 'records',
+        'serializer': json_v1,
+        'writer': BucketWriter(
+            bucket_id=EXPORTER_BUCKET_UUID,
+            key=filename_factory(name='records-delta', format='json.bz2'),
+        ),
+        'resultstream_cls': BZip2ResultStream,
+        'pid_fetcher': zenodo_record_fetcher,
+        'query': "+_exists_:recid +_missing_:removal_reason",
+    },
+    'records-parquet': {
+        'index': 'records',
+        'serializer': columnar_v1,
+        'writer': BucketWriter(
+            bucket_id=EXPORTER_BUCKET_UUID,
+            key=filename_factory(name='records', format='parquet'),
+        ),
+        'resultstream_cls': ColumnarResultStream,
+        'resultstream_kwargs': {'format': 'parquet'},
+        'pid_fetcher': zenodo_record_fetcher,
+        'query': "+_exists_:recid +_missing_:removal_reason",
+    },
+    'records-xml': {
+        'exporter_cls': FanoutExporter,
+        'index': 'records',
+        'targets': [
+            {
+                'name': 'datacite',
+                'serializer': datacite_v41,
+                'writer': BucketWriter(
+                    bucket_id=EXPORTER_BUCKET_UUID,
+                    key=filename_factory(
+                        name='records-datacite', format='xml.bz2'),
+                ),
+                'resultstream_cls': BZip2ResultStream,
+            },
+            {
+                'name': 'dcat',
+                'serializer': dcat_v1,
+                'writer': BucketWriter(
+                    bucket_id=EXPORTER_BUCKET_UUID,
+                    key=filename_factory(
+                        name='records-dcat', format='xml.bz2'),
+                ),
+                'resultstream_cls': BZip2ResultStream,
+            },
+        ],
+        'pid_fetcher': zenodo_record_fetcher,
+        'query': "+_exists_:recid +_missing_:removal_reason",
+    },
 }
-"""Export jobs definitions."""
+"""Export jobs definitions.
+
+The compression codec is chosen with ``resultstream_cls`` set to
+:py:class:`~zenodo.modules.exporter.streams.CompressedResultStream` and e.g.
+``resultstream_kwargs={'codec': 'zstd', 'level': 10}``. See
+:py:data:`~zenodo.modules.exporter.streams.COMPRESSORS` for available codecs.
+
+Besides :py:class:`~zenodo.modules.exporter.writers.BucketWriter`, the output
+can be uploaded in parallel parts with
+:py:class:`~zenodo.modules.exporter.writers.MultipartWriter`, or written to a
+local (or NFS) directory with
+:py:class:`~zenodo.modules.exporter.writers.FilesystemWriter`, which only
+moves the file to its final name once it is complete.
+
+Setting ``slices`` to more than one splits the job in as many parallel tasks,
+each exporting one slice of the index to a separate part. The parts are then
+assembled into the object given by the job's writer. Compressed parts are
+concatenated as they are, so the output of a sliced job is a multi-stream
+file (e.g. several BZip2 streams), which some decompressors only read up to
+the end of the first stream. Slicing is thus disabled by default.
+
+Setting ``exporter_cls`` to
+:py:class:`~zenodo.modules.exporter.api.IncrementalExporter` exports only the
+records updated since the previous run of the job (slices are not supported
+for incremental jobs).
+
+The ``records-parquet`` job exports flattened records in the Parquet
+columnar format (requires the ``columnar`` extra). A job with a columnar
+serializer must not be sliced, since Parquet and Arrow files cannot be
+concatenated.
+
+Setting ``exporter_cls`` to
+:py:class:`~zenodo.modules.exporter.api.FanoutExporter` exports the records
+with several ``targets`` (serializer, writer and result stream) in a single
+scan of the index, each target being serialized in its own thread. The
+``records-xml`` job produces the DataCite and DCAT dumps this way (fan-out
+jobs cannot be sliced or checkpointed). Each dump is a single XML document,
+whose ``<resources>`` root element contains one element per record.
+
+Setting ``checkpoint_key`` makes a (non-sliced) job resumable: the job is
+exported in parts and a checkpoint is saved after each part, so that the next
+run continues from the last checkpoint instead of starting over. The
+``records`` job is checkpointed this way.
+"""
@@ -28,8 +28,22 @@
 class FailedExportJobError(Exception):
     """Error for failed export job."""
 
-    def __init__(self, record_ids=None):
-        """Initialize the error with the list of not serialized records."""
+    def __init__(self, record_ids=None, count=None):
+        """Initialize the error with the list of not serialized records.
+
+        :param record_ids: List of record ids, or a
+            :py:class:`~zenodo.modules.exporter.streams.FailedRecordIds`,
+            in which case only the ids kept in memory are listed.
+        :param count: Total number of not serialized records, if more than
+            the listed ones.
+        """
+        record_ids = record_ids or []
+        ids = getattr(record_ids, 'ids', record_ids)
+        count = count if count is not None else len(record_ids)
         msg = "Serialization failed for the following records: {}"\
-            .format(', '.join(record_ids))
+            .format(', '.join(str(i) for i in ids))
+        if count > len(ids):
+            msg += ' and {0} more'.format(count - len(ids))
+        if getattr(record_ids, 'path', None):
+            msg += ' (full list in {0})'.format(record_ids.path)
         super(FailedExportJobError, self).__init__(msg)
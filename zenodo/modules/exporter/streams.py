@@ -27,9 +27,100 @@
 from __future__ import absolute_import, print_function
 
 import bz2
+import os
+import tempfile
+import zlib
+from collections import deque
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from six import binary_type
 
 from .errors import FailedExportJobError
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class FailedRecordIds(object):
+    """Bounded list of the ids of records which failed to be serialized.
+
+    Only the first ``max_size`` ids are kept in memory. Once the limit is
+    reached, all ids are written to a temporary file instead, so that the
+    memory use stays flat however many records fail. The file is removed by
+    ``close()`` (or when used as a context manager), after which only the
+    ids kept in memory and the count are available.
+    """
+
+    def __init__(self, max_size=1000):
+        """Initialize the list."""
+        self.max_size = max_size
+        self.ids = []
+        self.count = 0
+        self._file = None
+
+    @property
+    def path(self):
+        """Path of the file holding all ids (if the limit was reached)."""
+        return self._file.name if self._file else None
+
+    def append(self, id_):
+        """Add a record id."""
+        self.count += 1
+        if len(self.ids) < self.max_size:
+            self.ids.append(id_)
+            return
+        if self._file is None:
+            self._file = tempfile.NamedTemporaryFile(
+                mode='w', prefix='zenodo-export-failed-', suffix='.txt',
+                delete=False)
+            self._file.writelines('{0}\n'.format(i) for i in self.ids)
+        self._file.write('{0}\n'.format(id_))
+
+    def close(self):
+        """Remove the file holding all ids."""
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._file.name)
+            self._file = None
+
+    def __enter__(self):
+        """Enter the context."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Remove the file holding all ids when leaving the context."""
+        self.close()
+
+    def __len__(self):
+        """Number of failed records."""
+        return self.count
+
+    def __iter__(self):
+        """Iterate over all ids (read lazily from the file if needed)."""
+        if self._file is None:
+            for id_ in self.ids:
+                yield id_
+            return
+        self._file.flush()
+        with open(self._file.name) as fp:
+            for line in fp:
+                yield line.rstrip('\n')
+
 
 class ResultStream(object):
     """Stream of serialized records for a search.
@@ -39,21 +130,42 @@ class ResultStream(object):
     emulates a stream API with the ``read()`` method, so that the serialized
     records can be written to an output.
 
+    When ``read(size)`` is called with a size, serialized records are
+    gathered into a buffer and returned in blocks of exactly ``size`` bytes
+    (except for the last one), which avoids one storage write per record.
+
     :param search: Elasticsearch DSL search instance configured for specific
         index.
     :param pid_fetcher: Persistent identifier fetcher that matches configured
         index.
     :param serializer: Serializer that supports export (i.e. the serialize
         must have implement the API ``serialize_exporter(pid, record)``).
+
+    The ids of the records which failed to be serialized are kept in
+    ``failed_record_ids``, which can be replaced before reading the stream
+    and is released by ``close()``.
+
+    If the serializer has ``export_header`` or ``export_footer`` attributes,
+    they are written before the first and after the last record (e.g. the
+    root element of an XML document).
     """
 
+    raise_on_failure = True
+    """Raise :py:class:`~.errors.FailedExportJobError` at the end of the
+    stream if some records failed to be serialized."""
+
     def __init__(self, search, pid_fetcher, serializer):
         """Initialize result stream."""
         self.pid_fetcher = pid_fetcher
         self.search = search
         self.serializer = serializer
         self._iter = None
-        self.failed_record_ids = []
+        self._buffer = []
+        self._buffered = 0
+        self.count = 0
+        self.serialized_bytes = 0
+        self.failed_record_ids = FailedRecordIds()
+        self._footer_written = False
 
     def __next__(self):
         """Fetch next serialized record."""
@@ -61,68 +173,436 @@ class ResultStream(object):
         # initialized.
         if self._iter is None:
             self._iter = self.search.scan()
-        # Fetch next hit.
-        hit = next(self._iter)
+            header = getattr(self.serializer, 'export_header', None)
+            if header:
+                return header
+        # Fetch next hit, and end the output with the serializer's footer.
+        try:
+            hit = next(self._iter)
+        except StopIteration:
+            footer = getattr(self.serializer, 'export_footer', None)
+            if footer and not self._footer_written:
+                self._footer_written = True
+                return footer
+            raise
+        if isinstance(hit, dict) and '_source' in hit:
+            # Raw hit from the Elasticsearch client (see RawSearch)
+            id_, source = hit['_id'], hit['_source']
+        else:
+            id_, source = hit.meta.id, hit._d_
         # Serialize and return hit.
-        result = ''
+        result = b''
         try:
             result = self.serializer.serialize_exporter(
-                self.pid_fetcher(hit.meta.id, hit),
-                dict(_source=hit._d_, _version=0),
+                self.pid_fetcher(id_, source),
+                dict(_source=source, _version=0),
             )
         except Exception as e:
-            self.failed_record_ids.append(hit.meta.id)
+            self.failed_record_ids.append(id_)
 
+        self.count += 1
+        if isinstance(result, binary_type):
+            self.serialized_bytes += len(result)
         return result
 
     def __iter__(self):
         """Iterator."""
         return self
 
+    def close(self):
+        """Release the list of not serialized records."""
+        self.failed_record_ids.close()
+
     def next(self):
         """Python 2.x compatibility function."""
         return self.__next__()
 
-    def read(self, *args):
-        """Read next serialized record for search results.
+    def _fill(self, size):
+        """Buffer serialized data until there are at least ``size`` bytes."""
+        while self._buffered < size:
+            try:
+                data = next(self)
+            except StopIteration:
+                return
+            if data:
+                self._buffer.append(data)
+                self._buffered += len(data)
+
+    def read(self, size=-1):
+        """Read serialized records for search results.
+
+        Without ``size``, the next serialized record is returned. With
+        ``size``, up to ``size`` bytes of serialized records are returned.
 
         The method will return an empty string for repeated calls once all
         records have been read.
         """
-        try:
-            return next(self)
-        except StopIteration:
-            if self.failed_record_ids:
-                # raise an exception with the list of not serialized records
-                raise FailedExportJobError(record_ids=self.failed_record_ids)
-            return b''
+        if size is None or size < 0:
+            # Return whatever is buffered, or the next serialized record.
+            self._fill(1)
+            size = self._buffered
+        else:
+            self._fill(size)
+        data = b''.join(self._buffer)
+        chunk, rest = data[:size], data[size:]
+        self._buffer = [rest] if rest else []
+        self._buffered = len(rest)
+        if chunk:
+            return chunk
+        if self.failed_record_ids and self.raise_on_failure:
+            # raise an exception with the list of not serialized records
+            raise FailedExportJobError(record_ids=self.failed_record_ids)
+        return b''
 
 
-class BZip2ResultStream(ResultStream):
-    """BZip2 compressed stream of serialized records for a search.
+class CompressedResultStream(ResultStream):
+    """Compressed stream of serialized records for a search.
 
     Works like :py:data:`ResultStream`, except that the output is compressed
-    with BZip2.
+    with one of the codecs registered in :py:data:`COMPRESSORS`.
+
+    :param codec: Name of the compression codec.
+    :param options: Keyword arguments passed to the codec factory (e.g.
+        ``level``).
     """
 
-    def __init__(self, *args, **kwargs):
+    codec = 'bz2'
+    """Default compression codec."""
+
+    def __init__(self, search, pid_fetcher, serializer, codec=None,
+                 **options):
         """Initialize result stream."""
-        super(BZip2ResultStream, self).__init__(*args, **kwargs)
-        self.compressor = bz2.BZ2Compressor()
+        super(CompressedResultStream, self).__init__(
+            search, pid_fetcher, serializer)
+        self.compressor = get_compressor(codec or self.codec, **options)
+        self._flushed = False
 
     def __next__(self):
-        """Fetch next serialized bzip2 compressed chunk of records(s)."""
+        """Fetch next compressed chunk of serialized record(s)."""
+        if self._flushed:
+            raise StopIteration
         try:
             data = None
             while not data:
                 data = self.compressor.compress(
-                    super(BZip2ResultStream, self).__next__()
+                    super(CompressedResultStream, self).__next__()
                 )
             return data
         except StopIteration:
             # Once we have read all records, make sure we flush the data left
-            # in compressor. Repeated calls to flush will raise a ValueError.
+            # in the compressor.
+            self._flushed = True
+            return self.compressor.flush()
+
+
+class BZip2ResultStream(CompressedResultStream):
+    """BZip2 compressed stream of serialized records for a search.
+
+    Works like :py:data:`ResultStream`, except that the output is compressed
+    with BZip2.
+    """
+
+    codec = 'bz2'
+
+
+class OutputBuffer(object):
+    """Write-only file-like object whose content can be drained.
+
+    Unlike ``BytesIO``, the position reported by ``tell()`` keeps growing
+    when the buffer is drained, as required by formats which record file
+    offsets (e.g. Parquet and Arrow).
+    """
+
+    def __init__(self):
+        """Initialize the buffer."""
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        """Write data to the buffer."""
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        """Total number of bytes written."""
+        return self._position
+
+    def flush(self):
+        """Nothing to flush."""
+
+    def close(self):
+        """Close the buffer."""
+        self.closed = True
+
+    def drain(self):
+        """Get and remove the data written since the last drain."""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ColumnarResultStream(ResultStream):
+    """Parquet or Arrow IPC stream of serialized records for a search.
+
+    The serializer must return one row (dictionary) per record and provide
+    the Arrow schema of the rows with ``arrow_schema()``, like the records
+    ``columnar_v1`` serializer. Rows are written in row groups (record
+    batches for Arrow) of ``row_group_size`` rows.
+
+    :param format: Either ``parquet`` or ``arrow`` (Arrow IPC file format).
+    :param row_group_size: Number of rows per row group.
+    :param compression: Parquet compression codec.
+    """
+
+    def __init__(self, search, pid_fetcher, serializer, format='parquet',
+                 row_group_size=100000, compression='snappy'):
+        """Initialize result stream."""
+        if pyarrow is None:
+            raise RuntimeError(
+                'Columnar export requires the "pyarrow" package.')
+        if format not in ('parquet', 'arrow'):
+            raise ValueError('Unknown columnar format: {0}'.format(format))
+        super(ColumnarResultStream, self).__init__(
+            search, pid_fetcher, serializer)
+        self.format = format
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self._rows = []
+        self._output = OutputBuffer()
+        self._writer = None
+        self._closed = False
+
+    def _open(self):
+        """Open the Parquet or Arrow writer."""
+        self._schema = self.serializer.arrow_schema()
+        sink = pyarrow.PythonFile(self._output, mode='w')
+        if self.format == 'parquet':
+            return pyarrow.parquet.ParquetWriter(
+                sink, self._schema, compression=self.compression)
+        return pyarrow.RecordBatchFileWriter(sink, self._schema)
+
+    def _write_rows(self):
+        """Write the gathered rows as a row group."""
+        if not self._rows:
+            return
+        batch = pyarrow.RecordBatch.from_arrays([
+            pyarrow.array([row.get(field.name) for row in self._rows],
+                          type=field.type)
+            for field in self._schema
+        ], self._schema.names)
+        self._rows = []
+        if self.format == 'parquet':
+            self._writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+
+    def __next__(self):
+        """Fetch next chunk of serialized row groups."""
+        if self._closed:
+            raise StopIteration
+        if self._writer is None:
+            self._writer = self._open()
+        while True:
             try:
-                return self.compressor.flush()
-            except ValueError:
-                raise StopIteration
+                row = super(ColumnarResultStream, self).__next__()
+            except StopIteration:
+                # Write the last row group and the file footer.
+                self._write_rows()
+                self._writer.close()
+                self._closed = True
+                return self._output.drain()
+            if row:
+                self._rows.append(row)
+            if len(self._rows) >= self.row_group_size:
+                self._write_rows()
+                data = self._output.drain()
+                if data:
+                    return data
+
+
+class ParallelCompressor(object):
+    """Block-parallel compressor.
+
+    Input data is gathered in blocks of ``block_size`` bytes, and each block
+    is compressed independently in a thread pool (the standard library
+    compressors release the GIL). The compressed blocks are returned in
+    order, so the output is a valid multi-stream file for codecs that
+    support it (BZip2, GZip).
+
+    :param compress: Function compressing a block of bytes into a complete
+        compressed stream.
+    :param block_size: Size of uncompressed blocks in bytes.
+    :param threads: Number of compression threads (defaults to the number
+        of CPUs).
+    """
+
+    def __init__(self, compress, block_size=4 * 1024 * 1024, threads=None):
+        """Initialize the compressor."""
+        threads = threads or cpu_count()
+        self._compress = compress
+        self._block_size = block_size
+        self._max_pending = 2 * threads
+        self._pool = ThreadPool(threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def _submit(self):
+        """Send the buffered data for compression."""
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(self._compress, (block,)))
+
+    def _collect(self):
+        """Get the compressed blocks which are ready, in order."""
+        out = []
+        while self._pending and (self._pending[0].ready() or
+                                 len(self._pending) > self._max_pending):
+            out.append(self._pending.popleft().get())
+        return b''.join(out)
+
+    def compress(self, data):
+        """Compress data, returning any compressed output already ready."""
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            self._submit()
+        return self._collect()
+
+    def flush(self):
+        """Compress remaining data and wait for all blocks."""
+        if self._buffered:
+            self._submit()
+        out = b''.join(r.get() for r in self._pending)
+        self._pending.clear()
+        self._pool.close()
+        self._pool.join()
+        return out
+
+
+def _gzip_compress(data, level=6):
+    """Compress data into a complete GZip member."""
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+def bz2_compressor(level=9):
+    """BZip2 compressor."""
+    return bz2.BZ2Compressor(level)
+
+
+def gzip_compressor(level=6):
+    """GZip compressor."""
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def xz_compressor(level=6):
+    """XZ compressor."""
+    if lzma is None:
+        raise RuntimeError('XZ compression requires the "lzma" module.')
+    return lzma.LZMACompressor(preset=level)
+
+
+def zstd_compressor(level=3, threads=0):
+    """Zstandard compressor (``threads=-1`` uses all CPUs)."""
+    if zstandard is None:
+        raise RuntimeError(
+            'Zstandard compression requires the "zstandard" package.')
+    return zstandard.ZstdCompressor(
+        level=level, threads=threads).compressobj()
+
+
+def parallel_bz2_compressor(level=9, **kwargs):
+    """Block-parallel BZip2 compressor."""
+    return ParallelCompressor(partial(bz2.compress, compresslevel=level),
+                              **kwargs)
+
+
+def parallel_gzip_compressor(level=6, **kwargs):
+    """Block-parallel GZip compressor."""
+    return ParallelCompressor(partial(_gzip_compress, level=level), **kwargs)
+
+
+COMPRESSORS = {
+    'bz2': bz2_compressor,
+    'gzip': gzip_compressor,
+    'xz': xz_compressor,
+    'zstd': zstd_compressor,
+    'pbz2': parallel_bz2_compressor,
+    'pgzip': parallel_gzip_compressor,
+}
+"""Registry of compressor factories by codec name.
+
+A factory returns an object with the ``compress(data)`` and ``flush()``
+methods of the standard library compressors.
+"""
+
+
+def get_compressor(codec, **options):
+    """Create a compressor for a registered codec."""
+    try:
+        factory = COMPRESSORS[codec]
+    except KeyError:
+        raise ValueError('Unknown compression codec: {0}'.format(codec))
+    return factory(**options)
+
+
+class ProgressStream(object):
+    """Stream wrapper reporting the progress of a result stream.
+
+    :param stream: Result stream.
+    :param progress: :py:class:`~zenodo.modules.exporter.utils.ExportProgress`
+        instance updated on every read.
+    """
+
+    def __init__(self, stream, progress):
+        """Initialize the stream wrapper."""
+        self.stream = stream
+        self.progress = progress
+
+    def read(self, size=-1):
+        """Read from the result stream and update the progress."""
+        count = self.stream.count
+        serialized_bytes = self.stream.serialized_bytes
+        failed = len(self.stream.failed_record_ids)
+        chunk = self.stream.read(size)
+        self.progress.update(
+            records=self.stream.count - count,
+            serialized_bytes=self.stream.serialized_bytes - serialized_bytes,
+            output_bytes=len(chunk),
+            failed=len(self.stream.failed_record_ids) - failed,
+        )
+        return chunk
+
+
+class ConcatStream(object):
+    """Stream that concatenates several file-like objects.
+
+    Used to assemble the parts written by the slices of a sharded export job
+    into a single output. Each part is closed once it has been fully read.
+
+    :param parts: Iterable of file-like objects supporting ``read(size)``.
+    """
+
+    def __init__(self, parts):
+        """Initialize concatenated stream."""
+        self._parts = iter(parts)
+        self._current = None
+
+    def read(self, size=-1):
+        """Read up to ``size`` bytes from the concatenated parts."""
+        while True:
+            if self._current is None:
+                try:
+                    self._current = next(self._parts)
+                except StopIteration:
+                    return b''
+            data = self._current.read(size)
+            if data:
+                return data
+            self._current.close()
+            self._current = None
@@ -26,14 +26,94 @@
 
 from __future__ import absolute_import, print_function
 
-from celery import shared_task
+from celery import chord, shared_task
 from flask import current_app
 
-from .api import Exporter
+from .api import Exporter, FanoutExporter, IncrementalExporter
+from .errors import FailedExportJobError
+from .writers import merge_parts, part_key
+
+
+def _job_definition(job_id):
+    """Get a copy of the job definition, without the scheduling options.
+
+    :raises ValueError: If the job is sliced but its exporter, options or
+        serializer (if it adds a header to the output) do not support slices.
+    """
+    job_definition = dict(
+        current_app.extensions['invenio-exporter'].job(job_id))
+    slices = job_definition.pop('slices', None) or 1
+    exporter_cls = job_definition.pop('exporter_cls', None) or Exporter
+    if slices > 1 and (
+            issubclass(exporter_cls, (IncrementalExporter, FanoutExporter))
+            or job_definition.get('checkpoint_key')
+            or getattr(job_definition.get('serializer'), 'export_header',
+                       None)):
+        raise ValueError(
+            'Export job {0} cannot be sliced.'.format(job_id))
+    return exporter_cls, job_definition, slices
+
+
+def _progress_updater(task):
+    """Get a progress updater which reports metrics in the task state."""
+    def updater(metrics):
+        if task.request.id:
+            task.update_state(state='PROGRESS', meta=metrics)
+    return updater
+
+
+@shared_task(bind=True)
+def export_job(self, job_id=None):
+    """Export job.
+
+    If the job definition has ``slices`` set to more than one, the index is
+    split with a sliced scroll and each slice is exported to a separate part
+    by its own task. Once all slices are done, the parts are assembled into
+    a single output object, and the job fails if some records could not be
+    serialized.
+    """
+    exporter_cls, job_definition, slices = _job_definition(job_id)
+    if slices > 1:
+        key = job_definition['writer'].resolve_key()
+        chord(
+            export_slice_job.si(job_id, key, slice_id, slices)
+            for slice_id in range(slices)
+        )(merge_export_job.s(job_id, key, slices))
+    else:
+        exporter_cls(**job_definition).run(
+            progress_updater=_progress_updater(self))
+
+
+@shared_task(bind=True)
+def export_slice_job(self, job_id, key, slice_id, max_slices):
+    """Export one slice of a sliced export job to its own part.
+
+    :returns: Dictionary with the ids (at most ``max_failed_ids``) and the
+        number of the records which failed to be serialized.
+    """
+    exporter_cls, job_definition, _ = _job_definition(job_id)
+    job_definition['writer'] = job_definition['writer'].copy(
+        part_key(key, slice_id))
+    exporter = exporter_cls(
+        slice_id=slice_id, max_slices=max_slices, **job_definition)
+    exporter.run(progress_updater=_progress_updater(self))
+    return dict(failed_ids=list(exporter.failed_ids.ids),
+                failed_count=len(exporter.failed_ids))
 
 
 @shared_task
-def export_job(job_id=None):
-    """Export job."""
-    job_definition = current_app.extensions['invenio-exporter'].job(job_id)
-    Exporter(**job_definition).run()
+def merge_export_job(results, job_id, key, max_slices):
+    """Assemble the parts of a sliced export job into a single object.
+
+    :param results: Results of the slices' tasks.
+    :raises FailedExportJobError: If records of some slices failed to be
+        serialized (once the parts are assembled).
+    """
+    _, job_definition, _ = _job_definition(job_id)
+    merge_parts(job_definition['writer'], key,
+                [part_key(key, slice_id) for slice_id in range(max_slices)])
+    failed_count = sum(r['failed_count'] for r in results)
+    if failed_count:
+        raise FailedExportJobError(
+            record_ids=[id_ for r in results for id_ in r['failed_ids']],
+            count=failed_count)
@@ -25,6 +25,7 @@
 
 from __future__ import absolute_import, print_function
 
+import time
 from uuid import UUID
 
 from flask import current_app
@@ -32,6 +33,11 @@ from invenio_db import db
 from invenio_files_rest.errors import FilesException
 from invenio_files_rest.models import Bucket, Location
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 def initialize_exporter_bucket():
     """Initialize the bucket for exporter module metadata dumps.
@@ -51,3 +57,78 @@ def initialize_exporter_bucket():
                         default_storage_class=storage_class)
         db.session.add(bucket)
         db.session.commit()
+
+
+def peak_rss():
+    """Get the peak resident memory of the current process in bytes."""
+    if resource is None:
+        return None
+    # On Linux "ru_maxrss" is in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ExportProgress(object):
+    """Progress and throughput metrics of an export job.
+
+    The metrics are reported every ``interval`` seconds (and at the end of
+    the job) to the log and to the optional ``updater`` callable, which for
+    Celery tasks updates the task state.
+
+    :param name: Name of the export (e.g. the output object key).
+    :param updater: Callable receiving the metrics dictionary.
+    :param interval: Reporting interval in seconds.
+    """
+
+    def __init__(self, name=None, updater=None, interval=60):
+        """Initialize the metrics."""
+        self.name = name
+        self.updater = updater
+        self.interval = interval
+        self.records = 0
+        self.failed = 0
+        self.serialized_bytes = 0
+        self.output_bytes = 0
+        self.start_time = time.time()
+        self._last_report = self.start_time
+
+    def update(self, records=0, serialized_bytes=0, output_bytes=0,
+               failed=0):
+        """Update the metrics, and report them if the interval passed."""
+        self.records += records
+        self.failed += failed
+        self.serialized_bytes += serialized_bytes
+        self.output_bytes += output_bytes
+        if time.time() - self._last_report >= self.interval:
+            self.report()
+
+    @property
+    def metrics(self):
+        """Dictionary of the current metrics."""
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return dict(
+            export=self.name,
+            elapsed=round(elapsed, 1),
+            records=self.records,
+            failed=self.failed,
+            serialized_bytes=self.serialized_bytes,
+            output_bytes=self.output_bytes,
+            records_per_sec=round(self.records / elapsed, 1),
+            bytes_per_sec=round(self.output_bytes / elapsed, 1),
+            compression_ratio=(
+                round(float(self.serialized_bytes) / self.output_bytes, 2)
+                if self.serialized_bytes and self.output_bytes else None),
+            peak_rss=peak_rss(),
+        )
+
+    def report(self):
+        """Report the current metrics to the log and the updater."""
+        self._last_report = time.time()
+        metrics = self.metrics
+        current_app.logger.info(
+            'Export {export}: {records} records ({failed} failed) in '
+            '{elapsed}s, {records_per_sec} records/s, {bytes_per_sec} '
+            'bytes/s, compression ratio {compression_ratio}, peak RSS '
+            '{peak_rss} bytes.'.format(**metrics),
+            extra=metrics)
+        if self.updater:
+            self.updater(metrics)
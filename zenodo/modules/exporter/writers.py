@@ -26,45 +26,285 @@
 
 from __future__ import absolute_import, print_function
 
+import errno
+import json
+import os
+import shutil
+import tempfile
 from datetime import datetime
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
+from flask import current_app
 from invenio_db import db
-from invenio_files_rest.models import ObjectVersion
+from invenio_files_rest.models import MultipartObject, ObjectVersion, Part
+from six import BytesIO
+from werkzeug.wsgi import LimitedStream
+
+from .streams import ConcatStream
+
+CHUNK_SIZE = 4 * 1024 * 1024
+"""Default size of the blocks written to the storage (4 MiB)."""
+
+PART_SIZE = 64 * 1024 * 1024
+"""Default size of the parts of multipart uploads (64 MiB)."""
 
 
 class BucketWriter(object):
-    """Export writer that writes to an object in a bucket."""
+    """Export writer that writes to an object in a bucket.
+
+    The data stream is read in blocks of ``chunk_size`` bytes, so that the
+    serialized records are sent to the storage in large writes.
+    """
 
-    def __init__(self, bucket_id=None, key=None, **kwargs):
+    def __init__(self, bucket_id=None, key=None, chunk_size=CHUNK_SIZE,
+                 **kwargs):
         """Initialize writer."""
         self.bucket_id = bucket_id
         self.key = key
+        self.chunk_size = chunk_size
         self.obj = None
 
+    def resolve_key(self):
+        """Get the object key (calling the key factory if needed)."""
+        return self.key() if callable(self.key) else self.key
+
+    def copy(self, key):
+        """Get a writer for the same bucket but a different object key."""
+        return self.__class__(
+            bucket_id=self.bucket_id, key=key, chunk_size=self.chunk_size)
+
     def open(self):
         """Open the bucket for writing."""
-        self.obj = ObjectVersion.create(
-            self.bucket_id,
-            self.key() if callable(self.key) else self.key
-        )
+        self.obj = ObjectVersion.create(self.bucket_id, self.resolve_key())
         db.session.commit()
         return self
 
+    def load_state(self, key):
+        """Load a JSON state object (``None`` if it does not exist)."""
+        obj = ObjectVersion.get(self.bucket_id, key)
+        if obj is None:
+            return None
+        with obj.file.storage().open('rb') as fp:
+            return json.loads(fp.read().decode('utf8'))
+
+    def save_state(self, key, data):
+        """Save a JSON state object (as a new version of the object)."""
+        ObjectVersion.create(self.bucket_id, key, stream=BytesIO(
+            json.dumps(data).encode('utf8')))
+        db.session.commit()
+
+    def read_part(self, key):
+        """Open a previously written object for reading."""
+        obj = ObjectVersion.get(self.bucket_id, key)
+        return obj.file.storage().open('rb')
+
+    def remove_part(self, key):
+        """Remove all versions of a previously written object."""
+        for obj in ObjectVersion.get_versions(self.bucket_id, key).all():
+            file_ = obj.file
+            obj.remove()
+            if file_ is not None:
+                file_.storage().delete()
+                file_.delete()
+        db.session.commit()
+
     def write(self, stream):
         """Write the data stream to the object."""
-        self.obj.set_contents(stream)
+        self.obj.set_contents(stream, chunk_size=self.chunk_size)
 
     def close(self):
         """Close bucket file."""
         db.session.commit()
 
 
+class MultipartWriter(BucketWriter):
+    """Export writer that uploads an object to a bucket in parallel parts.
+
+    The multipart upload API needs the size of the object in advance, so the
+    data stream is first spooled to a local temporary file. The file is then
+    uploaded in parts of ``part_size`` bytes by ``threads`` parallel workers,
+    each with its own storage stream and database session, and the parts are
+    merged into the object. Objects too small for a multipart upload are
+    written in a single request.
+    """
+
+    def __init__(self, bucket_id=None, key=None, chunk_size=CHUNK_SIZE,
+                 part_size=PART_SIZE, threads=4, **kwargs):
+        """Initialize writer."""
+        super(MultipartWriter, self).__init__(
+            bucket_id=bucket_id, key=key, chunk_size=chunk_size)
+        self.part_size = part_size
+        self.threads = threads
+        self.obj_key = None
+
+    def copy(self, key):
+        """Get a writer for the same bucket but a different object key."""
+        return self.__class__(
+            bucket_id=self.bucket_id, key=key, chunk_size=self.chunk_size,
+            part_size=self.part_size, threads=self.threads)
+
+    def open(self):
+        """Open the writer (the object is created once written)."""
+        self.obj_key = self.resolve_key()
+        return self
+
+    def write(self, stream):
+        """Spool the data stream and upload it to the object."""
+        with tempfile.NamedTemporaryFile(prefix='zenodo-export-') as fp:
+            shutil.copyfileobj(stream, fp, self.chunk_size)
+            size = fp.tell()
+            fp.flush()
+            if MultipartObject.is_valid_size(size, self.part_size):
+                self.obj = self._upload_parts(fp.name, size)
+            else:
+                fp.seek(0)
+                self.obj = ObjectVersion.create(
+                    self.bucket_id, self.obj_key, stream=fp, size=size,
+                    chunk_size=self.chunk_size)
+        db.session.commit()
+
+    def _upload_parts(self, path, size):
+        """Upload a file with a multipart upload."""
+        mp = MultipartObject.create(
+            self.bucket_id, self.obj_key, size, self.part_size)
+        db.session.commit()
+        upload_part = partial(
+            self._upload_part, current_app._get_current_object(), path,
+            mp.upload_id)
+        pool = ThreadPool(self.threads)
+        try:
+            pool.map(upload_part, range(mp.last_part_number + 1))
+        except Exception:
+            mp.delete()
+            db.session.commit()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        mp = MultipartObject.get(self.bucket_id, self.obj_key, mp.upload_id)
+        mp.complete()
+        return mp.merge_parts()
+
+    def _upload_part(self, app, path, upload_id, part_number):
+        """Upload one part of a multipart upload (in a worker thread)."""
+        with app.app_context():
+            mp = MultipartObject.get(self.bucket_id, self.obj_key, upload_id)
+            with open(path, 'rb') as fp:
+                fp.seek(part_number * self.part_size)
+                Part.create(mp, part_number, stream=LimitedStream(
+                    fp, self.part_size))
+            db.session.commit()
+
+
+class FilesystemWriter(object):
+    """Export writer that writes to a file in a local (or NFS) directory.
+
+    The data is written to a temporary file in the same directory, which is
+    renamed to the final file name once the whole stream has been written.
+    Readers thus never see a partial export, and a failed export leaves no
+    file behind. State files are replaced atomically in the same way.
+    """
+
+    def __init__(self, path=None, key=None, chunk_size=CHUNK_SIZE, **kwargs):
+        """Initialize writer."""
+        self.path = path
+        self.key = key
+        self.chunk_size = chunk_size
+        self.fp = None
+        self._filename = None
+        self._tmp_path = None
+        self._complete = False
+
+    def resolve_key(self):
+        """Get the file name (calling the key factory if needed)."""
+        return self.key() if callable(self.key) else self.key
+
+    def copy(self, key):
+        """Get a writer for the same directory but a different file name."""
+        return self.__class__(
+            path=self.path, key=key, chunk_size=self.chunk_size)
+
+    def _join(self, key):
+        """Get the path of a file in the directory."""
+        return os.path.join(self.path, key)
+
+    def _open_temporary(self, key):
+        """Open a temporary file next to the given file."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.{0}.'.format(key), suffix='.tmp', dir=self.path)
+        return os.fdopen(fd, 'wb'), tmp_path
+
+    def open(self):
+        """Open a temporary file for writing."""
+        self._filename = self._join(self.resolve_key())
+        self.fp, self._tmp_path = self._open_temporary(
+            os.path.basename(self._filename))
+        self._complete = False
+        return self
+
+    def write(self, stream):
+        """Write the data stream to the temporary file."""
+        shutil.copyfileobj(stream, self.fp, self.chunk_size)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self._complete = True
+
+    def close(self):
+        """Close the file, and move it to its final name if complete."""
+        self.fp.close()
+        if self._complete:
+            os.rename(self._tmp_path, self._filename)
+        else:
+            os.remove(self._tmp_path)
+
+    def load_state(self, key):
+        """Load a JSON state file (``None`` if it does not exist)."""
+        try:
+            with open(self._join(key), 'rb') as fp:
+                return json.loads(fp.read().decode('utf8'))
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def save_state(self, key, data):
+        """Save a JSON state file (atomically replacing the previous one)."""
+        fp, tmp_path = self._open_temporary(key)
+        with fp:
+            fp.write(json.dumps(data).encode('utf8'))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, self._join(key))
+
+    def read_part(self, key):
+        """Open a previously written file for reading."""
+        return open(self._join(key), 'rb')
+
+    def remove_part(self, key):
+        """Remove a previously written file."""
+        try:
+            os.remove(self._join(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
 class NullWriter(object):
     """Export writer that does not write anywhere."""
 
     def __init__(self, **kwargs):
         """Initialize writer."""
 
+    def resolve_key(self):
+        """Dummy key."""
+
+    def copy(self, key):
+        """Dummy copy."""
+        return self
+
     def open(self):
         """Dummy open."""
         return self
@@ -75,6 +315,47 @@ class NullWriter(object):
     def close(self):
         """Dummy close."""
 
+    def load_state(self, key):
+        """Dummy state load."""
+
+    def save_state(self, key, data):
+        """Dummy state save."""
+
+    def read_part(self, key):
+        """Dummy read."""
+        return BytesIO()
+
+    def remove_part(self, key):
+        """Dummy remove."""
+
+
+def part_key(key, slice_id):
+    """Get the object key of one part of a sliced export."""
+    return '{key}.part-{slice_id:04d}'.format(key=key, slice_id=slice_id)
+
+
+def merge_parts(writer, key, part_keys, remove=True):
+    """Assemble the parts of an export into a single object.
+
+    Compressed parts are concatenated as they are (both BZip2 and GZip
+    support multi-stream files), so no data is recompressed. Unless
+    ``remove`` is ``False``, the parts are removed once the object has been
+    written (parts which were already removed are ignored).
+    """
+    fp = writer.copy(key).open()
+    try:
+        fp.write(ConcatStream(writer.read_part(k) for k in part_keys))
+    finally:
+        fp.close()
+    if remove:
+        for k in part_keys:
+            writer.remove_part(k)
+
+
+def tombstones_key(key):
+    """Get the object key of the deleted records list of a delta export."""
+    return '{key}.deleted.json'.format(key=key)
+
 
 def filename_factory(**kwargs):
     """Get a function which generates a filename with a timestamp."""
@@ -122,6 +122,30 @@ Wrong DOIs were minted for a short period in 2013 due to mistake in the legacy
 system.
 """
 
+ZENODO_RECORDS_VERSIONS_CACHE_TIMEOUT = 24 * 60 * 60
+"""Time in seconds during which the DOIs of the versions of a concept are
+cached (they are also removed when a version is published or deleted)."""
+
+ZENODO_RECORDS_INDEXER_PREFETCH_SIZE = 500
+"""Number of bulk indexed records whose PIDs, relations and stats are fetched
+at once."""
+
+ZENODO_RECORDS_REFS_CACHED = [
+    (r'^https?://dx\.zenodo\.org/licenses/(.+)$', 'od_lic'),
+    (r'^https?://dx\.zenodo\.org/grants/(10\.13039/.+)$', 'grant'),
+    (r'^https?://(?:dx\.)?doi\.org/(10\.13039/[^/]+)$', 'frdoi'),
+]
+"""Patterns of the JSON references resolved through the references cache, and
+type of the PID (matched by the first group) of the referenced records."""
+
+ZENODO_RECORDS_REFS_CACHE_SIZE = 20000
+"""Maximum number of referenced documents cached by each process (0 disables
+the cache)."""
+
+ZENODO_RECORDS_REFS_CACHE_CHECK_INTERVAL = 10
+"""Time in seconds between checks of the version of the cached referenced
+documents (i.e. how long other processes can use a modified document)."""
+
 ZENODO_CUSTOM_METADATA_TERM_TYPES = {
     'keyword': six.string_types,
     'text': six.string_types,
@@ -30,15 +30,18 @@ import collections
 
 from invenio_indexer.signals import before_record_index
 from invenio_pidrelations.contrib.versioning import versioning_blueprint
+from invenio_records.signals import after_record_delete, after_record_update
 from six import itervalues
 from werkzeug.utils import cached_property
 
 from zenodo.modules.records.models import ObjectType
+from zenodo.modules.utils.common import register_after_transaction
 
 from . import config
 from .custom_metadata import CustomMetadataAPI
 from .indexer import indexer_receiver
 from .proxies import current_zenodo_records
+from .refs import cached_loader_factory, invalidate_refs_receiver
 from .utils import serialize_record, transform_record
 from .views import blueprint, record_jinja_context
 
@@ -96,6 +99,16 @@ class ZenodoRecords(object):
         )
 
         before_record_index.connect(indexer_receiver, sender=app)
+        register_after_transaction()
+
+        # Cache the licenses, grants and funders referenced by records
+        records_state = app.extensions.get('invenio-records')
+        if records_state:
+            records_state.loader_cls = cached_loader_factory(
+                records_state.loader_cls)
+        # Only existing records are cached, so inserts don't invalidate them
+        for signal in (after_record_update, after_record_delete):
+            signal.connect(invalidate_refs_receiver, sender=app)
         app.extensions['zenodo-records'] = self
 
     @staticmethod
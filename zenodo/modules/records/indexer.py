@@ -26,20 +26,255 @@
 
 from __future__ import absolute_import, print_function
 
+import operator
+import uuid
+from collections import defaultdict
+
+from elasticsearch import VERSION as ES_VERSION
+from elasticsearch.helpers import expand_action as default_expand_action
+from elasticsearch.helpers import bulk
+from flask import current_app
+from invenio_db import db
+from invenio_indexer.api import RecordIndexer
+from invenio_indexer.utils import _es7_expand_action
 from invenio_pidrelations.contrib.versioning import PIDVersioning
-from invenio_pidrelations.proxies import current_pidrelations
+from invenio_pidrelations.models import PIDRelation
 from invenio_pidrelations.serializers.utils import serialize_relations
-from invenio_pidstore.models import PersistentIdentifier
+from invenio_pidrelations.utils import resolve_relation_type_config
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_records.api import Record
+from invenio_records.models import RecordMetadata
+from invenio_search import current_search, current_search_client
+from invenio_search.utils import build_alias_name, timestamp_suffix
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.exc import NoResultFound
 
+from zenodo.modules.records.refs import prefetch_refs
 from zenodo.modules.records.serializers.pidrelations import \
     serialize_related_identifiers
 from zenodo.modules.records.utils import build_record_custom_fields
-from zenodo.modules.stats.utils import build_record_stats
+from zenodo.modules.stats.utils import build_record_stats, \
+    build_records_stats, chunkify
+
+
+def _indexing_data(record):
+    """Fetch the data added to a record by the indexer receiver."""
+    pid = PersistentIdentifier.query.filter(
+        PersistentIdentifier.pid_value == str(record['recid']),
+        PersistentIdentifier.pid_type == 'recid',
+        PersistentIdentifier.object_uuid == record.id,
+    ).one_or_none()
+    relations, related_identifiers = None, []
+    if pid:
+        pv = PIDVersioning(child=pid)
+        if pv.exists:
+            relations = serialize_relations(pid)
+        else:
+            relations = {'version': [{'is_last': True, 'index': 0}, ]}
+        related_identifiers = serialize_related_identifiers(pid)
+    return dict(
+        relations=relations,
+        related_identifiers=related_identifiers,
+        stats=build_record_stats(record['recid'], record.get('conceptrecid')),
+    )
+
+
+class _PrefetchedQuery(object):
+    """Query-like list of prefetched PIDs."""
+
+    def __init__(self, pids):
+        """Initialize the query."""
+        self._pids = list(pids)
+
+    def all(self):
+        """Get the PIDs."""
+        return list(self._pids)
+
+    def count(self):
+        """Get the number of PIDs."""
+        return len(self._pids)
+
+
+class _PrefetchedVersioning(object):
+    """Version relation of a PID, built from prefetched PIDs.
+
+    Provides what the configured relation schema (``VersionRelation``) reads
+    from :class:`~invenio_pidrelations.contrib.versioning.PIDVersioning`, so
+    that the relations are serialized by the same schema as with
+    :func:`~invenio_pidrelations.serializers.utils.serialize_relations`.
+    """
+
+    is_ordered = True
+
+    def __init__(self, relation_type, parent, child, index, children,
+                 draft_child=None, draft_child_deposit=None):
+        """Initialize the relation.
+
+        :param children: List of ``(index, pid)`` tuples of the registered
+            children, ordered by index.
+        """
+        self.relation_type = relation_type
+        self.parent = parent
+        self.child = child
+        self.index = index
+        self.children = _PrefetchedQuery(pid for _, pid in children)
+        self.draft_child = draft_child
+        self.draft_child_deposit = draft_child_deposit
+        indexed = [pid for index, pid in children if index is not None]
+        self.last_child = indexed[-1] if indexed else None
+
+    def serialize(self):
+        """Serialize the relation as ``serialize_relations`` does."""
+        rel_cfg = resolve_relation_type_config(self.relation_type)
+        schema = rel_cfg.schema()
+        schema.context['pid'] = self.child
+        result, errors = schema.dump(self)
+        return {rel_cfg.name: [result]}
+
+
+def prefetch_indexing_data(records):
+    """Fetch the data added to several records by the indexer receiver.
+
+    The recids, the version relations and the statistics of the records are
+    fetched with a few queries for all of them, instead of several queries
+    for each record.
+
+    :param records: Records about to be indexed.
+    :returns: Dictionary of the data of each record, by record id. Records
+        with unusual relations (e.g. being the parent of other versions) are
+        left out, so that the receiver fetches their data itself.
+    """
+    records = dict((str(r.id), r) for r in records if r.get('recid'))
+    if not records:
+        return {}
+    version_type = resolve_relation_type_config('version').id
+    draft_type = resolve_relation_type_config('record_draft').id
+
+    pids = {}
+    query = PersistentIdentifier.query.filter(
+        PersistentIdentifier.pid_type == 'recid',
+        PersistentIdentifier.object_uuid.in_(list(records)),
+    )
+    recids = {}
+    for pid in query:
+        record_id = str(pid.object_uuid)
+        if pid.pid_value == str(records[record_id]['recid']):
+            pids[pid.id] = record_id
+            recids[pid.id] = pid
+
+    # Parents of the recids (i.e. the conceptrecids)
+    parents = {}
+    skipped = set()
+    if pids:
+        Parent = aliased(PersistentIdentifier)
+        rows = db.session.query(PIDRelation.child_id, Parent).join(
+            Parent, Parent.id == PIDRelation.parent_id
+        ).filter(
+            PIDRelation.relation_type == version_type,
+            PIDRelation.child_id.in_(list(pids)),
+        )
+        for child_id, parent in rows:
+            if child_id in parents:
+                skipped.add(child_id)
+            parents[child_id] = parent
+        # Recids which are parents themselves
+        rows = db.session.query(PIDRelation.parent_id).filter(
+            PIDRelation.relation_type == version_type,
+            PIDRelation.parent_id.in_(list(pids)),
+        )
+        skipped.update(row[0] for row in rows)
+
+    # All the versions of each parent
+    versions = defaultdict(list)
+    if parents:
+        Child = aliased(PersistentIdentifier)
+        rows = db.session.query(
+            PIDRelation.parent_id, PIDRelation.index, Child
+        ).join(
+            Child, Child.id == PIDRelation.child_id
+        ).filter(
+            PIDRelation.relation_type == version_type,
+            PIDRelation.parent_id.in_(
+                list(set(p.id for p in parents.values()))),
+        )
+        for parent_id, index, child in rows:
+            versions[parent_id].append((index, child))
+
+    concepts = {}
+    for parent_id, children in versions.items():
+        # Same order as "PIDVersioning.children" (NULL indexes last)
+        registered = sorted(
+            ((index, child) for index, child in children
+             if child.status == PIDStatus.REGISTERED),
+            key=lambda c: (c[0] is None, c[0]))
+        drafts = [child for index, child in children
+                  if index is not None and child.status == PIDStatus.RESERVED]
+        concepts[parent_id] = dict(
+            registered=registered,
+            indexes=dict((child.id, index) for index, child in children),
+            drafts=drafts,
+        )
+
+    # Deposits of the draft versions
+    deposits = {}
+    draft_ids = [d.id for c in concepts.values() for d in c['drafts']]
+    if draft_ids:
+        Child = aliased(PersistentIdentifier)
+        rows = db.session.query(PIDRelation.parent_id, Child).join(
+            Child, Child.id == PIDRelation.child_id
+        ).filter(
+            PIDRelation.relation_type == draft_type,
+            PIDRelation.parent_id.in_(draft_ids),
+        )
+        for parent_id, deposit in rows:
+            deposits[parent_id] = deposit
+
+    data = dict((record_id, dict(relations=None, related_identifiers=[]))
+                for record_id in records)
+    for pid_id, record_id in pids.items():
+        parent = parents.get(pid_id)
+        if pid_id in skipped:
+            del data[record_id]
+            continue
+        if parent is None:
+            data[record_id]['relations'] = \
+                {'version': [{'is_last': True, 'index': 0}, ]}
+            continue
+        concept = concepts[parent.id]
+        if len(concept['drafts']) > 1:
+            del data[record_id]
+            continue
+        draft = concept['drafts'][0] if concept['drafts'] else None
+        data[record_id]['relations'] = _PrefetchedVersioning(
+            version_type, parent, recids[pid_id],
+            concept['indexes'][pid_id], concept['registered'],
+            draft_child=draft,
+            draft_child_deposit=deposits.get(draft.id) if draft else None,
+        ).serialize()
+        record = records[record_id]
+        # External DOI records don't have Concept DOI
+        if 'conceptdoi' in record:
+            data[record_id]['related_identifiers'] = [{
+                'scheme': 'doi',
+                'relation': 'isVersionOf',
+                'identifier': record['conceptdoi'],
+            }]
+
+    stats = build_records_stats(
+        [(records[record_id]['recid'], records[record_id].get('conceptrecid'))
+         for record_id in data])
+    for record_id, record_data in data.items():
+        record_data['stats'] = stats[records[record_id]['recid']]
+    return data
 
 
 def indexer_receiver(sender, json=None, record=None, index=None,
-                     **dummy_kwargs):
-    """Connect to before_record_index signal to transform record for ES."""
+                     prefetched=None, **dummy_kwargs):
+    """Connect to before_record_index signal to transform record for ES.
+
+    :param prefetched: Data of the records, prefetched with
+        :func:`prefetch_indexing_data` by :class:`ZenodoRecordIndexer`.
+    """
     if not index.startswith('records-') or record.get('$schema') is None:
         return
 
@@ -52,23 +287,12 @@ def indexer_receiver(sender, json=None, record=None, index=None,
         json['filecount'] = len(files)
         json['size'] = sum([f.get('size', 0) for f in files])
 
-    pid = PersistentIdentifier.query.filter(
-        PersistentIdentifier.pid_value == str(record['recid']),
-        PersistentIdentifier.pid_type == 'recid',
-        PersistentIdentifier.object_uuid == record.id,
-    ).one_or_none()
-    if pid:
-        pv = PIDVersioning(child=pid)
-        if pv.exists:
-            relations = serialize_relations(pid)
-        else:
-            relations = {'version': [{'is_last': True, 'index': 0}, ]}
-        if relations:
-            json['relations'] = relations
-
-        rels = serialize_related_identifiers(pid)
-        if rels:
-            json.setdefault('related_identifiers', []).extend(rels)
+    data = (prefetched or {}).get(str(record.id)) or _indexing_data(record)
+    if data['relations']:
+        json['relations'] = data['relations']
+    if data['related_identifiers']:
+        json.setdefault('related_identifiers', []).extend(
+            data['related_identifiers'])
 
     for loc in json.get('locations', []):
         if loc.get('lat') and loc.get('lon'):
@@ -78,9 +302,228 @@ def indexer_receiver(sender, json=None, record=None, index=None,
     if '_internal' in json:
         del json['_internal']
 
-    json['_stats'] = build_record_stats(record['recid'],
-                                        record.get('conceptrecid'))
+    json['_stats'] = data['stats']
 
     custom_es_fields = build_record_custom_fields(json)
     for es_field, es_value in custom_es_fields.items():
         json[es_field] = es_value
+
+
+class ZenodoRecordIndexer(RecordIndexer):
+    """Record indexer prefetching the data of the bulk indexed records.
+
+    The messages of the bulk indexing queue are processed in chunks of
+    ``prefetch_size``: the records of a chunk are loaded with a single query,
+    and the data added by :func:`indexer_receiver` is prefetched for all of
+    them with :func:`prefetch_indexing_data`.
+    """
+
+    def __init__(self, prefetch_size=None, **kwargs):
+        """Initialize the indexer."""
+        super(ZenodoRecordIndexer, self).__init__(**kwargs)
+        self.prefetch_size = prefetch_size
+        self._records = {}
+        self._prefetched = {}
+
+    def _prefetch(self, messages):
+        """Load the records of a chunk of messages and their data."""
+        self._prefetch_records([m.decode()['id'] for m in messages
+                                if m.decode()['op'] != 'delete'])
+
+    def _prefetch_records(self, ids):
+        """Load records and their data."""
+        try:
+            self._records = dict(
+                (str(r.id), r) for r in Record.get_records(ids))
+            prefetch_refs(self._records.values())
+            self._prefetched = prefetch_indexing_data(
+                r for r in self._records.values()
+                if self.record_to_index(r)[0].startswith('records-'))
+        except Exception:
+            # Fall back to fetching the data of each record
+            current_app.logger.warning(
+                'Failed to prefetch the records to index.', exc_info=True)
+            self._records, self._prefetched = {}, {}
+
+    def _actionsiter(self, message_iterator):
+        """Iterate bulk actions, prefetching each chunk of messages."""
+        prefetch_size = self.prefetch_size or \
+            current_app.config['ZENODO_RECORDS_INDEXER_PREFETCH_SIZE']
+        for messages in chunkify(message_iterator, prefetch_size):
+            self._prefetch(messages)
+            for action in super(ZenodoRecordIndexer, self)._actionsiter(
+                    messages):
+                yield action
+        self._records, self._prefetched = {}, {}
+
+    def _index_action(self, payload):
+        """Bulk index action, with the prefetched record and data."""
+        record = self._records.get(payload['id'])
+        if record is None:
+            return super(ZenodoRecordIndexer, self)._index_action(payload)
+        index, doc_type = self.record_to_index(record)
+
+        arguments = {}
+        body = self._prepare_record(record, index, doc_type, arguments,
+                                    prefetched=self._prefetched)
+        index, doc_type = self._prepare_index(index, doc_type)
+
+        action = {
+            '_op_type': 'index',
+            '_index': index,
+            '_type': doc_type,
+            '_id': str(record.id),
+            '_version': record.revision_id,
+            '_version_type': self._version_type,
+            '_source': body
+        }
+        action.update(arguments)
+        return action
+
+    def reindex(self, chunks, index, target=None, es_bulk_kwargs=None):
+        """Index records directly in Elasticsearch, without the bulk queue.
+
+        :param chunks: Iterator yielding lists of record UUIDs. The records
+            of each list are prefetched together.
+        :param index: Only the records belonging to this index are indexed.
+        :param target: Index where to index the records, instead of the
+            alias of ``index`` (e.g. a new index to swap it with).
+        :param dict es_bulk_kwargs: Passed to
+            :func:`elasticsearch:elasticsearch.helpers.bulk`.
+        :returns: Tuple with the number of indexed records and of errors.
+            The records which could not be serialized are logged, skipped
+            and counted as errors.
+        """
+        failed = []
+
+        def _actions():
+            for ids in chunks:
+                self._prefetch_records(ids)
+                for id_ in ids:
+                    try:
+                        action = self._reindex_action(str(id_), index)
+                    except Exception:
+                        current_app.logger.exception(
+                            'Failed to reindex record %s.', id_)
+                        failed.append(id_)
+                        continue
+                    if action is None:
+                        continue
+                    if target:
+                        action['_index'] = target
+                    yield action
+            self._records, self._prefetched = {}, {}
+
+        indexed, errors = bulk(
+            self.client,
+            _actions(),
+            stats_only=True,
+            request_timeout=current_app.config[
+                'INDEXER_BULK_REQUEST_TIMEOUT'],
+            expand_action_callback=(
+                _es7_expand_action if ES_VERSION[0] >= 7
+                else default_expand_action
+            ),
+            **(es_bulk_kwargs or {})
+        )
+        return indexed, errors + len(failed)
+
+    def _reindex_action(self, id_, index):
+        """Bulk index action of a record, if it belongs to the index."""
+        record = self._records.get(id_)
+        if record is None:
+            # Not prefetched: deleted since, or the prefetching failed
+            try:
+                record = self._records[id_] = self.record_cls.get_record(id_)
+            except NoResultFound:
+                return None
+        if self.record_to_index(record)[0] != index:
+            return None
+        return self._index_action({'id': id_, 'op': 'index'})
+
+
+def uuid_ranges(partitions):
+    """Split the UUID space in ranges of the same size.
+
+    :returns: List of ``(start, end)`` tuples of UUID strings, where the
+        start is included and the end excluded. The end of the last range is
+        ``None``.
+    """
+    step = 2 ** 128 // partitions
+    bounds = [str(uuid.UUID(int=i * step)) for i in range(partitions)]
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def iter_record_ids(start, end=None, chunk_size=500):
+    """Iterate by chunks the UUIDs of the (not deleted) records of a range."""
+    query = db.session.query(RecordMetadata.id).filter(
+        RecordMetadata.json.isnot(None)).order_by(RecordMetadata.id)
+    if end:
+        query = query.filter(RecordMetadata.id < end)
+    last, op = start, operator.ge
+    while True:
+        ids = [id_ for id_, in query.filter(
+            op(RecordMetadata.id, last)).limit(chunk_size)]
+        if not ids:
+            return
+        yield [str(id_) for id_ in ids]
+        last, op = ids[-1], operator.gt
+
+
+def create_reindex_index(index):
+    """Create a new index, without aliases, to reindex an index into.
+
+    :returns: Name of the new index.
+    """
+    (name, _), _ = current_search.create_index(
+        index, suffix=timestamp_suffix(), create_write_alias=False)
+    return name
+
+
+def update_index_settings(index, settings):
+    """Update the settings of an index.
+
+    :param index: Name of the index (or alias).
+    :param settings: Dictionary of the ``index.*`` settings to update.
+    :returns: Dictionary with the previous values of the settings, ``None``
+        for the ones not explicitly set, so that they can be restored.
+    """
+    names = ['index.{0}'.format(k) for k in settings]
+    response = current_search_client.indices.get_settings(
+        index=index, name=names, flat_settings=True)
+    previous = {}
+    for values in response.values():
+        previous.update(values['settings'])
+    current_search_client.indices.put_settings(
+        index=index, body={'index': settings})
+    return dict((k, previous.get('index.{0}'.format(k))) for k in settings)
+
+
+def swap_index_aliases(index, new_index):
+    """Atomically move the aliases of an index to a new index.
+
+    The indices pointed by the alias of ``index`` lose all their aliases,
+    which are added to ``new_index``. An index named as the alias (i.e.
+    created without suffix) is deleted, in the same operation.
+
+    :param index: Name of the index (without prefix nor suffix).
+    :param new_index: Name of the new index.
+    :returns: List of the names of the old indices which were kept.
+    """
+    alias = build_alias_name(index)
+    old_aliases = current_search_client.indices.get_alias(index=alias)
+    actions, kept = [], []
+    for old_index, values in old_aliases.items():
+        names = set(values['aliases'])
+        if old_index == alias:
+            actions.append({'remove_index': {'index': old_index}})
+            names.add(alias)
+        else:
+            kept.append(old_index)
+        for name in sorted(names):
+            if old_index != alias:
+                actions.append(
+                    {'remove': {'index': old_index, 'alias': name}})
+            actions.append({'add': {'index': new_index, 'alias': name}})
+    current_search_client.indices.update_aliases(body={'actions': actions})
+    return kept
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Cache of the documents referenced by records (licenses, grants, etc.)."""
+
+from __future__ import absolute_import, print_function
+
+import copy
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+from flask import current_app
+from invenio_cache import current_cache
+from invenio_db import db
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_records.models import RecordMetadata
+from six import string_types
+
+from zenodo.modules.utils import after_transaction
+
+REFS_VERSION_KEY = 'records_refs:version'
+"""Cache key of the version of the referenced documents."""
+
+REFS_SCHEMAS = re.compile(r'/schemas/(funders|grants|licenses)/')
+"""Pattern of the schemas of the records cached as referenced documents."""
+
+
+class RefsCache(object):
+    """Process-wide, size-bounded cache of referenced documents.
+
+    The least recently used documents are evicted once there are more than
+    ``ZENODO_RECORDS_REFS_CACHE_SIZE`` of them. The documents are cached for
+    a version, shared by all processes through the Invenio-Cache, and are
+    discarded when it changes, i.e. when a referenced record is created,
+    updated or deleted.
+    """
+
+    def __init__(self):
+        """Initialize the cache."""
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0
+
+    @property
+    def version(self):
+        """Get the version of the cached documents.
+
+        The shared version is checked at most every
+        ``ZENODO_RECORDS_REFS_CACHE_CHECK_INTERVAL`` seconds.
+        """
+        now = time.time()
+        interval = current_app.config[
+            'ZENODO_RECORDS_REFS_CACHE_CHECK_INTERVAL']
+        if now - self._checked >= interval:
+            version = current_cache.get(REFS_VERSION_KEY)
+            with self._lock:
+                if version != self._version:
+                    self._docs.clear()
+                    self._version = version
+                self._checked = now
+        return self._version
+
+    def get(self, uri):
+        """Get a copy of a cached document (``None`` if not cached)."""
+        self.version
+        with self._lock:
+            doc = self._docs.pop(uri, None)
+            if doc is not None:
+                self._docs[uri] = doc
+        return copy.deepcopy(doc)
+
+    def set(self, uri, doc, version):
+        """Cache a copy of a document, if loaded for the current version."""
+        size = current_app.config['ZENODO_RECORDS_REFS_CACHE_SIZE']
+        doc = copy.deepcopy(doc)
+        with self._lock:
+            if version != self._version:
+                return
+            self._docs.pop(uri, None)
+            self._docs[uri] = doc
+            while len(self._docs) > size:
+                self._docs.popitem(last=False)
+
+    def invalidate(self):
+        """Discard the cached documents, in all processes."""
+        current_cache.set(REFS_VERSION_KEY, uuid.uuid4().hex, timeout=-1)
+        with self._lock:
+            self._docs.clear()
+            self._checked = 0
+
+    def __contains__(self, uri):
+        """Check if a document is cached."""
+        return uri in self._docs
+
+    def __len__(self):
+        """Get the number of cached documents."""
+        return len(self._docs)
+
+
+refs_cache = RefsCache()
+
+
+def cached_ref_pid(uri):
+    """Get the PID of the record referenced by a cached reference.
+
+    :returns: Tuple of the PID type and value, or ``None`` if the reference
+        is not cached.
+    """
+    for pattern, pid_type in current_app.config['ZENODO_RECORDS_REFS_CACHED']:
+        match = re.match(pattern, uri)
+        if match:
+            return pid_type, match.group(1)
+    return None
+
+
+def cached_loader_factory(loader_cls):
+    """Create a JSON loader caching the cached references in ``refs_cache``.
+
+    :param loader_cls: Loader class of Invenio-Records.
+    """
+    class CachedJsonLoader(loader_cls):
+        """JSON loader caching the referenced licenses, grants and funders."""
+
+        def get_remote_json(self, uri, **kwargs):
+            """Get a referenced document, from the cache if possible."""
+            if not current_app.config['ZENODO_RECORDS_REFS_CACHE_SIZE'] or \
+                    not cached_ref_pid(uri):
+                return super(CachedJsonLoader, self).get_remote_json(
+                    uri, **kwargs)
+            version = refs_cache.version
+            doc = refs_cache.get(uri)
+            if doc is None:
+                doc = dict(super(CachedJsonLoader, self).get_remote_json(
+                    uri, **kwargs))
+                refs_cache.set(uri, doc, version)
+            return doc
+
+    return CachedJsonLoader
+
+
+def _iter_refs(obj):
+    """Iterate the references of a JSON document."""
+    if isinstance(obj, dict):
+        if isinstance(obj.get('$ref'), string_types):
+            yield obj['$ref']
+        else:
+            for value in obj.values():
+                for ref in _iter_refs(value):
+                    yield ref
+    elif isinstance(obj, list):
+        for value in obj:
+            for ref in _iter_refs(value):
+                yield ref
+
+
+def prefetch_refs(records):
+    """Cache the documents referenced by many records at once.
+
+    The referenced records are fetched with one query per PID type, and so
+    are the records they reference in turn (e.g. the funders of grants).
+
+    :param records: Iterable of records (or any JSON).
+    """
+    if not current_app.config['ZENODO_RECORDS_REFS_CACHE_SIZE']:
+        return
+    version = refs_cache.version
+    uris = set(ref for record in records for ref in _iter_refs(record))
+    seen = set()
+    while uris:
+        seen.update(uris)
+        pids = defaultdict(lambda: defaultdict(list))
+        for uri in uris:
+            pid = cached_ref_pid(uri)
+            if pid and uri not in refs_cache:
+                pids[pid[0]][pid[1]].append(uri)
+        uris = set()
+        for pid_type, values in pids.items():
+            rows = db.session.query(
+                PersistentIdentifier.pid_value, RecordMetadata.json).join(
+                RecordMetadata,
+                RecordMetadata.id == PersistentIdentifier.object_uuid).filter(
+                PersistentIdentifier.pid_type == pid_type,
+                PersistentIdentifier.pid_value.in_(list(values)),
+                PersistentIdentifier.object_type == 'rec',
+                PersistentIdentifier.status == PIDStatus.REGISTERED,
+                RecordMetadata.json.isnot(None),
+            )
+            for pid_value, json in rows:
+                for uri in values[pid_value]:
+                    refs_cache.set(uri, json, version)
+                uris.update(_iter_refs(json))
+        uris -= seen
+
+
+def invalidate_refs_receiver(sender, record=None, **kwargs):
+    """Invalidate the cached references when a referenced record changes.
+
+    The cache is invalidated on the first change of a transaction (e.g. of
+    a batch of harvested grants), and again once the transaction ends,
+    since the previous documents may have been cached in the meantime.
+    """
+    schema = record.get('$schema')
+    if isinstance(schema, string_types) and REFS_SCHEMAS.search(schema):
+        if after_transaction(REFS_VERSION_KEY, refs_cache.invalidate):
+            refs_cache.invalidate()
@@ -39,6 +39,7 @@ from zenodo.modules.records.serializers.dc import ZenodoDublinCoreSerializer
 from zenodo.modules.records.serializers.marc21 import ZenodoMARCXMLSerializer
 
 from .bibtex import BibTeXSerializer
+from .columnar import ZenodoColumnarSerializer as ColumnarSerializer
 from .dcat import DCATSerializer
 from .extra_formats import ExtraFormatsSerializer
 from .files import files_responsify
@@ -106,6 +107,8 @@ schemaorg_jsonld_v1 = ZenodoSchemaOrgSerializer(replace_refs=True)
 extra_formats_v1 = ExtraFormatsSerializer()
 #: GeoJSON serializer
 geojson_v1 = GeoJSONSerializer(replace_refs=False)
+#: Columnar (flat rows) serializer for Parquet/Arrow exports
+columnar_v1 = ColumnarSerializer(RecordSchemaV1, replace_refs=True)
 
 # Records-REST serializers
 # ========================
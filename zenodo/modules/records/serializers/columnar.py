@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Zenodo columnar (flat rows) serializer."""
+
+from __future__ import absolute_import, print_function
+
+from .json import ZenodoJSONSerializer
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class ZenodoColumnarSerializer(ZenodoJSONSerializer):
+    """Zenodo columnar serializer.
+
+    Serializes records with the JSON schema, and flattens the result into a
+    row of scalar (or list of strings) columns, suitable for columnar formats
+    such as Parquet or Arrow.
+    """
+
+    columns = (
+        ('recid', 'int64'),
+        ('conceptrecid', 'string'),
+        ('doi', 'string'),
+        ('conceptdoi', 'string'),
+        ('title', 'string'),
+        ('resource_type', 'string'),
+        ('access_right', 'string'),
+        ('communities', 'list<string>'),
+        ('creators', 'list<string>'),
+        ('publication_date', 'string'),
+        ('file_count', 'int64'),
+        ('file_size', 'int64'),
+    )
+    """Names and types of the columns."""
+
+    export_fields = [
+        'recid', 'conceptrecid', 'doi', 'conceptdoi', 'title',
+        'resource_type', 'access_right', 'communities', 'creators',
+        'publication_date', 'relations', '_files', '_buckets', '_stats',
+        '_created', '_updated',
+    ]
+    """Source fields needed to serialize a search hit for export."""
+
+    def arrow_schema(self):
+        """Get the Arrow schema of the rows."""
+        if pyarrow is None:
+            raise RuntimeError(
+                'Columnar serialization requires the "pyarrow" package.')
+        types = {
+            'int64': pyarrow.int64(),
+            'string': pyarrow.string(),
+            'list<string>': pyarrow.list_(pyarrow.string()),
+        }
+        return pyarrow.schema(
+            [pyarrow.field(name, types[type_]) for name, type_ in self.columns])
+
+    @staticmethod
+    def flatten(data):
+        """Flatten a record serialized with the JSON schema into a row."""
+        metadata = data.get('metadata', {})
+        resource_type = metadata.get('resource_type', {})
+        files = data.get('files') or []
+        return dict(
+            recid=data.get('id'),
+            conceptrecid=data.get('conceptrecid'),
+            doi=data.get('doi'),
+            conceptdoi=data.get('conceptdoi'),
+            title=metadata.get('title'),
+            resource_type='/'.join(filter(None, (
+                resource_type.get('type'), resource_type.get('subtype')
+            ))) or None,
+            access_right=metadata.get('access_right'),
+            communities=[c['id'] for c in metadata.get('communities', [])],
+            creators=[c['name'] for c in metadata.get('creators', [])],
+            publication_date=metadata.get('publication_date'),
+            file_count=len(files),
+            file_size=sum(f.get('size') or 0 for f in files),
+        )
+
+    def serialize_exporter(self, pid, record):
+        """Serialize a single record for the exporter as a row."""
+        return self.flatten(self.transform_search_hit(pid, record))
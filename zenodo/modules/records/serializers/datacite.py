@@ -29,6 +29,7 @@ from __future__ import absolute_import, print_function
 from flask import current_app
 from invenio_records_rest.serializers.datacite import DataCite31Serializer, \
     DataCite41Serializer
+from lxml import etree
 
 from .pidrelations import preprocess_related_identifiers
 from .schemas.common import ui_link_for
@@ -65,6 +66,12 @@ class ZenodoDataCite41Serializer(DataCite41Serializer):
     records.
     """
 
+    export_header = b'<?xml version="1.0" encoding="utf-8"?>\n<resources>\n'
+    """Start of the exported XML document."""
+
+    export_footer = b'</resources>\n'
+    """End of the exported XML document."""
+
     def preprocess_record(self, pid, record, links_factory=None):
         """Add related identifiers from PID relations."""
         result = super(ZenodoDataCite41Serializer, self).preprocess_record(
@@ -80,3 +87,32 @@ class ZenodoDataCite41Serializer(DataCite41Serializer):
         })
         result['metadata']['alternate_identifiers'] = altidentifiers
         return result
+
+    def preprocess_exporter_hit(self, record_hit):
+        """Add the record URL as alternate identifier of an exported hit.
+
+        Versioning relations are not added (unlike in
+        ``preprocess_record()``), since they would need database queries for
+        every record.
+        """
+        source = record_hit['_source']
+        altidentifiers = list(source.get('alternate_identifiers', []))
+        altidentifiers.append({
+            'identifier': ui_link_for('record_html', id=str(source['recid'])),
+            'scheme': 'url'
+        })
+        return dict(record_hit, _source=dict(
+            source, alternate_identifiers=altidentifiers))
+
+    def serialize_exporter(self, pid, record):
+        """Serialize a single record for the exporter.
+
+        Each record is written as a ``<resource>`` element followed by a
+        newline, and the records are wrapped in a ``<resources>`` element
+        (see ``export_header`` and ``export_footer``).
+        """
+        return etree.tostring(
+            self.schema.dump_etree(self.transform_search_hit(
+                pid, self.preprocess_exporter_hit(record))),
+            encoding='utf-8',
+        ) + b'\n'
@@ -34,6 +34,12 @@ from werkzeug.utils import cached_property
 class DCATSerializer(object):
     """DCAT serializer for records."""
 
+    export_header = b'<?xml version="1.0" encoding="utf-8"?>\n<resources>\n'
+    """Start of the exported XML document."""
+
+    export_footer = b'</resources>\n'
+    """End of the exported XML document."""
+
     def __init__(self, datacite_serializer):
         """."""
         self.datacite_serializer = datacite_serializer
@@ -97,3 +103,16 @@ class DCATSerializer(object):
     def serialize_oaipmh(self, pid, record):
         """Serialize a single record for OAI-PMH."""
         return self.transform_with_xslt(pid, record, search_hit=True).getroot()
+
+    def serialize_exporter(self, pid, record):
+        """Serialize a single record for the exporter.
+
+        Each record is written as an ``<rdf:RDF>`` element followed by a
+        newline, and the records are wrapped in a ``<resources>`` element.
+        """
+        return ET.tostring(
+            self.transform_with_xslt(
+                pid, self.datacite_serializer.preprocess_exporter_hit(record),
+                search_hit=True),
+            encoding='utf-8',
+        ) + b'\n'
@@ -26,10 +26,76 @@
 
 from __future__ import absolute_import, print_function
 
+from flask import current_app
+from invenio_cache import current_cache
+from invenio_db import db
 from invenio_pidrelations.contrib.versioning import PIDVersioning
-from invenio_pidstore.models import PersistentIdentifier
+from invenio_pidrelations.models import PIDRelation
+from invenio_pidrelations.utils import resolve_relation_type_config
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_records.models import RecordMetadata
+from sqlalchemy.orm import aliased
 
 from zenodo.modules.records.api import ZenodoRecord
+from zenodo.modules.utils import after_transaction
+
+
+def _versions_cache_key(conceptrecid):
+    """Get the cache key of the versions of a concept."""
+    return 'record_versions:{0}'.format(conceptrecid)
+
+
+def get_versions_identifiers(conceptrecid):
+    """Get the identifiers of the published versions of a concept.
+
+    The identifiers are read from the records' metadata with a single query,
+    without loading the records, and are cached until a version of the
+    concept is published or deleted.
+
+    :param conceptrecid: Value of the concept recid.
+    :returns: List of ``(recid, doi, conceptdoi)`` lists, ordered by version.
+    """
+    key = _versions_cache_key(conceptrecid)
+    versions = current_cache.get(key)
+    if versions is None:
+        Parent = aliased(PersistentIdentifier)
+        Child = aliased(PersistentIdentifier)
+        rows = db.session.query(
+            Child.pid_value,
+            RecordMetadata.json['doi'].as_string(),
+            RecordMetadata.json['conceptdoi'].as_string(),
+        ).join(
+            PIDRelation, PIDRelation.child_id == Child.id
+        ).join(
+            Parent, Parent.id == PIDRelation.parent_id
+        ).join(
+            RecordMetadata, RecordMetadata.id == Child.object_uuid
+        ).filter(
+            Parent.pid_type == 'recid',
+            Parent.pid_value == str(conceptrecid),
+            PIDRelation.relation_type ==
+            resolve_relation_type_config('version').id,
+            Child.status == PIDStatus.REGISTERED,
+        ).order_by(PIDRelation.index.asc())
+        versions = [list(row) for row in rows]
+        if versions:
+            current_cache.set(
+                key, versions,
+                timeout=current_app.config[
+                    'ZENODO_RECORDS_VERSIONS_CACHE_TIMEOUT'])
+    return versions
+
+
+def invalidate_versions_identifiers(conceptrecid):
+    """Remove the cached identifiers of the versions of a concept.
+
+    They are removed again once the transaction ends, since they may have
+    been cached from the committed versions in the meantime.
+    """
+    if conceptrecid:
+        key = _versions_cache_key(conceptrecid)
+        current_cache.delete(key)
+        after_transaction(key, lambda: current_cache.delete(key))
 
 
 def serialize_related_identifiers(pid):
@@ -37,14 +103,21 @@ def serialize_related_identifiers(pid):
     pv = PIDVersioning(child=pid)
     related_identifiers = []
     if pv.exists:
-
-        rec = ZenodoRecord.get_record(pid.get_assigned_object())
+        conceptdois = dict(
+            (recid, conceptdoi) for recid, _, conceptdoi in
+            get_versions_identifiers(pv.parent.pid_value))
+        if pid.pid_value in conceptdois:
+            conceptdoi = conceptdois[pid.pid_value]
+        else:
+            # Not a published version (e.g. a new version being published)
+            rec = ZenodoRecord.get_record(pid.get_assigned_object())
+            conceptdoi = rec.get('conceptdoi')
         # External DOI records don't have Concept DOI
-        if 'conceptdoi' in rec:
+        if conceptdoi:
             ri = {
                 'scheme': 'doi',
                 'relation': 'isVersionOf',
-                'identifier': rec['conceptdoi']
+                'identifier': conceptdoi
             }
             related_identifiers.append(ri)
 
@@ -73,14 +146,12 @@ def serialize_related_identifiers(pid):
         #         'identifier': rec['doi']
         #     }
         #     related_identifiers.append(ri)
-    pv = PIDVersioning(parent=pid)
-    if pv.exists:
-        for p in pv.children:
-            rec = ZenodoRecord.get_record(p.get_assigned_object())
+    else:
+        for _, doi, _ in get_versions_identifiers(pid.pid_value):
             ri = {
                 'scheme': 'doi',
                 'relation': 'hasVersion',
-                'identifier': rec['doi']
+                'identifier': doi
             }
             related_identifiers.append(ri)
     return related_identifiers
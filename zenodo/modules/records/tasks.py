@@ -26,23 +26,59 @@
 
 from __future__ import absolute_import, print_function
 
+import time
 from datetime import datetime
 
 from celery import shared_task
 from flask import current_app
 from invenio_cache import current_cache
 from invenio_db import db
-from invenio_indexer.api import RecordIndexer
 from invenio_pidstore.models import PIDStatus
 from invenio_pidstore.providers.datacite import DataCiteProvider
 from invenio_records import Record
 from lxml import etree
 
+from zenodo.modules.records.indexer import ZenodoRecordIndexer, \
+    iter_record_ids
 from zenodo.modules.records.models import AccessRight
 from zenodo.modules.records.serializers import datacite_v41
 from zenodo.modules.records.utils import find_registered_doi_pids, xsd41
 
 
+@shared_task(ignore_result=True)
+def process_bulk_queue(version_type=None, es_bulk_kwargs=None):
+    """Process the bulk indexing queue, prefetching the records' data."""
+    ZenodoRecordIndexer(version_type=version_type).process_bulk_queue(
+        es_bulk_kwargs=es_bulk_kwargs)
+
+
+@shared_task
+def reindex_records(start, end=None, index='records-record-v1.0.0',
+                    target=None, chunk_size=None, es_bulk_kwargs=None):
+    """Index the records of a UUID range, as part of a full reindex.
+
+    :param start: First UUID of the range.
+    :param end: UUID following the range (``None`` for the end of the UUID
+        space).
+    :param index: Only the records belonging to this index are indexed.
+    :param target: Index where to index the records, instead of the alias of
+        ``index``.
+    :param chunk_size: Number of records fetched and sent to Elasticsearch
+        at once.
+    :returns: Dictionary with the number of indexed records, of errors and
+        the elapsed time.
+    """
+    chunk_size = chunk_size or \
+        current_app.config['ZENODO_RECORDS_INDEXER_PREFETCH_SIZE']
+    started = time.time()
+    indexed, errors = ZenodoRecordIndexer().reindex(
+        iter_record_ids(start, end, chunk_size=chunk_size), index,
+        target=target,
+        es_bulk_kwargs=dict(es_bulk_kwargs or {}, chunk_size=chunk_size))
+    return dict(start=start, end=end, indexed=indexed, errors=errors,
+                time=time.time() - started)
+
+
 @shared_task(ignore_result=True)
 def update_expired_embargos():
     """Release expired embargoes every midnight."""
@@ -52,7 +88,7 @@ def update_expired_embargos():
         record.commit()
     db.session.commit()
 
-    indexer = RecordIndexer()
+    indexer = ZenodoRecordIndexer()
     indexer.bulk_index(record_ids)
     indexer.process_bulk_queue()
 
@@ -35,7 +35,9 @@ from invenio_indexer.utils import schema_to_index
 from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_records.api import Record
 from invenio_search import current_search
+from jsonref import JsonRef
 from lxml import etree
+from six import string_types
 from sqlalchemy import or_
 from werkzeug.utils import import_string
 
@@ -192,3 +194,34 @@ def build_record_custom_fields(record):
 
     return {k: es_custom_fields[k] for k in es_custom_fields
             if es_custom_fields[k]}
+
+
+def resolve_record_refs(data, loader=None):
+    """Get a copy of a record's JSON with its references resolved.
+
+    Equivalent to ``copy.deepcopy(record.replace_refs())``, but the JSON is
+    copied in a single pass instead of being copied by ``replace_refs``, with
+    lazy ``JsonRef`` proxies, and then deep copied to resolve them. Documents
+    referenced several times (e.g. the funder of grants) are loaded once.
+
+    :param data: Record (or any JSON).
+    :param loader: JSON loader (by default, the one of Invenio-Records).
+    """
+    kwargs = dict(
+        loader=loader or
+        current_app.extensions['invenio-records'].loader_cls(),
+        _store={},
+    )
+
+    def _resolve(obj):
+        if hasattr(obj, '__subject__'):  # ``JsonRef`` of a loaded document
+            return _resolve(obj.__subject__)
+        if isinstance(obj, dict):
+            if isinstance(obj.get('$ref'), string_types):
+                return _resolve(JsonRef(obj, **kwargs).__subject__)
+            return dict((k, _resolve(v)) for k, v in obj.items())
+        if isinstance(obj, list):
+            return [_resolve(v) for v in obj]
+        return obj
+
+    return _resolve(data)
@@ -51,7 +51,7 @@ from zenodo.modules.communities.api import ZenodoCommunity
 from zenodo.modules.deposit.extra_formats import ExtraFormats
 from zenodo.modules.deposit.views_rest import pass_extra_formats_mimetype
 from zenodo.modules.records.utils import is_doi_locally_managed
-from zenodo.modules.stats.utils import get_record_stats
+from zenodo.modules.stats.utils import get_cached_record_stats
 
 from .api import ZenodoRecord
 from .models import AccessRight, ObjectType
@@ -257,8 +257,8 @@ def select_preview_file(files):
 
 @blueprint.app_template_filter()
 def record_stats(record):
-    """Fetch record statistics from Elasticsearch."""
-    return get_record_stats(record.id, False)
+    """Fetch (cached) record statistics from Elasticsearch."""
+    return get_cached_record_stats(record.id)
 
 
 @blueprint.app_template_filter()
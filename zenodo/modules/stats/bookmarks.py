@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Durable bookmarks of the statistics exporters."""
+
+from __future__ import absolute_import, print_function
+
+from datetime import datetime
+
+from dateutil.parser import parse as dateutil_parse
+from invenio_db import db
+
+from zenodo.modules.stats.models import StatsExporterBookmark
+
+
+class BookmarkStore(object):
+    """Store of the exporters' bookmarks, in the database.
+
+    Each exporter has a single row, holding the timestamp of the last
+    exported event. Unlike cache keys, the bookmarks cannot be evicted.
+    """
+
+    def get(self, name):
+        """Get the bookmark of an exporter (``None`` if not set)."""
+        bookmark = StatsExporterBookmark.query.get(name)
+        if bookmark is None:
+            return None
+        return bookmark.date.isoformat()
+
+    def set(self, name, date):
+        """Set and commit the bookmark of an exporter.
+
+        :param date: Timestamp, as a ``datetime`` or an ISO string.
+        """
+        if not isinstance(date, datetime):
+            date = dateutil_parse(date)
+        bookmark = StatsExporterBookmark.query.get(name)
+        if bookmark is None:
+            db.session.add(StatsExporterBookmark(name=name, date=date))
+        else:
+            bookmark.date = date
+        db.session.commit()
+
+    def delete(self, name):
+        """Remove the bookmark of an exporter."""
+        StatsExporterBookmark.query.filter_by(name=name).delete()
+        db.session.commit()
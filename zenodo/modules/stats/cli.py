@@ -28,19 +28,26 @@ import csv
 import glob
 import re
 import sys
+import time
 from datetime import datetime as dt
+from functools import partial
+from multiprocessing import Pool
 
 import click
 from dateutil.parser import parse as dateutil_parse
 from flask.cli import with_appcontext
+from invenio_db import db
+from invenio_queues.proxies import current_queues
 from invenio_stats.cli import stats
 from invenio_stats.proxies import current_stats
 from six.moves import filter, map
 from six.moves.urllib.parse import urlparse
 
-from zenodo.modules.stats.tasks import update_record_statistics
-from zenodo.modules.stats.utils import chunkify, \
-    extract_event_record_metadata, fetch_record, fetch_record_file
+from zenodo.modules.stats.exporters import PiwikExporter
+from zenodo.modules.stats.lookup import RecordLookup
+from zenodo.modules.stats.tasks import aggregate_events, \
+    update_record_statistics
+from zenodo.modules.stats.utils import chunkify
 
 PY3 = sys.version_info[0] == 3
 
@@ -65,46 +72,51 @@ def parse_record_url(url):
 
 
 def build_common_event(record, data):
-    """Build common fields of a stats event from a record and request data."""
+    """Build common fields of a stats event from a record and request data.
+
+    :param record: Record entry of the record lookup.
+    """
     return dict(
         timestamp=dt.utcfromtimestamp(float(data['timestamp'])).isoformat(),
         pid_type='recid',
-        pid_value=str(record.get('recid')),
+        pid_value=str(record.recid),
         referrer=data['referrer'],
         ip_address=data['ipAddress'],
         user_agent=data['userAgent'],
         user_id=None,
-        **extract_event_record_metadata(record)
+        **record.event_metadata()
     )
 
 
-def build_record_view_event(data):
+def build_record_view_event(lookup, data):
     """Build a 'record-view' event from request data."""
     try:
         recid, _ = parse_record_url(data['url'])
         assert recid, 'no recid in url'
-        _, record = fetch_record(recid)
+        record = lookup.get(recid)
+        assert record, 'record not found'
     except Exception:
         return
 
     return build_common_event(record, data)
 
 
-def build_file_download_event(data):
+def build_file_download_event(lookup, data):
     """Build a 'file-download' event from request data."""
     try:
         recid, filename = parse_record_url(data['url'])
         assert recid and filename, 'no recid and filename in url'
-        _, record = fetch_record(recid)
-        obj = fetch_record_file(recid, filename)
+        record = lookup.get(recid)
+        assert record, 'record not found'
+        obj = record.files[filename]
     except Exception:
         return
 
     return dict(
-        bucket_id=str(obj.bucket_id),
-        file_id=str(obj.file_id),
+        bucket_id=obj.bucket_id,
+        file_id=obj.file_id,
         file_key=obj.key,
-        size=obj.file.size,
+        size=obj.size,
         **build_common_event(record, data)
     )
 
@@ -115,12 +127,97 @@ EVENT_TYPE_BUILDERS = {
 }
 
 
+def _read_csv(csv_path):
+    """Iterate over the rows of a CSV file."""
+    with open(csv_path, 'r' if PY3 else 'rb') as fp:
+        for row in csv.DictReader(fp, delimiter=','):
+            yield row
+
+
+def _parse_recid(row):
+    """Get the recid of a CSV row's URL (``None`` if it has none)."""
+    try:
+        return parse_record_url(row['url'])[0]
+    except Exception:
+        return None
+
+
+def _queue_size(event_type):
+    """Get the number of messages waiting in an event type's queue."""
+    queue = current_queues.queues['stats-{0}'.format(event_type)]
+    with queue.connection_pool.acquire(block=True) as conn:
+        _, size, _ = queue.queue(conn.default_channel).queue_declare(
+            passive=True)
+    return size
+
+
+def _publish(event_type, events, max_queue_size=None):
+    """Publish events, waiting while the events queue is too long."""
+    if max_queue_size:
+        while _queue_size(event_type) > max_queue_size:
+            time.sleep(1)
+    current_stats.publish(event_type, list(events))
+
+
+def import_events_file(csv_path, event_type, chunk_size=1000,
+                       max_queue_size=None):
+    """Import the stats events of a CSV file.
+
+    The file is read twice: first to collect the recids of all the rows,
+    which are then loaded in the record lookup with bulk queries, and then
+    to build and publish the events.
+
+    :returns: Tuple of the number of imported and skipped rows.
+    """
+    lookup = RecordLookup()
+    lookup.warm_up(filter(None, map(_parse_recid, _read_csv(csv_path))))
+    build_event = partial(EVENT_TYPE_BUILDERS[event_type], lookup)
+    imported = skipped = 0
+    for row_chunk in chunkify(_read_csv(csv_path), chunk_size):
+        events = list(filter(None, map(build_event, row_chunk)))
+        if events:
+            _publish(event_type, events, max_queue_size=max_queue_size)
+        imported += len(events)
+        skipped += len(row_chunk) - len(events)
+    return imported, skipped
+
+
+_worker_app = None
+
+
+def _init_worker():
+    """Initialize an import worker process.
+
+    The worker creates its own application, so that it works with both the
+    "fork" and the "spawn" process start methods.
+    """
+    from zenodo.factory import create_app
+    global _worker_app
+    _worker_app = create_app()
+
+
+def _import_events_file_worker(kwargs, csv_path):
+    """Import a CSV file in a worker process."""
+    with _worker_app.app_context():
+        try:
+            return (csv_path, ) + import_events_file(csv_path, **kwargs)
+        finally:
+            db.session.remove()
+
+
 @stats.command('import')
 @click.argument('event-type', type=click.Choice(EVENT_TYPE_BUILDERS.keys()))
 @click.argument('csv-dir', type=click.Path(file_okay=False, resolve_path=True))
-@click.option('--chunk-size', '-s', type=int, default=100)
+@click.option('--chunk-size', '-s', type=int, default=1000,
+              help='Number of events published at once.')
+@click.option('--processes', '-p', type=int, default=1,
+              help='Number of files imported in parallel.')
+@click.option('--max-queue-size', '-q', type=int, default=1000000,
+              help='Wait while the events queue is longer than this '
+                   '(0 to disable).')
 @with_appcontext
-def import_events(event_type, csv_dir, chunk_size):
+def import_events(event_type, csv_dir, chunk_size, processes,
+                  max_queue_size):
     r"""Import stats events from a directory of CSV files.
 
     Available event types: "file-download", "record-view"
@@ -133,16 +230,51 @@ def import_events(event_type, csv_dir, chunk_size):
     - url ("https://zenodo.org/record/1234/files/article.pdf")
     - timestamp (1388506249)
     - referrer ("Google", "example.com", etc)
+
+    The records of each file are resolved in bulk before its events are
+    built. With ``--processes``, the files are imported in parallel by as
+    many processes.
     """
-    csv_files = glob.glob(csv_dir + '/*.csv')
-    with click.progressbar(csv_files, len(csv_files)) as csv_files_bar:
-        for csv_path in csv_files_bar:
-            with open(csv_path, 'r' if PY3 else 'rb') as fp:
-                reader = csv.DictReader(fp, delimiter=',')
-                events = filter(
-                    None, map(EVENT_TYPE_BUILDERS[event_type], reader))
-                for event_chunk in chunkify(events, chunk_size):
-                    current_stats.publish(event_type, event_chunk)
+    csv_files = sorted(glob.glob(csv_dir + '/*.csv'))
+    kwargs = dict(event_type=event_type, chunk_size=chunk_size,
+                  max_queue_size=max_queue_size)
+    pool = None
+    if processes > 1:
+        # Close the connections, so that forked worker processes don't
+        # share them with the parent.
+        db.session.remove()
+        db.engine.dispose()
+        pool = Pool(processes, initializer=_init_worker)
+        results = pool.imap_unordered(
+            partial(_import_events_file_worker, kwargs), csv_files)
+    else:
+        results = (
+            (csv_path, ) + import_events_file(csv_path, **kwargs)
+            for csv_path in csv_files)
+
+    start = time.time()
+    total_imported = total_skipped = 0
+    try:
+        for index, (csv_path, imported, skipped) in enumerate(results, 1):
+            total_imported += imported
+            total_skipped += skipped
+            elapsed = max(time.time() - start, 1e-6)
+            click.echo(
+                '[{0}/{1}] {2}: {3} events ({4} skipped), {5:.0f} '
+                'events/sec overall'.format(
+                    index, len(csv_files), csv_path, imported, skipped,
+                    total_imported / elapsed))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    elapsed = max(time.time() - start, 1e-6)
+    click.secho(
+        'Imported {0} events ({1} skipped) from {2} files in {3:.0f}s '
+        '({4:.0f} events/sec).'.format(
+            total_imported, total_skipped, len(csv_files), elapsed,
+            total_imported / elapsed),
+        fg='green')
     click.secho(
         'Run the "invenio_stats.tasks.process_events" to index the events...',
         fg='yellow')
@@ -164,3 +296,50 @@ def update_records(start_date=None, end_date=None, eager=False):
         update_record_statistics.delay(
             start_date=start_date, end_date=end_date)
         click.secho('Update records statistics task sent...', fg='yellow')
+
+
+@stats.command('aggregate')
+@click.argument('aggregations', nargs=-1)
+@click.option('--start-date', callback=_verify_date)
+@click.option('--end-date', callback=_verify_date)
+@click.option('--batch-size', type=int,
+              help='Number of intervals aggregated by each task.')
+@click.option('--update-bookmark/--no-update-bookmark', default=True)
+@with_appcontext
+def aggregate(aggregations, start_date=None, end_date=None, batch_size=None,
+              update_bookmark=True):
+    """Aggregate events in parallel tasks (e.g. to backfill statistics)."""
+    aggregate_events.delay(
+        list(aggregations or current_stats.aggregations),
+        start_date=start_date, end_date=end_date,
+        update_bookmark=update_bookmark, batch_size=batch_size)
+    click.secho('Aggregation tasks sent...', fg='yellow')
+
+
+@stats.command('piwik-replay')
+@click.argument('start-date', callback=_verify_date)
+@click.argument('end-date', callback=_verify_date)
+@with_appcontext
+def piwik_replay(start_date, end_date):
+    """Export the events of a time range to Piwik again.
+
+    The bookmark of the scheduled export is not modified, so a replay can
+    be run (and repeated) at any time.
+    """
+    PiwikExporter().run(start_date=dateutil_parse(start_date),
+                        end_date=dateutil_parse(end_date),
+                        update_bookmark=False)
+    click.secho('Events exported.', fg='green')
+
+
+@stats.command('piwik-bookmark')
+@click.option('--set', 'date', callback=_verify_date,
+              help='Timestamp of the last exported event.')
+@with_appcontext
+def piwik_bookmark(date=None):
+    """Show or set the bookmark of the Piwik export."""
+    exporter = PiwikExporter()
+    if date:
+        exporter.bookmarks.set(
+            exporter.bookmark_name, dateutil_parse(date).isoformat())
+    click.echo(exporter.bookmark or 'No bookmark.')
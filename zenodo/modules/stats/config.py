@@ -28,11 +28,34 @@ ZENODO_STATS_PIWIK_EXPORTER = {
     'id_site': 1,
     'url': 'https://analytics.openaire.eu/piwik.php',
     'token_auth': 'api-token',
-    'chunk_size': 50  # [max piwik payload size = 64k] / [max querystring size = 750]
+    'chunk_size': 50,  # [max piwik payload size = 64k] / [max querystring size = 750]
+    'workers': 4,  # number of chunks sent concurrently
+    'timeout': 60,  # seconds
 }
 
 ZENODO_STATS_PIWIK_EXPORT_ENABLED = True
 
+# Time in seconds during which the statistics displayed on record pages are
+# cached, during which the fetch of a record's statistics by a request blocks
+# the fetches by other requests, and during which these requests wait for the
+# statistics before fetching them directly.
+ZENODO_STATS_CACHE_TIMEOUT = 300
+ZENODO_STATS_CACHE_LOCK_TIMEOUT = 5
+ZENODO_STATS_CACHE_LOCK_WAIT = 0.3
+
+# Maximum number of records kept in the (per-process) lookup used to build
+# and export statistics events.
+ZENODO_STATS_RECORD_LOOKUP_SIZE = 200000
+
+# Number of conceptrecids whose versions are resolved with a single query and
+# sent at once to the bulk indexing queue when updating the records' stats.
+ZENODO_STATS_UPDATE_BATCH_SIZE = 1000
+
+# Default number of aggregation intervals (e.g. days) aggregated by each of
+# the parallel tasks of "zenodo.modules.stats.tasks.aggregate_events". It can
+# be overridden by the "batch_size" of an aggregation's parameters.
+ZENODO_STATS_AGGREGATION_BATCH_SIZE = 7
+
 # Queries performed when processing aggregations might take more time than
 # usual. This is fine though, since this is happening during Celery tasks.
 ZENODO_STATS_ELASTICSEARCH_CLIENT_CONFIG = {'timeout': 60}
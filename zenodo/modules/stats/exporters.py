@@ -25,29 +25,63 @@
 """Zenodo stats exporters."""
 
 import json
+import sys
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 import requests
+import six
 from dateutil.parser import parse as dateutil_parse
 from elasticsearch_dsl import Search
 from flask import current_app
 from invenio_cache import current_cache
-from invenio_pidstore.errors import PIDDeletedError
 from invenio_search import current_search_client
 from invenio_search.utils import build_alias_name
-from six.moves.urllib.parse import urlencode
+from six.moves.urllib.parse import quote_plus
 
 from zenodo.modules.records.serializers.schemas.common import ui_link_for
+from zenodo.modules.stats.bookmarks import BookmarkStore
 from zenodo.modules.stats.errors import PiwikExportRequestError
-from zenodo.modules.stats.utils import chunkify, fetch_record
+from zenodo.modules.stats.lookup import RecordLookup
+from zenodo.modules.stats.utils import chunkify
 
 
 class PiwikExporter:
-    """Events exporter."""
+    """Events exporter.
+
+    The timestamp of the last exported event is saved in the bookmark store
+    after each chunk, and the next run (without a start date) continues
+    from there. Chunks are sent concurrently: when one fails, the bookmark
+    stays at the chunk before it, and the chunks that were already sent
+    after it are logged, as the next run exports them again.
+    """
+
+    bookmark_name = 'piwik'
+
+    def __init__(self, bookmarks=None):
+        """Initialize the exporter."""
+        self.bookmarks = bookmarks or BookmarkStore()
+
+    @property
+    def bookmark(self):
+        """Timestamp of the last exported event."""
+        bookmark = self.bookmarks.get(self.bookmark_name)
+        if bookmark is None:
+            # Bookmark kept in the cache by previous versions
+            bookmark = current_cache.get('piwik_export:bookmark')
+        return bookmark
 
     def run(self, start_date=None, end_date=None, update_bookmark=True):
-        """Run export job."""
+        """Run export job.
+
+        :param start_date: Start of the exported time range (by default the
+            bookmark).
+        :param end_date: End of the exported time range.
+        :param update_bookmark: Whether to save the bookmark after each
+            exported chunk. Replays of past time ranges don't.
+        """
         if start_date is None:
-            bookmark = current_cache.get('piwik_export:bookmark')
+            bookmark = self.bookmark
             if bookmark is None:
                 msg = 'Bookmark not found, and no start date specified.'
                 current_app.logger.warning(msg)
@@ -69,80 +103,186 @@ class PiwikExporter:
             {'timestamp': {'order': 'asc'}}
         ).params(preserve_order=True).scan()
 
-        url = current_app.config['ZENODO_STATS_PIWIK_EXPORTER'].get('url', None)
-        token_auth = current_app.config['ZENODO_STATS_PIWIK_EXPORTER'] \
-            .get('token_auth', None)
-        chunk_size = current_app.config['ZENODO_STATS_PIWIK_EXPORTER']\
-            .get('chunk_size', 0)
-
-        for event_chunk in chunkify(events, chunk_size):
-            query_strings = []
-            for event in event_chunk:
-                if 'recid' not in event:
-                    continue
-                try:
-                    query_string = self._build_query_string(event)
-                    query_strings.append(query_string)
-                except PIDDeletedError:
-                    pass
-
-            payload = {
-                'requests': query_strings,
-                'token_auth': token_auth
-            }
+        config = current_app.config['ZENODO_STATS_PIWIK_EXPORTER']
+        url = config.get('url', None)
+        token_auth = config.get('token_auth', None)
+        chunk_size = config.get('chunk_size', 0)
+        workers = config.get('workers', 1)
+        timeout = config.get('timeout', None)
 
-            res = requests.post(url, json=payload)
-
-            # Failure: not 200 or not "success"
-            content = res.json() if res.ok else None
-            if res.status_code == 200 and content.get('status') == 'success':
-                if content.get('invalid') != 0:
-                    msg = 'Invalid events in Piwik export request.'
-                    info = {
-                        'begin_event_timestamp': event_chunk[0].timestamp,
-                        'end_event_timestamp': event_chunk[-1].timestamp,
-                        'invalid_events': content.get('invalid')
-                    }
-                    current_app.logger.warning(msg, extra=info)
-                elif update_bookmark is True:
-                    current_cache.set('piwik_export:bookmark',
-                                      event_chunk[-1].timestamp,
-                                      timeout=-1)
-            else:
+        # Payloads are built while up to ``2 * workers`` previous chunks are
+        # being sent. The responses are handled in the order of the chunks,
+        # so that the bookmark only moves forward over exported events.
+        lookup = RecordLookup()
+        session = self._session(workers)
+        pool = ThreadPool(workers)
+        pending = deque()
+        try:
+            for event_chunk in chunkify(events, chunk_size):
+                payload = {
+                    'requests': self._build_query_strings(
+                        event_chunk, lookup),
+                    'token_auth': token_auth
+                }
+                pending.append((event_chunk, pool.apply_async(
+                    self._send, (session, url, payload, timeout))))
+                while len(pending) > 2 * workers:
+                    self._handle_response(
+                        *pending.popleft(), update_bookmark=update_bookmark)
+            while pending:
+                self._handle_response(
+                    *pending.popleft(), update_bookmark=update_bookmark)
+        except Exception:
+            exc_info = sys.exc_info()
+            self._log_sent_chunks(pending)
+            six.reraise(*exc_info)
+        finally:
+            pool.close()
+            pool.join()
+            session.close()
+
+    @staticmethod
+    def _session(workers):
+        """Get an HTTP session with a connection for each worker."""
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def _send(session, url, payload, timeout=None):
+        """Send a payload (in a worker thread)."""
+        res = session.post(url, json=payload, timeout=timeout)
+        return res.status_code, (res.json() if res.ok else None)
+
+    def _handle_response(self, event_chunk, result, update_bookmark=True):
+        """Check the response to a chunk, and update the bookmark."""
+        status_code, content = result.get()
+        # Failure: not 200 or not "success"
+        if status_code == 200 and content.get('status') == 'success':
+            if content.get('invalid') != 0:
                 msg = 'Invalid events in Piwik export request.'
                 info = {
                     'begin_event_timestamp': event_chunk[0].timestamp,
                     'end_event_timestamp': event_chunk[-1].timestamp,
+                    'invalid_events': content.get('invalid')
                 }
-                raise PiwikExportRequestError(msg, export_info=info)
+                current_app.logger.warning(msg, extra=info)
+            elif update_bookmark is True:
+                self.bookmarks.set(
+                    self.bookmark_name, event_chunk[-1].timestamp)
+        else:
+            msg = 'Invalid events in Piwik export request.'
+            info = {
+                'begin_event_timestamp': event_chunk[0].timestamp,
+                'end_event_timestamp': event_chunk[-1].timestamp,
+            }
+            raise PiwikExportRequestError(msg, export_info=info)
+
+    @staticmethod
+    def _log_sent_chunks(pending):
+        """Log the chunks sent after a failed one, once they complete.
 
-    def _build_query_string(self, event):
+        The bookmark is not moved past the failed chunk, so these chunks are
+        exported again by the next run.
+        """
+        sent = []
+        for event_chunk, result in pending:
+            try:
+                status_code, content = result.get()
+            except Exception:
+                continue
+            if status_code == 200 and content.get('status') == 'success':
+                sent.append({
+                    'begin_event_timestamp': event_chunk[0].timestamp,
+                    'end_event_timestamp': event_chunk[-1].timestamp,
+                })
+        if sent:
+            msg = 'Piwik export chunks sent after a failed chunk.'
+            current_app.logger.warning(msg, extra={'sent_chunks': sent})
+
+    def _build_query_strings(self, event_chunk, lookup):
+        """Build the query strings of a chunk of events."""
+        lookup.warm_up(
+            event.recid for event in event_chunk if 'recid' in event)
         id_site = current_app.config['ZENODO_STATS_PIWIK_EXPORTER']\
             .get('id_site', None)
-        url = ui_link_for('record_html', id=event.recid)
-        visitor_id = event.visitor_id[0:16]
-        _, record = fetch_record(event.recid)
-        oai = record.get('_oai', {}).get('id')
-        cvar = json.dumps({'1': ['oaipmhID', oai]})
-        action_name = record.get('title')[:150]  # max 150 characters
-
-        params = dict(
-            idsite=id_site,
-            rec=1,
-            url=url,
-            _id=visitor_id,
-            cid=visitor_id,
-            cvar=cvar,
-            cdt=event.timestamp,
-            urlref=event.referrer,
-            action_name=action_name
-        )
-
-        if event.to_dict().get('country'):
-            params['country'] = event.country.lower()
-        if event.to_dict().get('file_key'):
-            params['url'] = ui_link_for('record_file', id=event.recid,
-                                        filename=event.file_key)
-            params['download'] = params['url']
-
-        return '?{}'.format(urlencode(params, 'utf-8'))
+        return build_query_strings(event_chunk, lookup, id_site=id_site)
+
+
+def _quote(value):
+    """URL-quote a parameter value."""
+    if not isinstance(value, bytes):
+        value = six.text_type(value).encode('utf-8')
+    return quote_plus(value)
+
+
+def _encode(params):
+    """URL-encode ``(name, value)`` pairs, skipping ``None`` values."""
+    return '&'.join('{0}={1}'.format(name, _quote(value))
+                    for name, value in params if value is not None)
+
+
+def build_query_strings(events, lookup, id_site=None):
+    """Build the Piwik tracking query strings of a page of events.
+
+    The parameters which only depend on the record (URL, custom variables
+    and action name) are encoded once for each distinct record (and file),
+    so that only the visitor, date, referrer and country are encoded for
+    each event. Events of records which cannot be resolved are skipped.
+
+    :param events: Statistics events (search hits).
+    :param lookup: :class:`~zenodo.modules.stats.lookup.RecordLookup` used
+        to resolve the records.
+    :param id_site: Piwik site ID.
+    :returns: List of query strings.
+    """
+    records = {}
+    urls = {}
+    query_strings = []
+    for event in events:
+        event = event.to_dict()
+        recid = event.get('recid')
+        if recid is None:
+            continue
+        if recid not in records:
+            record = lookup.get(recid)
+            if record is None:  # e.g. deleted record
+                records[recid] = None
+            else:
+                records[recid] = _encode((
+                    ('idsite', id_site),
+                    ('rec', 1),
+                    ('cvar', json.dumps({'1': ['oaipmhID', record.oai_id]})),
+                    # max 150 characters
+                    ('action_name', (record.title or '')[:150]),
+                ))
+        record_params = records[recid]
+        if record_params is None:
+            continue
+
+        file_key = event.get('file_key')
+        url_key = (recid, file_key)
+        if url_key not in urls:
+            if file_key:
+                url = ui_link_for(
+                    'record_file', id=recid, filename=file_key)
+                urls[url_key] = _encode((('url', url), ('download', url)))
+            else:
+                urls[url_key] = _encode(
+                    (('url', ui_link_for('record_html', id=recid)),))
+
+        visitor_id = event['visitor_id'][0:16]
+        country = event.get('country')
+        event_params = _encode((
+            ('_id', visitor_id),
+            ('cid', visitor_id),
+            ('cdt', event['timestamp']),
+            ('urlref', event.get('referrer')),
+            ('country', country.lower() if country else None),
+        ))
+        query_strings.append('?{0}&{1}&{2}'.format(
+            urls[url_key], record_params, event_params))
+    return query_strings
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Compact lookup of the records referenced by statistics events."""
+
+from __future__ import absolute_import, print_function
+
+from collections import OrderedDict
+
+from flask import current_app
+from invenio_db import db
+from invenio_files_rest.models import FileInstance, ObjectVersion
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_records.models import RecordMetadata
+
+from .utils import chunkify
+
+
+class FileEntry(object):
+    """File fields needed by statistics events."""
+
+    __slots__ = ('bucket_id', 'file_id', 'key', 'size')
+
+    def __init__(self, bucket_id, file_id, key, size):
+        """Initialize the entry."""
+        self.bucket_id = bucket_id
+        self.file_id = file_id
+        self.key = key
+        self.size = size
+
+
+class RecordEntry(object):
+    """Record fields needed by statistics events."""
+
+    __slots__ = (
+        'record_id', 'recid', 'conceptrecid', 'doi', 'conceptdoi',
+        'access_right', 'resource_type', 'communities', 'owners', 'title',
+        'oai_id', 'bucket_id', 'files',
+    )
+
+    def __init__(self, record_id, data):
+        """Initialize the entry from the record's JSON."""
+        self.record_id = str(record_id)
+        self.recid = str(data['recid']) if data.get('recid') else None
+        self.conceptrecid = data.get('conceptrecid')
+        self.doi = data.get('doi')
+        self.conceptdoi = data.get('conceptdoi')
+        self.access_right = data.get('access_right')
+        self.resource_type = data.get('resource_type')
+        self.communities = data.get('communities')
+        self.owners = data.get('owners')
+        self.title = data.get('title')
+        self.oai_id = data.get('_oai', {}).get('id')
+        self.bucket_id = data.get('_buckets', {}).get('record')
+        self.files = {}
+
+    def event_metadata(self):
+        """Get the payload needed for a statistics event."""
+        return dict(
+            record_id=self.record_id,
+            recid=self.recid,
+            conceptrecid=self.conceptrecid,
+            doi=self.doi,
+            conceptdoi=self.conceptdoi,
+            access_right=self.access_right,
+            resource_type=self.resource_type,
+            communities=self.communities,
+            owners=self.owners,
+        )
+
+
+class RecordLookup(object):
+    """Lookup of the records referenced by statistics events, by recid.
+
+    Unlike a cache of resolved records, only the few fields used by the
+    events are kept, in compact entries. Entries are loaded in bulk with
+    :meth:`warm_up` (a single query for the records and one for their files,
+    per chunk of recids), and the least recently used entries are evicted
+    once there are more than ``max_size``. Recids which cannot be resolved
+    (e.g. deleted records) are remembered as well.
+
+    Entries are never refreshed, so a lookup should only be used for a
+    single export or import run.
+
+    :param max_size: Maximum number of entries (by default
+        ``ZENODO_STATS_RECORD_LOOKUP_SIZE``).
+    """
+
+    def __init__(self, max_size=None):
+        """Initialize the lookup."""
+        self.max_size = max_size or \
+            current_app.config['ZENODO_STATS_RECORD_LOOKUP_SIZE']
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        """Get the number of entries."""
+        return len(self._entries)
+
+    def __contains__(self, recid):
+        """Check if a recid has been looked up."""
+        return str(recid) in self._entries
+
+    def clear(self):
+        """Remove all entries."""
+        self._entries.clear()
+
+    def warm_up(self, recids, chunk_size=1000):
+        """Load the entries of the given recids (if not already loaded)."""
+        recids = set(str(r) for r in recids) - set(self._entries)
+        for chunk in chunkify(recids, chunk_size):
+            entries = dict.fromkeys(chunk)
+            rows = db.session.query(
+                PersistentIdentifier.pid_value, RecordMetadata.id,
+                RecordMetadata.json,
+            ).join(
+                RecordMetadata,
+                RecordMetadata.id == PersistentIdentifier.object_uuid
+            ).filter(
+                PersistentIdentifier.pid_type == 'recid',
+                PersistentIdentifier.pid_value.in_(chunk),
+                PersistentIdentifier.status == PIDStatus.REGISTERED,
+            )
+            buckets = {}
+            for recid, record_id, data in rows:
+                entry = entries[recid] = RecordEntry(record_id, data)
+                if entry.bucket_id:
+                    buckets[entry.bucket_id] = entry
+            if buckets:
+                files = db.session.query(
+                    ObjectVersion.bucket_id, ObjectVersion.file_id,
+                    ObjectVersion.key, FileInstance.size,
+                ).join(
+                    FileInstance, FileInstance.id == ObjectVersion.file_id
+                ).filter(
+                    ObjectVersion.bucket_id.in_(list(buckets)),
+                    ObjectVersion.is_head.is_(True),
+                )
+                for bucket_id, file_id, key, size in files:
+                    buckets[str(bucket_id)].files[key] = FileEntry(
+                        str(bucket_id), str(file_id), key, size)
+            for recid in chunk:
+                self._set(recid, entries[recid])
+
+    def _set(self, recid, entry):
+        """Add an entry, evicting the least recently used ones."""
+        self._entries[recid] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, recid):
+        """Get the entry of a recid (``None`` if it cannot be resolved)."""
+        recid = str(recid)
+        if recid not in self._entries:
+            self.warm_up([recid])
+        # Mark the entry as recently used
+        entry = self._entries[recid] = self._entries.pop(recid)
+        return entry
+
+    def get_file(self, recid, key):
+        """Get the entry of a record's file (``None`` if not found)."""
+        entry = self.get(recid)
+        return entry.files.get(key) if entry else None
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Zenodo.
+# Copyright (C) 2019 CERN.
+#
+# Zenodo is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Zenodo is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Zenodo; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+"""Database models of the statistics module."""
+
+from __future__ import absolute_import, print_function
+
+from invenio_db import db
+from sqlalchemy_utils.models import Timestamp
+
+
+class StatsExporterBookmark(db.Model, Timestamp):
+    """Bookmark of a statistics exporter.
+
+    Holds the timestamp of the last event exported by the exporter.
+    """
+
+    __tablename__ = 'stats_exporter_bookmark'
+
+    name = db.Column(db.String(255), primary_key=True)
+    """Name of the exporter."""
+
+    date = db.Column(db.DateTime, nullable=False)
+    """Timestamp of the last exported event."""
+
+
+__all__ = ('StatsExporterBookmark', )
@@ -26,16 +26,92 @@
 
 from datetime import datetime
 
-from celery import shared_task
+from celery import chord, group, shared_task
 from dateutil.parser import parse as dateutil_parse
 from elasticsearch_dsl import Index, Search
 from flask import current_app
 from invenio_indexer.api import RecordIndexer
-from invenio_pidrelations.contrib.versioning import PIDVersioning
-from invenio_pidstore.models import PersistentIdentifier
 from invenio_stats import current_stats
 
 from zenodo.modules.stats.exporters import PiwikExporter
+from zenodo.modules.stats.utils import aggregation_windows, \
+    get_conceptrecids_children, index_records_stats, invalidate_record_stats
+
+
+def _aggregator(aggregation):
+    """Instantiate an aggregator."""
+    aggr_cfg = current_stats.aggregations[aggregation]
+    params = dict(aggr_cfg.params)
+    params.pop('batch_size', None)
+    return aggr_cfg.cls(name=aggr_cfg.name, **params)
+
+
+def _batch_size(aggregation, batch_size=None):
+    """Get the number of intervals aggregated by each task."""
+    return (
+        batch_size or
+        current_stats.aggregations[aggregation].params.get('batch_size') or
+        current_app.config['ZENODO_STATS_AGGREGATION_BATCH_SIZE'])
+
+
+@shared_task(ignore_result=True)
+def aggregate_events(aggregations, start_date=None, end_date=None,
+                     update_bookmark=True, batch_size=None):
+    """Aggregate indexed events, in parallel windows of intervals.
+
+    The time range of each aggregation (by default from its bookmark up to
+    now) is split in windows of ``batch_size`` intervals (e.g. days), which
+    are aggregated by separate tasks. The bookmark is only set once all the
+    windows have been aggregated, so that a failed window is aggregated
+    again by the next run.
+    """
+    start_date = dateutil_parse(start_date) if start_date else None
+    end_date = dateutil_parse(end_date) if end_date else None
+    for aggregation in aggregations:
+        aggr = _aggregator(aggregation)
+        # If no events have been indexed there is nothing to aggregate
+        if not Index(aggr.event_index, using=aggr.client).exists():
+            continue
+        lower_limit = (
+            start_date or
+            aggr.bookmark_api.get_bookmark() or
+            aggr._get_oldest_event_timestamp()
+        )
+        if lower_limit is None:
+            continue
+        upper_limit = min(end_date or datetime.max, datetime.utcnow())
+        windows = aggregation_windows(
+            lower_limit, upper_limit, aggr.interval,
+            _batch_size(aggregation, batch_size))
+        if not windows:
+            continue
+
+        header = [
+            aggregate_events_window.si(
+                aggregation, start.isoformat(), end.isoformat())
+            for start, end in windows
+        ]
+        if update_bookmark:
+            chord(header)(set_aggregation_bookmark.si(
+                aggregation, upper_limit.isoformat()))
+        else:
+            group(header).apply_async()
+
+
+@shared_task
+def aggregate_events_window(aggregation, start_date, end_date):
+    """Aggregate the events of a window, without setting the bookmark."""
+    aggr = _aggregator(aggregation)
+    aggr.run(dateutil_parse(start_date), dateutil_parse(end_date),
+             update_bookmark=False)
+
+
+@shared_task(ignore_result=True)
+def set_aggregation_bookmark(aggregation, date):
+    """Set the bookmark of an aggregation."""
+    aggr = _aggregator(aggregation)
+    aggr.bookmark_api.set_bookmark(
+        dateutil_parse(date).strftime(aggr.doc_id_suffix))
 
 
 @shared_task(ignore_result=True)
@@ -91,12 +167,27 @@ def update_record_statistics(start_date=None, end_date=None):
         ).source(include='conceptrecid')
         conceptrecids |= {b.conceptrecid for b in query.scan()}
 
-    indexer = RecordIndexer()
-    for concpetrecid_val in conceptrecids:
-        conceptrecid = PersistentIdentifier.get('recid', concpetrecid_val)
-        pv = PIDVersioning(parent=conceptrecid)
-        children_recids = pv.children.all()
-        indexer.bulk_index([str(p.object_uuid) for p in children_recids])
+    # Resolve the versions of the conceptrecids in batches, and update the
+    # statistics of each batch in a separate task.
+    batch_size = current_app.config['ZENODO_STATS_UPDATE_BATCH_SIZE']
+    for records in get_conceptrecids_children(
+            sorted(filter(None, conceptrecids)), batch_size=batch_size):
+        if records:
+            update_records_stats.delay(records)
+
+
+@shared_task(ignore_result=True)
+def update_records_stats(records):
+    """Update the "_stats" field of indexed records.
+
+    Records which are not indexed yet are sent to the bulk indexing queue.
+
+    :param records: List of ``(record_id, recid, conceptrecid)`` lists.
+    """
+    missing = index_records_stats([tuple(r) for r in records])
+    if missing:
+        RecordIndexer().bulk_index(missing)
+    invalidate_record_stats([record_id for record_id, _, _ in records])
 
 
 @shared_task(ignore_result=True, max_retries=3, default_retry_delay=60 * 60)
@@ -25,20 +25,25 @@
 """Statistics utilities."""
 
 import itertools
+import random
+import time
+from datetime import datetime
 
 from elasticsearch.exceptions import NotFoundError
-from flask import request
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import MultiSearch
+from flask import current_app, request
+from invenio_cache import current_cache
+from invenio_db import db
+from invenio_pidrelations.models import PIDRelation
+from invenio_pidrelations.utils import resolve_relation_type_config
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
 from invenio_search.api import RecordsSearch
 from invenio_search.proxies import current_search_client
 from invenio_search.utils import build_alias_name
 from invenio_stats import current_stats
-
-from zenodo.modules.records.resolvers import record_resolver
-
-try:
-    from functools import lru_cache
-except ImportError:
-    from functools32 import lru_cache
+from invenio_stats.aggregations import INTERVAL_DELTAS, SUPPORTED_INTERVALS
+from sqlalchemy.orm import aliased
 
 
 def get_record_from_context(**kwargs):
@@ -66,53 +71,105 @@ def extract_event_record_metadata(record):
     )
 
 
-def build_record_stats(recid, conceptrecid):
-    """Build the record's stats."""
-    stats = {}
-    stats_sources = {
-        'record-view': {
-            'params': {'recid': recid},
-            'fields': {
-                'views': 'count',
-                'unique_views': 'unique_count',
-            },
-        },
-        'record-download': {
-            'params': {'recid': recid},
-            'fields': {
-                'downloads': 'count',
-                'unique_downloads': 'unique_count',
-                'volume': 'volume',
-            },
+RECORD_STATS_QUERIES = {
+    'record-view': {
+        'param': 'recid',
+        'fields': {
+            'views': 'count',
+            'unique_views': 'unique_count',
         },
-        'record-view-all-versions': {
-            'params': {'conceptrecid': conceptrecid},
-            'fields': {
-                'version_views': 'count',
-                'version_unique_views': 'unique_count',
-            }
+    },
+    'record-download': {
+        'param': 'recid',
+        'fields': {
+            'downloads': 'count',
+            'unique_downloads': 'unique_count',
+            'volume': 'volume',
         },
-        'record-download-all-versions': {
-            'params': {'conceptrecid': conceptrecid},
-            'fields': {
-                'version_downloads': 'count',
-                'version_unique_downloads': 'unique_count',
-                'version_volume': 'volume',
-            },
+    },
+    'record-view-all-versions': {
+        'param': 'conceptrecid',
+        'fields': {
+            'version_views': 'count',
+            'version_unique_views': 'unique_count',
+        }
+    },
+    'record-download-all-versions': {
+        'param': 'conceptrecid',
+        'fields': {
+            'version_downloads': 'count',
+            'version_unique_downloads': 'unique_count',
+            'version_volume': 'volume',
         },
-    }
-    for query_name, cfg in stats_sources.items():
+    },
+}
+"""Statistics queries used to build the "_stats" field of records."""
+
+
+def build_records_stats(records, chunk_size=100):
+    """Build the stats of several records.
+
+    The queries of ``chunk_size`` records are sent in a single multi-search
+    request, and the all-versions queries are run only once for records
+    sharing the same conceptrecid.
+
+    :param records: Iterable of ``(recid, conceptrecid)`` tuples.
+    :returns: Dictionary of the stats of each recid.
+    """
+    queries = {}
+    for query_name in RECORD_STATS_QUERIES:
+        query_cfg = current_stats.queries.get(query_name)
+        if query_cfg:
+            queries[query_name] = query_cfg.cls(
+                name=query_name, **query_cfg.params)
+    if not queries:
+        return {recid: {} for recid, _ in records}
+
+    client = next(iter(queries.values())).client
+    stats = {}
+    for chunk in chunkify(records, chunk_size):
+        params = dict(
+            recid=set(recid for recid, _ in chunk),
+            conceptrecid=set(c for _, c in chunk if c is not None),
+        )
+        keys, ms = [], MultiSearch(using=client)
+        for query_name, query in queries.items():
+            param = RECORD_STATS_QUERIES[query_name]['param']
+            for value in params[param]:
+                keys.append((query_name, value))
+                ms = ms.add(query.build_query(None, None, **{param: value}))
+
+        results = {}
         try:
-            query_cfg = current_stats.queries[query_name]
-            query = query_cfg.cls(name=query_name, **query_cfg.params)
-            result = query.run(**cfg['params'])
-            for dst, src in cfg['fields'].items():
-                stats[dst] = result.get(src)
+            responses = ms.execute(raise_on_error=False) if keys else []
         except Exception:
-            pass
+            responses = []
+        for (query_name, value), response in zip(keys, responses):
+            if response is None:
+                continue
+            try:
+                result = queries[query_name].process_query_result(
+                    response.to_dict(), None, None)
+            except Exception:
+                continue
+            fields = RECORD_STATS_QUERIES[query_name]['fields']
+            results[query_name, value] = {
+                dst: result.get(src) for dst, src in fields.items()}
+
+        for recid, conceptrecid in chunk:
+            record_stats = stats[recid] = {}
+            for query_name, cfg in RECORD_STATS_QUERIES.items():
+                value = conceptrecid if cfg['param'] == 'conceptrecid' \
+                    else recid
+                record_stats.update(results.get((query_name, value), {}))
     return stats
 
 
+def build_record_stats(recid, conceptrecid):
+    """Build the record's stats."""
+    return build_records_stats([(recid, conceptrecid)])[recid]
+
+
 def get_record_stats(recordid, throws=True):
     """Fetch record statistics from Elasticsearch."""
     try:
@@ -130,6 +187,90 @@ def get_record_stats(recordid, throws=True):
         pass
 
 
+def _record_stats_cache_key(recordid):
+    """Get the cache key of a record's statistics."""
+    return 'record_stats:{0}'.format(recordid)
+
+
+def _fetch_record_stats(recordid):
+    """Fetch record statistics, and whether they can be cached."""
+    try:
+        return get_record_stats(recordid) or {}, True
+    except Exception:
+        current_app.logger.warning(
+            'Failed to fetch the statistics of record %s.', recordid,
+            exc_info=True)
+        return {}, False
+
+
+def get_cached_record_stats(recordid):
+    """Fetch record statistics, cached for a few minutes.
+
+    Each record's statistics expire individually, after
+    ``ZENODO_STATS_CACHE_TIMEOUT`` seconds plus a random jitter of up to 10%,
+    so that entries cached together do not all expire at once. Concurrent
+    misses for the same record are coalesced: only one request fetches the
+    statistics from Elasticsearch, while the others wait briefly (at most
+    ``ZENODO_STATS_CACHE_LOCK_WAIT`` seconds) for the cached result, and
+    then fetch them directly.
+
+    Records without statistics are cached as an empty dictionary. Failures
+    to fetch the statistics return an empty dictionary, but are not cached.
+    """
+    key = _record_stats_cache_key(recordid)
+    stats = current_cache.get(key)
+    if stats is not None:
+        return stats
+
+    lock_timeout = current_app.config['ZENODO_STATS_CACHE_LOCK_TIMEOUT']
+    if not current_cache.add(key + ':lock', True, timeout=lock_timeout):
+        deadline = time.time() + \
+            current_app.config['ZENODO_STATS_CACHE_LOCK_WAIT']
+        while time.time() < deadline:
+            time.sleep(0.05)
+            stats = current_cache.get(key)
+            if stats is not None:
+                return stats
+        return _fetch_record_stats(recordid)[0]
+
+    try:
+        stats, cacheable = _fetch_record_stats(recordid)
+        if cacheable:
+            timeout = current_app.config['ZENODO_STATS_CACHE_TIMEOUT']
+            current_cache.set(
+                key, stats, timeout=int(timeout * random.uniform(1, 1.1)))
+    finally:
+        current_cache.delete(key + ':lock')
+    return stats
+
+
+def invalidate_record_stats(recordids):
+    """Remove the cached statistics of records."""
+    keys = [_record_stats_cache_key(recordid) for recordid in recordids]
+    if keys:
+        current_cache.delete_many(*keys)
+
+
+def aggregation_windows(start_date, end_date, interval, batch_size):
+    """Split a time range in windows of ``batch_size`` aggregation intervals.
+
+    The aggregation queries round their lower limit down and their upper
+    limit up to the interval, so the windows don't overlap and can be
+    aggregated independently.
+
+    :returns: List of ``(start_date, end_date)`` tuples.
+    """
+    fmt = SUPPORTED_INTERVALS[interval]
+    step = INTERVAL_DELTAS[interval]
+    lower = datetime.strptime(start_date.strftime(fmt), fmt)
+    windows = []
+    while lower <= end_date:
+        upper = lower + step * batch_size - step
+        windows.append((lower, min(upper, end_date)))
+        lower += step * batch_size
+    return windows
+
+
 def chunkify(iterable, n):
     """Create equally sized tuple-chunks from an iterable."""
     it = iter(iterable)
@@ -140,14 +281,102 @@ def chunkify(iterable, n):
         yield chunk
 
 
-@lru_cache(maxsize=1024)
-def fetch_record(recid):
-    """Cached record fetch."""
-    return record_resolver.resolve(recid)
+def get_conceptrecids_children(conceptrecids, batch_size=1000):
+    """Get all the versions of the given conceptrecids.
+
+    The children of ``batch_size`` conceptrecids are resolved with a single
+    query, instead of one ``PIDVersioning`` lookup per conceptrecid. Only
+    registered (i.e. published and not deleted) versions are returned.
+
+    :returns: Iterator over lists (one per batch) of ``(record_id, recid,
+        conceptrecid)`` tuples.
+    """
+    parent = aliased(PersistentIdentifier)
+    child = aliased(PersistentIdentifier)
+    version_relation = resolve_relation_type_config('version').id
+    for chunk in chunkify(conceptrecids, batch_size):
+        query = db.session.query(
+            child.object_uuid, child.pid_value, parent.pid_value
+        ).join(
+            PIDRelation, PIDRelation.child_id == child.id
+        ).join(
+            parent, PIDRelation.parent_id == parent.id
+        ).filter(
+            parent.pid_type == 'recid',
+            parent.pid_value.in_([str(c) for c in chunk]),
+            PIDRelation.relation_type == version_relation,
+            child.status == PIDStatus.REGISTERED,
+        )
+        yield [(str(object_uuid), recid, conceptrecid)
+               for object_uuid, recid, conceptrecid in query]
+
+
+def index_records_stats(records):
+    """Update the ``_stats`` field of indexed records.
+
+    Only the statistics are computed, without running the record indexer
+    (and its database lookups). The documents are fetched and written back
+    whole, with their own external version: partial updates,
+    ``_update_by_query`` and ``if_seq_no`` writes all increment the
+    document version, which must stay equal to the record revision for the
+    indexer's ``external_gte`` versioning (otherwise reindexing the same
+    revision, e.g. when a new version changes the relations, would fail).
+
+    Concurrent indexer writes are handled as follows:
 
+    * a newer revision indexed in the meantime makes the write fail with a
+      version conflict, and the document is skipped;
+    * a document rewritten at the same revision (detected by its
+      ``_seq_no`` and ``_primary_term``, checked again right before the
+      write) is skipped, as the indexer also computes its statistics;
+    * a rewrite at the same revision between this last check and the write
+      is overwritten with the previously fetched document. The window is a
+      single bulk request, and the next reindex of the record repairs it.
 
-@lru_cache(maxsize=1024)
-def fetch_record_file(recid, filename):
-    """Cached record file fetch."""
-    _, record = fetch_record(recid)
-    return record.files[filename].obj
+    :param records: List of ``(record_id, recid, conceptrecid)`` tuples.
+    :returns: List of the IDs of the records which are not indexed.
+    """
+    if not records:
+        return []
+    index = build_alias_name('records')
+    ids = [record_id for record_id, _, _ in records]
+    docs = current_search_client.mget(index=index, body={'ids': ids})['docs']
+    stats = build_records_stats([
+        (recid, conceptrecid)
+        for (_, recid, conceptrecid), doc in zip(records, docs)
+        if doc.get('found')
+    ])
+    # Skip the documents rewritten (with their statistics) by the indexer
+    fetched = dict(
+        (doc['_id'], (doc['_seq_no'], doc['_primary_term']))
+        for doc in docs if doc.get('found'))
+    current = current_search_client.mget(
+        index=index, body={'ids': list(fetched)}, _source=False,
+    )['docs'] if fetched else []
+    unchanged = set(
+        doc['_id'] for doc in current if doc.get('found') and
+        fetched[doc['_id']] == (doc['_seq_no'], doc['_primary_term']))
+    actions, missing = [], []
+    for (record_id, recid, conceptrecid), doc in zip(records, docs):
+        if not doc.get('found'):
+            missing.append(record_id)
+            continue
+        if doc['_id'] not in unchanged:
+            continue
+        source = doc['_source']
+        source['_stats'] = stats[recid]
+        actions.append(dict(
+            _op_type='index',
+            _index=doc['_index'],
+            _id=doc['_id'],
+            _version=doc['_version'],
+            _version_type='external_gte',
+            _source=source,
+        ))
+    _, errors = bulk(current_search_client, actions, raise_on_error=False)
+    for error in errors:
+        if list(error.values())[0].get('status') == 409:
+            continue
+        current_app.logger.warning(
+            'Failed to update record statistics.', extra={'error': error})
+    return missing
@@ -26,8 +26,9 @@
 
 from __future__ import absolute_import, print_function
 
-from .common import obj_or_import_string
+from .common import after_transaction, obj_or_import_string
 
 __all__ = (
+    'after_transaction',
     'obj_or_import_string',
 )
@@ -28,19 +28,28 @@ from __future__ import absolute_import, print_function
 
 import json
 import os
+import time
+from datetime import datetime
 from io import SEEK_END, SEEK_SET
 
 import click
+from celery import group
 from flask.cli import with_appcontext
 from invenio_db import db
 from invenio_files_rest.models import ObjectVersion
 from invenio_pidstore.models import PersistentIdentifier
 from invenio_records.api import Record
 from invenio_records.models import RecordMetadata
+from invenio_search import current_search_client
+from invenio_search.utils import build_alias_name
 
 from zenodo.modules.deposit.resolvers import deposit_resolver
 from zenodo.modules.deposit.tasks import datacite_register
+from zenodo.modules.records.indexer import ZenodoRecordIndexer, \
+    create_reindex_index, swap_index_aliases, update_index_settings, \
+    uuid_ranges
 from zenodo.modules.records.resolvers import record_resolver
+from zenodo.modules.records.tasks import reindex_records
 
 from .grants import OpenAIREGrantsDump
 from .openaire import OpenAIRECommunitiesMappingUpdater
@@ -404,3 +413,90 @@ def update_openaire_communities(path):
         unresolved_communities, indent=4, separators=(', ', ': '))))
     click.secho('{0}'.format(json.dumps(mapping, indent=4,
                                         separators=(', ', ': '))), fg='blue')
+
+
+@utils.command('reindex')
+@click.option('--index', '-i', default='records-record-v1.0.0',
+              help='Index to reindex.')
+@click.option('--workers', '-w', type=int, default=4,
+              help='Number of UUID ranges indexed by parallel tasks.')
+@click.option('--chunk-size', type=int,
+              help='Number of records per bulk request.')
+@click.option('--refresh-interval', default='-1',
+              help='Refresh interval of the index while reindexing.')
+@click.option('--new-index', is_flag=True,
+              help='Reindex into a new index, and then move the aliases to '
+                   'it (zero downtime).')
+@click.option('--delete-old', is_flag=True,
+              help='Delete the old index after moving the aliases.')
+@with_appcontext
+def reindex(index, workers, chunk_size, refresh_interval, new_index,
+            delete_old):
+    """Reindex the records of an index in parallel tasks."""
+    target = create_reindex_index(index) if new_index else None
+    settings = {'refresh_interval': refresh_interval}
+    if target:
+        click.secho('Created index {0}'.format(target), fg='blue')
+        settings['number_of_replicas'] = 0
+    index_name = target or build_alias_name(index)
+    previous_settings = update_index_settings(index_name, settings)
+
+    started, start_time = datetime.utcnow(), time.time()
+    ranges = uuid_ranges(workers)
+    result = group(
+        reindex_records.s(start, end, index=index, target=target,
+                          chunk_size=chunk_size,
+                          es_bulk_kwargs={'raise_on_error': False})
+        for start, end in ranges
+    ).apply_async()
+    try:
+        with click.progressbar(length=workers, label='Reindexing') as bar:
+            while not result.ready():
+                time.sleep(1)
+                bar.update(result.completed_count() - bar.pos)
+            bar.update(workers - bar.pos)
+        partitions = result.get(propagate=False)
+    finally:
+        update_index_settings(index_name, previous_settings)
+    current_search_client.indices.refresh(index=index_name)
+
+    elapsed = time.time() - start_time
+    failed = [(start, end, p) for (start, end), p in zip(ranges, partitions)
+              if not isinstance(p, dict)]
+    partitions = [p for p in partitions if isinstance(p, dict)]
+    indexed = sum(p['indexed'] for p in partitions)
+    errors = sum(p['errors'] for p in partitions)
+    for p in partitions:
+        click.echo('{start} - {end}: {indexed} indexed, {errors} errors, '
+                   '{rate:.1f} docs/s'.format(
+                       rate=p['indexed'] / max(p['time'], 1e-3), **p))
+    for start, end, exc in failed:
+        click.secho('{0} - {1}: failed ({2!r})'.format(start, end, exc),
+                    fg='red')
+    click.secho('{0} records indexed, {1} errors, {2} failed ranges in '
+                '{3:.1f}s ({4:.1f} docs/s)'.format(
+                    indexed, errors, len(failed), elapsed,
+                    indexed / max(elapsed, 1e-3)),
+                fg='red' if errors or failed else 'green')
+
+    if target:
+        if errors or failed:
+            current_search_client.indices.delete(index=target)
+            click.secho('Aliases not moved and {0} deleted, due to the '
+                        'errors.'.format(target), fg='red')
+            return
+        old_indices = swap_index_aliases(index, target)
+        click.secho('Aliases moved to {0}'.format(target), fg='green')
+        # Reindex the records modified while reindexing, through the alias
+        modified = db.session.query(
+            RecordMetadata.id, RecordMetadata.json.is_(None)).filter(
+                RecordMetadata.updated >= started).all()
+        indexer = ZenodoRecordIndexer()
+        indexer.bulk_index(id_ for id_, deleted in modified if not deleted)
+        indexer.bulk_delete(id_ for id_, deleted in modified if deleted)
+        click.secho('Sent {0} modified records for indexing.'.format(
+            len(modified)), fg='blue')
+        if delete_old and old_indices:
+            current_search_client.indices.delete(index=','.join(old_indices))
+            click.secho('Deleted {0}'.format(', '.join(old_indices)),
+                        fg='blue')
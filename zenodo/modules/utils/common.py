@@ -27,8 +27,13 @@
 from __future__ import absolute_import, print_function
 
 import six
+from invenio_db import db
+from sqlalchemy import event
 from werkzeug.utils import import_string
 
+AFTER_TRANSACTION_KEY = 'zenodo_after_transaction'
+"""Session info key of the functions called once the transaction ends."""
+
 
 def obj_or_import_string(value, default=None):
     """Import string or return object.
@@ -42,3 +47,36 @@ def obj_or_import_string(value, default=None):
     elif value:
         return value
     return default
+
+
+def after_transaction(key, func):
+    """Call a function once the current database transaction ends.
+
+    The function is called after the outermost transaction is committed or
+    rolled back, and only once per key. It is typically used to discard
+    cached values which another process may have cached again from the
+    previous database state before the transaction was committed.
+
+    :param key: Key of the function (a later function replaces it).
+    :param func: Function called without arguments.
+    :returns: Whether no function was registered yet with this key.
+    """
+    funcs = db.session.info.setdefault(AFTER_TRANSACTION_KEY, {})
+    registered = key in funcs
+    funcs[key] = func
+    return not registered
+
+
+def _after_transaction_end(session, transaction):
+    """Call the functions registered for the ending transaction."""
+    if transaction.parent is None:
+        for func in session.info.pop(AFTER_TRANSACTION_KEY, {}).values():
+            func()
+
+
+def register_after_transaction():
+    """Call the functions of ``after_transaction`` when transactions end."""
+    if not event.contains(
+            db.session, 'after_transaction_end', _after_transaction_end):
+        event.listen(
+            db.session, 'after_transaction_end', _after_transaction_end)